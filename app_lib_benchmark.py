@@ -0,0 +1,168 @@
+"""
+Synthetic road networks and reporting helpers for benchmarking round trip generation.
+
+Synthetic networks come in the fi_2po_4pgr column layout (see app_lib_graph.EDGE_COLUMNS), built into a RoadGraph
+and NearestNodeIndex by build_network(). The benchmark itself drives the generate_ksp_roundtrip view's pipeline, so
+it lives with the view layer, in the benchmark_round_trip management command.
+"""
+from .app_lib_graph import RoadGraph
+from .app_lib_spatial import NearestNodeIndex
+from .app_lib_timing import PhaseTimer
+import math
+import tracemalloc
+import numpy as np
+
+
+METRES_PER_DEGREE_LAT = 111320.0
+DEFAULT_CENTER_LAT = 60.17
+DEFAULT_CENTER_LON = 24.94
+# osm2po clazz values and their share of streets: tertiary, cycleway, residential, secondary
+DEFAULT_CLAZZ_MIX = ((31, 0.15), (81, 0.1), (41, 0.6), (21, 0.15))
+SYNTHETIC_NETWORK_KINDS = ('grid', 'geometric')
+NETWORK_KINDS = SYNTHETIC_NETWORK_KINDS + ('database',)
+PHASES = ('snap', 'sectors', 'ksp', 'dispose', 'alt_ksp', 'merge')
+PERCENTILES = (50, 90, 99)
+
+
+def _network_columns(node_lats, node_lons, sources, targets, clazz_mix, random):
+    # Two-way streets: every undirected (source, target) pair becomes an edge in both directions
+    sources, targets = np.concatenate((sources, targets)), np.concatenate((targets, sources))
+    x1, y1, x2, y2 = node_lons[sources], node_lats[sources], node_lons[targets], node_lats[targets]
+    lat_scale = METRES_PER_DEGREE_LAT
+    lon_scale = METRES_PER_DEGREE_LAT * np.cos(np.radians((y1 + y2) / 2))
+    half = len(sources) // 2
+    clazz_values, clazz_shares = zip(*clazz_mix)
+    clazz = random.choice(clazz_values, size=half, p=np.asarray(clazz_shares) / sum(clazz_shares))
+    return {
+        'id': np.arange(1, len(sources) + 1, dtype=np.float64),
+        'source': sources + 1.0,
+        'target': targets + 1.0,
+        'cost': np.hypot((x2 - x1) * lon_scale, (y2 - y1) * lat_scale),
+        'clazz': np.concatenate((clazz, clazz)).astype(np.float64),
+        'x1': x1, 'y1': y1, 'x2': x2, 'y2': y2,
+        'xmin': np.minimum(x1, x2), 'ymin': np.minimum(y1, y2),
+        'xmax': np.maximum(x1, x2), 'ymax': np.maximum(y1, y2)
+    }
+
+
+def generate_grid_network(size_km, spacing_m=100, center_lat=DEFAULT_CENTER_LAT, center_lon=DEFAULT_CENTER_LON,
+                          drop_ratio=0.1, jitter_ratio=0.2, clazz_mix=DEFAULT_CLAZZ_MIX, seed=0):
+    """
+    Manhattan-like city: jittered square grid of size_km x size_km with drop_ratio of the streets missing.
+    """
+    random = np.random.RandomState(seed)
+    cells = max(int(size_km * 1000 / spacing_m), 1) + 1
+    rows, cols = np.divmod(np.arange(cells * cells), cells)
+    offsets_y = (rows - cells / 2.0 + random.uniform(-jitter_ratio, jitter_ratio, rows.shape)) * spacing_m
+    offsets_x = (cols - cells / 2.0 + random.uniform(-jitter_ratio, jitter_ratio, cols.shape)) * spacing_m
+    node_lats = center_lat + offsets_y / METRES_PER_DEGREE_LAT
+    node_lons = center_lon + offsets_x / (METRES_PER_DEGREE_LAT * math.cos(math.radians(center_lat)))
+
+    nodes = np.arange(cells * cells).reshape(cells, cells)
+    sources = np.concatenate((nodes[:, :-1].ravel(), nodes[:-1, :].ravel()))
+    targets = np.concatenate((nodes[:, 1:].ravel(), nodes[1:, :].ravel()))
+    kept = random.uniform(size=len(sources)) >= drop_ratio
+    return _network_columns(node_lats, node_lons, sources[kept], targets[kept], clazz_mix, random)
+
+
+def generate_geometric_network(size_km, node_count, connect_radius_m=150, center_lat=DEFAULT_CENTER_LAT,
+                               center_lon=DEFAULT_CENTER_LON, clazz_mix=DEFAULT_CLAZZ_MIX, seed=0):
+    """
+    Organic city: node_count random points in a size_km x size_km square, streets between all pairs of points
+    closer than connect_radius_m (a random geometric graph).
+    """
+    random = np.random.RandomState(seed)
+    ys = random.uniform(-size_km * 500, size_km * 500, node_count)
+    xs = random.uniform(-size_km * 500, size_km * 500, node_count)
+    node_lats = center_lat + ys / METRES_PER_DEGREE_LAT
+    node_lons = center_lon + xs / (METRES_PER_DEGREE_LAT * math.cos(math.radians(center_lat)))
+
+    # Points bucketed into radius sized cells, pairs only looked for within and between neighbouring cells
+    cell_rows = np.floor(ys / connect_radius_m).astype(np.int64)
+    cell_cols = np.floor(xs / connect_radius_m).astype(np.int64)
+    order = np.lexsort((cell_cols, cell_rows))
+    cell_keys = (cell_rows * (node_count + 1) + cell_cols)[order]
+    source_chunks, target_chunks = [], []
+    for row_step, col_step in ((0, 0), (0, 1), (1, -1), (1, 0), (1, 1)):
+        neighbour_keys = ((cell_rows + row_step) * (node_count + 1) + cell_cols + col_step)[order]
+        starts = np.searchsorted(cell_keys, neighbour_keys, side='left')
+        ends = np.searchsorted(cell_keys, neighbour_keys, side='right')
+        counts = ends - starts
+        pair_sources = np.repeat(order, counts)
+        pair_targets = order[np.repeat(starts, counts) + np.arange(int(counts.sum())) - np.repeat(np.cumsum(counts) - counts, counts)]
+        close = np.hypot(ys[pair_sources] - ys[pair_targets], xs[pair_sources] - xs[pair_targets]) < connect_radius_m
+        if (row_step, col_step) == (0, 0):
+            close &= pair_sources < pair_targets  # Each pair once, no self loops
+        source_chunks.append(pair_sources[close])
+        target_chunks.append(pair_targets[close])
+    return _network_columns(
+        node_lats, node_lons, np.concatenate(source_chunks), np.concatenate(target_chunks), clazz_mix, random
+    )
+
+
+class PhaseRecorder(PhaseTimer):
+    """
+    PhaseTimer keeping the time of every single phase run in phase_seconds[phase], for percentiles.
+    Never finished, the benchmark doesn't end up in the phase timing histograms.
+    """
+
+    def __init__(self, phase_seconds):
+        super().__init__('benchmark_round_trip')
+        self.phase_seconds = phase_seconds
+
+    def add(self, phase, seconds):
+        self.phase_seconds.setdefault(phase, []).append(seconds)
+
+
+def summarize_seconds(seconds):
+    if not seconds:
+        return None
+    milliseconds = np.asarray(seconds) * 1000
+    summary = {'count': len(seconds), 'mean_ms': float(milliseconds.mean())}
+    for percentile in PERCENTILES:
+        summary['p{}_ms'.format(percentile)] = float(np.percentile(milliseconds, percentile))
+    return summary
+
+
+def build_network(kind, size_km, node_count, seed, landmark_count):
+    # (RoadGraph, NearestNodeIndex) of a synthetic network
+    if kind == 'grid':
+        columns = generate_grid_network(size_km, seed=seed)
+    else:
+        columns = generate_geometric_network(size_km, node_count, seed=seed)
+    graph = RoadGraph.from_edges(columns, version='benchmark')
+    if landmark_count > 0:
+        graph = graph.with_landmarks(landmark_count)
+    return graph, NearestNodeIndex(graph.node_id, graph.node_lat, graph.node_lon, version='benchmark')
+
+
+def measure_peak_bytes(function, *args):
+    # Peak of memory traced while function(*args) runs, in a pass of its own
+    tracemalloc.start()
+    try:
+        function(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def compare_to_baseline(report, baseline):
+    """
+    Per workload (distance, concurrency) ratios current / baseline of p50, p99 and throughput.
+    """
+    baseline_workloads = {
+        (workload['distance_km'], workload['concurrency']): workload for workload in baseline['workloads']
+    }
+    comparisons = []
+    for workload in report['workloads']:
+        before = baseline_workloads.get((workload['distance_km'], workload['concurrency']))
+        if before is None or not before['request'] or not workload['request']:
+            continue
+        comparisons.append({
+            'distance_km': workload['distance_km'],
+            'concurrency': workload['concurrency'],
+            'p50_ratio': workload['request']['p50_ms'] / before['request']['p50_ms'],
+            'p99_ratio': workload['request']['p99_ms'] / before['request']['p99_ms'],
+            'throughput_ratio': workload['requests_per_second'] / before['requests_per_second']
+        })
+    return comparisons
@@ -0,0 +1,100 @@
+"""
+Per-request latency budget for round trip generation.
+
+A RequestBudget carries the request's deadline (settings.ROUND_TRIP_TIME_BUDGET seconds from its start, none when
+unset) and lets one thread cancel the database work other threads are doing for the same request. Queries run inside
+budget.query_scope(dbh), which limits them to the remaining time with "SET LOCAL statement_timeout" and makes them
+cancellable by budget.cancel(). Work that ran out of time raises BudgetExhausted.
+"""
+from django.conf import settings
+from contextlib import contextmanager
+import threading
+import time
+import psycopg2
+import psycopg2.extensions
+
+
+DEFAULT_ROUND_TRIP_TIME_BUDGET = None  # seconds, no deadline unless configured
+MIN_STATEMENT_TIMEOUT_MS = 1  # 0 would mean no timeout at all
+
+
+class BudgetExhausted(Exception):
+    pass
+
+
+class RequestBudget:
+
+    def __init__(self, seconds=None):
+        self.deadline = time.time() + seconds if seconds else None
+        self._cancelled = threading.Event()
+        self._lock = threading.Lock()
+        self._connections = set()  # Connections running a query_scope() right now
+        self._sub_budgets = []
+
+    def sub_budget(self):
+        """
+        Budget with the same deadline that can be cancelled on its own (e.g. for one round trip of a batch), and is
+        cancelled along with this one.
+        """
+        sub_budget = RequestBudget()
+        sub_budget.deadline = self.deadline
+        with self._lock:
+            self._sub_budgets.append(sub_budget)
+        if self._cancelled.is_set():
+            sub_budget.cancel()
+        return sub_budget
+
+    def remaining_seconds(self):
+        # None without a deadline
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - time.time())
+
+    def is_exhausted(self):
+        return self._cancelled.is_set() or self.remaining_seconds() == 0.0
+
+    def check(self):
+        if self.is_exhausted():
+            raise BudgetExhausted()
+
+    def cancel(self):
+        """
+        Make further check()s fail and cancel the queries running in query scopes (they raise BudgetExhausted),
+        sub budgets included.
+        """
+        self._cancelled.set()
+        with self._lock:
+            for dbh in self._connections:
+                try:
+                    dbh.cancel()
+                except psycopg2.Error:
+                    pass
+            sub_budgets = list(self._sub_budgets)
+        for sub_budget in sub_budgets:
+            sub_budget.cancel()
+
+    @contextmanager
+    def query_scope(self, dbh):
+        self.check()
+        remaining_seconds = self.remaining_seconds()
+        if remaining_seconds is not None:
+            # SET LOCAL (as set_config() to take a parameter): the pool rolls the transaction back on return
+            cursor = dbh.cursor()
+            cursor.execute(
+                "SELECT set_config('statement_timeout', %s, true);",
+                (str(max(MIN_STATEMENT_TIMEOUT_MS, int(remaining_seconds * 1000))),)
+            )
+            cursor.close()
+        with self._lock:
+            self._connections.add(dbh)
+        try:
+            yield dbh
+        except psycopg2.extensions.QueryCanceledError:
+            raise BudgetExhausted()
+        finally:
+            with self._lock:
+                self._connections.discard(dbh)
+
+
+def start_request_budget():
+    return RequestBudget(getattr(settings, 'ROUND_TRIP_TIME_BUDGET', DEFAULT_ROUND_TRIP_TIME_BUDGET))
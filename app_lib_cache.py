@@ -0,0 +1,136 @@
+from django.core.cache import caches
+from collections import OrderedDict
+import threading
+import time
+
+
+class TTLLRUCache:
+    """
+    Thread-safe in-process cache with least-recently-used eviction beyond max_size and per-entry time-to-live.
+    With stale_ttl > 0, entries up to stale_ttl seconds past their TTL are still served by get_or_compute()
+    while a background thread recomputes them (stale-while-revalidate).
+    """
+
+    def __init__(self, max_size, ttl, stale_ttl=0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self._entries = OrderedDict()  # key -> (value, stored_at)
+        self._revalidating = set()
+        self._lock = threading.Lock()
+        self._stats = {
+            'hits': 0,
+            'stale_hits': 0,
+            'misses': 0,
+            'evictions': 0,
+            'expirations': 0
+        }
+
+    def _lookup(self, key):
+        # Returns (value, is_stale), or (None, None) on a miss; caller holds the lock
+        entry = self._entries.get(key)
+        if entry is None:
+            return None, None
+        value, stored_at = entry
+        age = time.time() - stored_at
+        if age > self.ttl + self.stale_ttl:
+            del self._entries[key]
+            self._stats['expirations'] += 1
+            return None, None
+        self._entries.move_to_end(key)
+        return value, age > self.ttl
+
+    def get(self, key, default=None):
+        with self._lock:
+            value, is_stale = self._lookup(key)
+            if is_stale is None or is_stale:
+                self._stats['misses'] += 1
+                return default
+            self._stats['hits'] += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.time())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self._stats['evictions'] += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def get_or_compute(self, key, compute):
+        with self._lock:
+            value, is_stale = self._lookup(key)
+            if is_stale is False:
+                self._stats['hits'] += 1
+                return value
+            if is_stale:
+                self._stats['stale_hits'] += 1
+                if key not in self._revalidating:
+                    self._revalidating.add(key)
+                    threading.Thread(target=self._revalidate, args=(key, compute), daemon=True).start()
+                return value
+            self._stats['misses'] += 1
+        value = compute()
+        self.set(key, value)
+        return value
+
+    def _revalidate(self, key, compute):
+        try:
+            self.set(key, compute())
+        except Exception:
+            pass  # Keep serving the stale entry until it expires for good
+        finally:
+            with self._lock:
+                self._revalidating.discard(key)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = len(self._entries)
+        stats['max_size'] = self.max_size
+        return stats
+
+
+class DjangoCacheAdapter:
+    """
+    get/set/stats of TTLLRUCache on top of a configured Django cache (e.g. memcached or redis shared by all
+    workers). Tuple keys are joined into strings under key_prefix.
+    """
+
+    def __init__(self, alias, ttl, key_prefix):
+        self.alias = alias
+        self.ttl = ttl
+        self.key_prefix = key_prefix
+        self._lock = threading.Lock()
+        self._stats = {
+            'hits': 0,
+            'misses': 0
+        }
+
+    def _cache_key(self, key):
+        parts = key if isinstance(key, tuple) else (key,)
+        return ':'.join([self.key_prefix] + [str(part) for part in parts])
+
+    def get(self, key, default=None):
+        value = caches[self.alias].get(self._cache_key(key))
+        with self._lock:
+            self._stats['hits' if value is not None else 'misses'] += 1
+        return default if value is None else value
+
+    def set(self, key, value):
+        caches[self.alias].set(self._cache_key(key), value, self.ttl)
+
+    def delete(self, key):
+        caches[self.alias].delete(self._cache_key(key))
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
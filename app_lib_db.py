@@ -0,0 +1,179 @@
+from django.conf import settings
+from contextlib import contextmanager
+import os
+import threading
+import time
+import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
+
+
+# Defaults, overridable with GISDB_POOL_* settings
+DEFAULT_POOL_MIN_SIZE = 1
+DEFAULT_POOL_MAX_SIZE = 10
+DEFAULT_POOL_CHECKOUT_TIMEOUT = 10  # seconds to wait for a free connection before giving up
+DEFAULT_POOL_HEALTH_CHECK_INTERVAL = 30  # seconds a connection may idle before it is pinged on checkout
+
+
+class GisdbPoolExhausted(Exception):
+    pass
+
+
+def get_gisdb_data_source_name():
+    return "host={} dbname={} user={} password={}".format(
+        settings.GISDB_HOST,
+        settings.GISDB_NAME,
+        settings.GISDB_USER,
+        settings.GISDB_PASSWORD
+    )
+
+
+class GisdbConnectionPool:
+    """
+    Thread-safe pool of psycopg2 connections to the GIS database.
+    Checkouts block (up to checkout_timeout) instead of failing when all max_size connections are in use,
+    so concurrent requests queue up rather than exhausting Postgres' max_connections.
+    """
+
+    def __init__(self, min_size, max_size, checkout_timeout, health_check_interval):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.checkout_timeout = checkout_timeout
+        self.health_check_interval = health_check_interval
+        self._pool = psycopg2.pool.ThreadedConnectionPool(min_size, max_size, get_gisdb_data_source_name())
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._lock = threading.Lock()
+        self._last_used = {}  # id(connection) -> timestamp of last return to pool, for idle connections only
+        self._metrics = {
+            'checkouts': 0,
+            'checkout_timeouts': 0,
+            'checkout_wait_seconds_total': 0.0,
+            'connections_discarded': 0,
+            'health_check_failures': 0,
+            'in_use': 0
+        }
+
+    def _is_healthy(self, dbh):
+        if dbh.closed:
+            return False
+        last_used = self._last_used.get(id(dbh))
+        if last_used is None or time.time() - last_used < self.health_check_interval:
+            return True
+        try:
+            cursor = dbh.cursor()
+            cursor.execute("SELECT 1;")
+            cursor.close()
+            dbh.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _discard(self, dbh):
+        with self._lock:
+            self._last_used.pop(id(dbh), None)
+            self._metrics['connections_discarded'] += 1
+        self._pool.putconn(dbh, close=True)
+
+    def getconn(self):
+        wait_started = time.time()
+        if not self._slots.acquire(timeout=self.checkout_timeout):
+            with self._lock:
+                self._metrics['checkout_timeouts'] += 1
+            raise GisdbPoolExhausted('No GIS database connection available within {}s'.format(self.checkout_timeout))
+        try:
+            dbh = self._pool.getconn()
+            while not self._is_healthy(dbh):
+                with self._lock:
+                    self._metrics['health_check_failures'] += 1
+                self._discard(dbh)
+                dbh = self._pool.getconn()
+        except Exception:
+            self._slots.release()
+            raise
+        with self._lock:
+            self._last_used.pop(id(dbh), None)
+            self._metrics['checkouts'] += 1
+            self._metrics['checkout_wait_seconds_total'] += time.time() - wait_started
+            self._metrics['in_use'] += 1
+        return dbh
+
+    def putconn(self, dbh, broken=False):
+        try:
+            # Never hand out a connection mid-transaction (also drops leftover "ON COMMIT DROP" temp tables)
+            if not broken and not dbh.closed \
+                    and dbh.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    dbh.rollback()
+                except psycopg2.Error:
+                    broken = True
+            if broken or dbh.closed:
+                self._discard(dbh)
+            else:
+                with self._lock:
+                    self._last_used[id(dbh)] = time.time()
+                self._pool.putconn(dbh)
+        finally:
+            with self._lock:
+                self._metrics['in_use'] -= 1
+            self._slots.release()
+
+    def closeall(self):
+        self._pool.closeall()
+
+    def metrics(self):
+        with self._lock:
+            metrics = dict(self._metrics)
+        metrics['min_size'] = self.min_size
+        metrics['max_size'] = self.max_size
+        metrics['idle'] = len(self._last_used)
+        return metrics
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def get_gisdb_pool():
+    global _pool, _pool_pid
+    # (Re)create lazily per process, pooled sockets must not be shared across forked workers
+    if _pool is None or _pool_pid != os.getpid():
+        with _pool_lock:
+            if _pool is None or _pool_pid != os.getpid():
+                _pool = GisdbConnectionPool(
+                    getattr(settings, 'GISDB_POOL_MIN_SIZE', DEFAULT_POOL_MIN_SIZE),
+                    getattr(settings, 'GISDB_POOL_MAX_SIZE', DEFAULT_POOL_MAX_SIZE),
+                    getattr(settings, 'GISDB_POOL_CHECKOUT_TIMEOUT', DEFAULT_POOL_CHECKOUT_TIMEOUT),
+                    getattr(settings, 'GISDB_POOL_HEALTH_CHECK_INTERVAL', DEFAULT_POOL_HEALTH_CHECK_INTERVAL)
+                )
+                _pool_pid = os.getpid()
+    return _pool
+
+
+def get_gisdb_pool_metrics():
+    # None while this process has no pool yet, reporting must not open connections of its own
+    if _pool is None or _pool_pid != os.getpid():
+        return None
+    return _pool.metrics()
+
+
+@contextmanager
+def gisdb_connection(dbh=None):
+    """
+    Check out a pooled GIS database connection for the duration of the block.
+    If an already checked out connection (dbh) is given it is simply reused, so one request can share
+    a single checkout across several helpers.
+    """
+    if dbh is not None:
+        yield dbh
+        return
+    pool = get_gisdb_pool()
+    dbh = pool.getconn()
+    broken = False
+    try:
+        yield dbh
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        broken = True
+        raise
+    finally:
+        pool.putconn(dbh, broken=broken)
@@ -0,0 +1,66 @@
+from django.conf import settings
+import numpy as np
+
+
+DEFAULT_EDGE_DISPOSAL_STRATEGY = 'mid_distance_repetition'
+
+
+def paths_to_arrays(paths):
+    """
+    Flatten K shortest paths (lists of edge ids, cheapest first) into (route_ids, seqs, edges) arrays,
+    the same columns PGR_KSP returns row by row.
+    """
+    lengths = np.array([len(path) for path in paths], dtype=np.int64)
+    route_ids = np.repeat(np.arange(len(paths), dtype=np.int64), lengths)
+    route_starts = np.concatenate(([0], np.cumsum(lengths)[:-1])) if len(paths) else np.zeros(0, dtype=np.int64)
+    seqs = np.arange(int(lengths.sum()), dtype=np.int64) - np.repeat(route_starts, lengths)
+    edges = np.array([edge for path in paths for edge in path], dtype=np.int64)
+    return route_ids, seqs, edges
+
+
+def score_mid_distance_repetition(route_ids, seqs, edges, route_count):
+    """
+    Default strategy: (times crossed / route count) * average "how close to the middle of its route" weight.
+    Edges shared by many routes around their middle score highest, disposing them forces a different way out.
+    """
+    # total_sequences/2 is middle point, abs(middle_point - seq)/middle_point is a 1..0..1 offset ratio,
+    # reduced from 1 to have it around as 0..1..0 instead
+    half_route_lengths = np.bincount(route_ids, minlength=route_count)[route_ids] / 2
+    weights = 1 - (np.abs(half_route_lengths - seqs) / half_route_lengths)
+    unique_edges, edge_index = np.unique(edges, return_inverse=True)
+    counts_crossed = np.bincount(edge_index)
+    average_weights = np.bincount(edge_index, weights=weights) / counts_crossed
+    return unique_edges, (counts_crossed / route_count) * average_weights
+
+
+def score_repetition(route_ids, seqs, edges, route_count):
+    """
+    Alternative strategy for comparison: share of routes crossing the edge, position ignored.
+    """
+    unique_edges, edge_index = np.unique(edges, return_inverse=True)
+    return unique_edges, np.bincount(edge_index) / route_count
+
+
+EDGE_DISPOSAL_STRATEGIES = {
+    'mid_distance_repetition': score_mid_distance_repetition,
+    'repetition': score_repetition
+}
+
+
+def select_disposed_edges(paths, dispose_margin, strategy=None):
+    """
+    Edge ids of the first (cheapest) path scoring above dispose_margin, in first path order.
+    strategy names one of EDGE_DISPOSAL_STRATEGIES, default settings.EDGE_DISPOSAL_STRATEGY.
+    """
+    if len(paths) == 0:
+        return []
+    if strategy is None:
+        strategy = getattr(settings, 'EDGE_DISPOSAL_STRATEGY', DEFAULT_EDGE_DISPOSAL_STRATEGY)
+    route_ids, seqs, edges = paths_to_arrays(paths)
+    unique_edges, scores = EDGE_DISPOSAL_STRATEGIES[strategy](route_ids, seqs, edges, len(paths))
+
+    # (Less aggressive disposing for more options) Restrict disposed edges to those found in first path
+    first_path_edges = edges[route_ids == 0]
+    first_path_edges = first_path_edges[np.sort(np.unique(first_path_edges, return_index=True)[1])]
+    first_path_scores = scores[np.searchsorted(unique_edges, first_path_edges)]
+    return first_path_edges[first_path_scores > dispose_margin].tolist()
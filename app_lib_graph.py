@@ -0,0 +1,567 @@
+from django.conf import settings
+from .app_lib_db import gisdb_connection
+from .app_lib_sql import get_current_road_network_version, get_sector_names, WAY_PRIORITY
+import heapq
+import json
+import os
+import re
+import shutil
+import threading
+import time
+import numpy as np
+
+
+# Columns loaded per fi_2po_4pgr edge; xmin..ymax is the bbox of geom_way, used to mimic "geom_way && envelope"
+EDGE_COLUMNS = ('id', 'source', 'target', 'cost', 'clazz', 'x1', 'y1', 'x2', 'y2', 'xmin', 'ymin', 'xmax', 'ymax')
+LOAD_BATCH_SIZE = 50000
+EARTH_RADIUS_M = 6371008.8
+SNAPSHOT_POINTER = 'current'  # File in the snapshot directory naming the snapshot to map
+SNAPSHOT_MANIFEST = 'manifest.json'
+DEFAULT_SNAPSHOTS_KEPT = 2
+DEFAULT_SNAPSHOT_CHECK_INTERVAL = 10  # seconds between checks of the snapshot pointer
+DEFAULT_LANDMARK_COUNT = 16
+ACTIVE_LANDMARK_COUNT = 4  # Of the landmarks, how many give the lower bounds of one query
+UNREACHABLE_DISTANCE = 1e12  # Stands in for infinity in landmark distances, so that bounds never turn into NaN
+
+
+class RoadGraph:
+    """
+    Directed road network held in flat NumPy arrays, adjacency in compressed sparse row (CSR) form.
+    Edges are traversed source -> target only, like PGR_KSP(..., has_rcost=false) does.
+
+    arrays:
+      edge_id, edge_cost, edge_clazz, edge_xmin, edge_ymin, edge_xmax, edge_ymax  -- per edge
+      edge_source, edge_target  -- per edge, dense node indices
+      edge_id_order  -- edge indices sorted by edge_id, the edge id index
+      node_id, node_lat, node_lon  -- per dense node index
+      indptr  -- per node + 1, outgoing edges of node n are adjacent_edge[indptr[n]:indptr[n+1]]
+      adjacent_edge  -- edge indices sorted by their source node
+    and after with_landmarks() (ALT preprocessing):
+      reverse_indptr, reverse_adjacent_edge  -- as indptr and adjacent_edge, for incoming edges
+      landmark_node  -- per landmark, dense node index
+      landmark_distance_from, landmark_distance_to  -- per node and landmark, road distance landmark -> node
+                                                        and node -> landmark (UNREACHABLE_DISTANCE if none)
+    """
+
+    def __init__(self, arrays, version=None, snapshot_name=None):
+        self.version = version
+        self.snapshot_name = snapshot_name  # When the arrays are mapped from a snapshot (see load_road_graph_snapshot)
+        self.arrays = arrays
+        for name, array in arrays.items():
+            setattr(self, name, array)
+
+    @classmethod
+    def from_edges(cls, columns, version=None):
+        sources = np.asarray(columns['source'], dtype=np.int64)
+        targets = np.asarray(columns['target'], dtype=np.int64)
+        node_id, endpoint_index = np.unique(np.concatenate((sources, targets)), return_inverse=True)
+        edge_source = endpoint_index[:len(sources)].astype(np.int32)
+        edge_target = endpoint_index[len(sources):].astype(np.int32)
+
+        # Node coordinates come from the edges' end points (x1, y1 at source, x2, y2 at target)
+        node_lat = np.zeros(len(node_id), dtype=np.float64)
+        node_lon = np.zeros(len(node_id), dtype=np.float64)
+        node_lat[edge_target] = columns['y2']
+        node_lon[edge_target] = columns['x2']
+        node_lat[edge_source] = columns['y1']
+        node_lon[edge_source] = columns['x1']
+
+        indptr = np.zeros(len(node_id) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(edge_source, minlength=len(node_id)), out=indptr[1:])
+        adjacent_edge = np.argsort(edge_source, kind='stable').astype(np.int32)
+
+        return cls({
+            'edge_id': np.asarray(columns['id'], dtype=np.int64),
+            'edge_cost': np.asarray(columns['cost'], dtype=np.float64),
+            'edge_clazz': np.asarray(columns['clazz'], dtype=np.int16),
+            'edge_xmin': np.asarray(columns['xmin'], dtype=np.float64),
+            'edge_ymin': np.asarray(columns['ymin'], dtype=np.float64),
+            'edge_xmax': np.asarray(columns['xmax'], dtype=np.float64),
+            'edge_ymax': np.asarray(columns['ymax'], dtype=np.float64),
+            'edge_source': edge_source,
+            'edge_target': edge_target,
+            'edge_id_order': np.argsort(np.asarray(columns['id'], dtype=np.int64), kind='stable').astype(np.int32),
+            'node_id': node_id,
+            'node_lat': node_lat,
+            'node_lon': node_lon,
+            'indptr': indptr,
+            'adjacent_edge': adjacent_edge
+        }, version)
+
+    def node_index(self, node_id):
+        i = int(np.searchsorted(self.node_id, node_id))
+        if i < len(self.node_id) and self.node_id[i] == node_id:
+            return i
+        return None
+
+    def edge_indices(self, edge_ids):
+        # Edge indices of the given fi_2po_4pgr edge ids, unknown ids left out
+        edge_ids = np.asarray(list(edge_ids), dtype=np.int64)
+        positions = np.minimum(
+            np.searchsorted(self.edge_id, edge_ids, sorter=self.edge_id_order), max(len(self.edge_id) - 1, 0)
+        )
+        edge_indices = self.edge_id_order[positions]
+        return edge_indices[self.edge_id[edge_indices] == edge_ids]
+
+    def edge_mask(self, extent=None, excluded_edge_ids=()):
+        # extent is (x, y, x, y) of two opposite corners, as passed to ST_MakeEnvelope
+        allowed = np.ones(len(self.edge_id), dtype=bool)
+        if extent is not None:
+            xmin, xmax = min(extent[0], extent[2]), max(extent[0], extent[2])
+            ymin, ymax = min(extent[1], extent[3]), max(extent[1], extent[3])
+            allowed &= (self.edge_xmax >= xmin) & (self.edge_xmin <= xmax)
+            allowed &= (self.edge_ymax >= ymin) & (self.edge_ymin <= ymax)
+        if len(excluded_edge_ids) and len(self.edge_id):
+            allowed[self.edge_indices(excluded_edge_ids)] = False
+        return allowed
+
+    def shortest_path(self, source, target, allowed, removed_edges=frozenset(), removed_nodes=frozenset()):
+        """
+        Dijkstra between dense node indices over the allowed edges.
+        Returns (cost, [node indices], [edge indices]) or None when target is unreachable.
+        """
+        costs = {source: 0.0}
+        previous = {}
+        settled = set()
+        heap = [(0.0, source)]
+        while heap:
+            cost, node = heapq.heappop(heap)
+            if node in settled:
+                continue
+            if node == target:
+                break
+            settled.add(node)
+            start, end = self.indptr[node], self.indptr[node + 1]
+            for edge in self.adjacent_edge[start:end].tolist():
+                if not allowed[edge] or edge in removed_edges:
+                    continue
+                next_node = int(self.edge_target[edge])
+                if next_node in settled or next_node in removed_nodes:
+                    continue
+                next_cost = cost + self.edge_cost[edge]
+                if next_cost < costs.get(next_node, float('inf')):
+                    costs[next_node] = next_cost
+                    previous[next_node] = (node, edge)
+                    heapq.heappush(heap, (next_cost, next_node))
+        if target not in costs:
+            return None
+        nodes, edges = [target], []
+        while nodes[-1] != source:
+            node, edge = previous[nodes[-1]]
+            nodes.append(node)
+            edges.append(edge)
+        nodes.reverse()
+        edges.reverse()
+        return costs[target], nodes, edges
+
+    @property
+    def has_landmarks(self):
+        return 'landmark_node' in self.arrays
+
+    def distances_from(self, source, reverse=False):
+        """
+        Dijkstra road distances from source to every node over all edges (to source from every node if reverse),
+        UNREACHABLE_DISTANCE for nodes out of reach. For the landmark preprocessing.
+        """
+        if reverse:
+            indptr, adjacent_edge, edge_head = self.reverse_indptr, self.reverse_adjacent_edge, self.edge_source
+        else:
+            indptr, adjacent_edge, edge_head = self.indptr, self.adjacent_edge, self.edge_target
+        indptr, adjacent_edge = indptr.tolist(), adjacent_edge.tolist()
+        edge_head, edge_cost = edge_head.tolist(), self.edge_cost.tolist()
+        distances = [UNREACHABLE_DISTANCE] * len(self.node_id)
+        distances[source] = 0.0
+        heap = [(0.0, source)]
+        while heap:
+            distance, node = heapq.heappop(heap)
+            if distance > distances[node]:
+                continue
+            for edge in adjacent_edge[indptr[node]:indptr[node + 1]]:
+                next_distance = distance + edge_cost[edge]
+                if next_distance < distances[edge_head[edge]]:
+                    distances[edge_head[edge]] = next_distance
+                    heapq.heappush(heap, (next_distance, edge_head[edge]))
+        return np.asarray(distances)
+
+    def with_landmarks(self, landmark_count=DEFAULT_LANDMARK_COUNT):
+        """
+        Copy of the graph with ALT preprocessing, see bidirectional_shortest_path(). Landmarks are picked farthest
+        first: each next one is the node farthest (by road) from all picked so far, which puts them around the
+        edges of the network where they bound the most.
+        """
+        reverse_indptr = np.zeros(len(self.node_id) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.edge_target, minlength=len(self.node_id)), out=reverse_indptr[1:])
+        graph = RoadGraph(dict(
+            self.arrays,
+            reverse_indptr=reverse_indptr,
+            reverse_adjacent_edge=np.argsort(self.edge_target, kind='stable').astype(np.int32)
+        ), self.version)
+
+        landmark_count = min(landmark_count, len(self.node_id))
+        landmark_node = np.zeros(landmark_count, dtype=np.int32)
+        distance_from = np.zeros((len(self.node_id), landmark_count), dtype=np.float32)
+        distance_to = np.zeros((len(self.node_id), landmark_count), dtype=np.float32)
+        # Starting from the node farthest from an arbitrary one, rather than from that arbitrary node itself
+        farthest_from = graph.distances_from(0)
+        for i in range(landmark_count):
+            reached = farthest_from < UNREACHABLE_DISTANCE
+            landmark_node[i] = int(np.argmax(np.where(reached, farthest_from, -1.0)))
+            distance_from[:, i] = graph.distances_from(landmark_node[i])
+            distance_to[:, i] = graph.distances_from(landmark_node[i], reverse=True)
+            nearest_landmark = distance_from[:, :i + 1].min(axis=1)
+            farthest_from = np.where(nearest_landmark < UNREACHABLE_DISTANCE, nearest_landmark, -1.0)
+            farthest_from[landmark_node[:i + 1]] = -1.0
+
+        graph.arrays.update(
+            landmark_node=landmark_node,
+            landmark_distance_from=distance_from,
+            landmark_distance_to=distance_to
+        )
+        for name in ('landmark_node', 'landmark_distance_from', 'landmark_distance_to'):
+            setattr(graph, name, graph.arrays[name])
+        return graph
+
+    def select_landmarks(self, source, target, count=ACTIVE_LANDMARK_COUNT):
+        # Landmark columns giving the tightest lower bounds of the source -> target distance
+        bounds = np.maximum(
+            self.landmark_distance_from[target].astype(np.float64) - self.landmark_distance_from[source],
+            self.landmark_distance_to[source].astype(np.float64) - self.landmark_distance_to[target]
+        )
+        return np.argsort(-bounds, kind='stable')[:count]
+
+    def landmark_distances(self, node, landmarks):
+        # (landmarks -> node, node -> landmarks) road distances as lists, plain floats beat NumPy on a few values
+        distance_from, distance_to = self.landmark_distance_from[node].tolist(), self.landmark_distance_to[node].tolist()
+        return [distance_from[i] for i in landmarks], [distance_to[i] for i in landmarks]
+
+    def bidirectional_shortest_path(self, source, target, allowed, removed_edges=frozenset(),
+                                    removed_nodes=frozenset(), landmarks=None):
+        """
+        Bidirectional A* (ALT) between dense node indices over the allowed edges, same results as shortest_path()
+        up to the float32 rounding of landmark distances (centimetres). Both searches use the average of the
+        landmark lower bounds to target and from source as potential, which keeps them consistent with each other.
+        The bounds hold on every subgraph (restricting edges only makes paths longer), so extents, excluded edges
+        and Yen's removed edges and nodes need no preprocessing of their own.
+        """
+        if source == target:
+            return 0.0, [source], []
+        if landmarks is None:
+            landmarks = self.select_landmarks(source, target)
+        landmarks = [int(landmark) for landmark in landmarks]
+        source_from, source_to = self.landmark_distances(source, landmarks)
+        target_from, target_to = self.landmark_distances(target, landmarks)
+        bounds = {}  # node -> (lower bound of node -> target, lower bound of source -> node)
+
+        def lower_bounds(node):
+            if node not in bounds:
+                node_from, node_to = self.landmark_distances(node, landmarks)
+                bounds[node] = (
+                    max(0.0, max(t - n for t, n in zip(target_from, node_from)),
+                        max(n - t for n, t in zip(node_to, target_to))),
+                    max(0.0, max(n - s for n, s in zip(node_from, source_from)),
+                        max(s - n for s, n in zip(source_to, node_to)))
+                )
+            return bounds[node]
+
+        def potential(node):
+            to_target, from_source = lower_bounds(node)
+            return (to_target - from_source) / 2
+
+        # Per direction: costs (real distances), links to the previous/next node, settled nodes, heap of (key, node)
+        costs = ({source: 0.0}, {target: 0.0})
+        links = ({}, {})
+        settled = (set(), set())
+        heaps = ([(potential(source), source)], [(-potential(target), target)])
+        adjacency = (
+            (self.indptr, self.adjacent_edge, self.edge_target),
+            (self.reverse_indptr, self.reverse_adjacent_edge, self.edge_source)
+        )
+        best_cost, meeting_node = float('inf'), None
+        while heaps[0] and heaps[1] and heaps[0][0][0] + heaps[1][0][0] < best_cost:
+            # Expand the smaller frontier
+            side = 0 if len(heaps[0]) <= len(heaps[1]) else 1
+            sign = 1 if side == 0 else -1
+            _, node = heapq.heappop(heaps[side])
+            if node in settled[side]:
+                continue
+            settled[side].add(node)
+            indptr, adjacent_edge, edge_head = adjacency[side]
+            for edge in adjacent_edge[indptr[node]:indptr[node + 1]].tolist():
+                if not allowed[edge] or edge in removed_edges:
+                    continue
+                next_node = int(edge_head[edge])
+                if next_node in settled[side] or next_node in removed_nodes:
+                    continue
+                # Nodes the landmarks prove can't reach target (or be reached from source) are no use
+                if lower_bounds(next_node)[side] >= UNREACHABLE_DISTANCE / 2:
+                    continue
+                next_cost = costs[side][node] + self.edge_cost[edge]
+                if next_cost < costs[side].get(next_node, float('inf')):
+                    costs[side][next_node] = next_cost
+                    links[side][next_node] = (node, edge)
+                    heapq.heappush(heaps[side], (next_cost + sign * potential(next_node), next_node))
+                    if next_node in costs[1 - side] and next_cost + costs[1 - side][next_node] < best_cost:
+                        best_cost, meeting_node = next_cost + costs[1 - side][next_node], next_node
+        if meeting_node is None:
+            return None
+
+        nodes, edges = [meeting_node], []
+        while nodes[0] != source:
+            node, edge = links[0][nodes[0]]
+            nodes.insert(0, node)
+            edges.insert(0, edge)
+        while nodes[-1] != target:
+            node, edge = links[1][nodes[-1]]
+            nodes.append(node)
+            edges.append(edge)
+        return best_cost, nodes, edges
+
+    def path_query(self, source, target, allowed, removed_edges=frozenset(), removed_nodes=frozenset(),
+                   landmarks=None):
+        # Goal-directed ALT search when landmarks were selected for the query, else Dijkstra
+        if landmarks is None:
+            return self.shortest_path(source, target, allowed, removed_edges, removed_nodes)
+        return self.bidirectional_shortest_path(source, target, allowed, removed_edges, removed_nodes, landmarks)
+
+    def k_shortest_paths(self, source_node_id, target_node_id, k, extent=None, excluded_edge_ids=(), budget=None):
+        """
+        Yen's K shortest loopless paths, returned cheapest first as lists of fi_2po_4pgr edge ids.
+        On a graph preprocessed with_landmarks() the path queries are bidirectional A* (ALT).
+        With a RequestBudget, BudgetExhausted is raised between path queries once it has run out or was cancelled.
+        """
+        source, target = self.node_index(source_node_id), self.node_index(target_node_id)
+        if source is None or target is None or source == target:
+            return []
+        allowed = self.edge_mask(extent, excluded_edge_ids)
+        # The landmarks best bounding the whole source -> target query also serve its spur paths (same target)
+        landmarks = self.select_landmarks(source, target) if self.has_landmarks else None
+        first_path = self.path_query(source, target, allowed, landmarks=landmarks)
+        if first_path is None:
+            return []
+
+        found_paths = [first_path]
+        candidates = []
+        seen_edge_sequences = {tuple(first_path[2])}
+        while len(found_paths) < k:
+            _, last_nodes, last_edges = found_paths[-1]
+            for i in range(len(last_nodes) - 1):
+                if budget is not None:
+                    budget.check()
+                spur_node = last_nodes[i]
+                root_nodes, root_edges = last_nodes[:i + 1], last_edges[:i]
+                # Block the next edge of every found path sharing this root, and the root itself (loopless)
+                removed_edges = {
+                    edges[i]
+                    for _, nodes, edges in found_paths
+                    if len(edges) > i and nodes[:i + 1] == root_nodes
+                }
+                spur_path = self.path_query(
+                    spur_node, target, allowed, removed_edges, set(root_nodes[:-1]), landmarks
+                )
+                if spur_path is None:
+                    continue
+                edges = root_edges + spur_path[2]
+                if tuple(edges) in seen_edge_sequences:
+                    continue
+                seen_edge_sequences.add(tuple(edges))
+                total_cost = float(self.edge_cost[root_edges].sum()) + spur_path[0]
+                heapq.heappush(candidates, (total_cost, len(seen_edge_sequences), root_nodes[:-1] + spur_path[1], edges))
+            if not candidates:
+                break
+            total_cost, _, nodes, edges = heapq.heappop(candidates)
+            found_paths.append((total_cost, nodes, edges))
+
+        return [self.edge_id[edges].tolist() for _, _, edges in found_paths]
+
+    def ranked_points_per_sector(self, center_lat, center_lon, optimal_range_km, lowest_permitted_range_km,
+                                 highest_permitted_range_km, sector_count=4, candidates_per_way_type=3):
+        """
+        In-memory counterpart of app_lib_sql.get_ranked_points_per_sector_within_range().
+        Ranges are measured to the edges' source nodes rather than to the whole way geometry.
+        """
+        center_lat_rad, center_lon_rad = np.radians(center_lat), np.radians(center_lon)
+        lat = np.radians(self.node_lat[self.edge_source])
+        delta_lon = np.radians(self.node_lon[self.edge_source]) - center_lon_rad
+
+        # Haversine distance and initial bearing from center to every edge's source node
+        a = np.sin((lat - center_lat_rad) / 2) ** 2 + np.cos(center_lat_rad) * np.cos(lat) * np.sin(delta_lon / 2) ** 2
+        metres_away = 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(a))
+        in_range = np.flatnonzero(
+            (metres_away > lowest_permitted_range_km * 1000) & (metres_away < highest_permitted_range_km * 1000)
+        )
+        metres_away, lat, delta_lon = metres_away[in_range], lat[in_range], delta_lon[in_range]
+        bearing = np.degrees(np.arctan2(
+            np.sin(delta_lon) * np.cos(lat),
+            np.cos(center_lat_rad) * np.sin(lat) - np.sin(center_lat_rad) * np.cos(lat) * np.cos(delta_lon)
+        )) % 360
+        sector = (bearing // (360.0 / sector_count)).astype(np.int64) % sector_count
+        way_priority = np.full(len(in_range), len(WAY_PRIORITY) - 1, dtype=np.int64)
+        for priority, way_type in enumerate(WAY_PRIORITY[:-1]):
+            way_priority[self.edge_clazz[in_range] == way_type] = priority
+
+        # Rank by sector, way priority, closeness to optimal range; keep the first few of each (sector, priority)
+        order = np.lexsort((np.abs(metres_away - optimal_range_km * 1000), way_priority, sector))
+        group = (sector * len(WAY_PRIORITY) + way_priority)[order]
+        group_starts = np.concatenate(([0], np.flatnonzero(np.diff(group)) + 1))
+        rank_in_group = np.arange(len(order)) - np.repeat(group_starts, np.diff(np.append(group_starts, len(order))))
+        order = order[rank_in_group < candidates_per_way_type]
+
+        sector_names = get_sector_names(sector_count)
+        sectors = {sector_name: [] for sector_name in sector_names}
+        for i in order.tolist():
+            edge = in_range[i]
+            sectors[sector_names[int(sector[i])]].append({
+                'lat': float(self.node_lat[self.edge_source[edge]]),
+                'lon': float(self.node_lon[self.edge_source[edge]]),
+                'node_id': float(self.node_id[self.edge_source[edge]]),
+                'distance': float(metres_away[i]),
+                'way_type': float(WAY_PRIORITY[int(way_priority[i])])
+            })
+        return sectors
+
+
+def load_road_graph(dbh=None, version=None, extent=None):
+    # Whole network, or only the edges within extent (x, y, x, y as for ST_MakeEnvelope) as a subgraph
+    database_query = ("""
+        SELECT
+        id, source, target,
+        ST_Length(geom_way::geography) as cost,
+        COALESCE(clazz, 0), x1, y1, x2, y2,
+        ST_XMin(geom_way), ST_YMin(geom_way), ST_XMax(geom_way), ST_YMax(geom_way)
+          FROM fi_2po_4pgr
+        """ + ("WHERE geom_way && ST_MakeEnvelope(%s, %s, %s, %s, 4326);" if extent is not None else ";"))
+    query_params = tuple(extent) if extent is not None else None
+    column_chunks = {column: [] for column in EDGE_COLUMNS}
+    with gisdb_connection(dbh) as dbh:
+        cursor = dbh.cursor()
+        cursor.execute(database_query, query_params)
+        rows = cursor.fetchmany(LOAD_BATCH_SIZE)
+        while rows:
+            chunk = np.array(rows, dtype=np.float64)
+            for i, column in enumerate(EDGE_COLUMNS):
+                column_chunks[column].append(chunk[:, i])
+            rows = cursor.fetchmany(LOAD_BATCH_SIZE)
+        cursor.close()
+    return RoadGraph.from_edges({
+        column: np.concatenate(chunks) if chunks else np.zeros(0)
+        for column, chunks in column_chunks.items()
+    }, version)
+
+
+def get_snapshot_name(version):
+    # Versions are "relfilenode:revision" (see app_lib_sql.get_road_network_version), the timestamp keeps
+    # re-exports of one version apart
+    return 'road_graph-{}-{}'.format(re.sub(r'[^0-9A-Za-z_.-]', '-', str(version)), int(time.time() * 1000))
+
+
+def read_current_snapshot(snapshot_dir):
+    """
+    (snapshot name, manifest) the pointer file of snapshot_dir names, or None when nothing has been exported.
+    """
+    try:
+        with open(os.path.join(snapshot_dir, SNAPSHOT_POINTER)) as pointer_file:
+            snapshot_name = pointer_file.read().strip()
+        with open(os.path.join(snapshot_dir, snapshot_name, SNAPSHOT_MANIFEST)) as manifest_file:
+            return snapshot_name, json.load(manifest_file)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def export_road_graph_snapshot(graph, snapshot_dir, keep=DEFAULT_SNAPSHOTS_KEPT):
+    """
+    Write graph's arrays as .npy files of a new snapshot directory under snapshot_dir, then point the pointer file
+    at it. Both steps are atomic renames, workers never map a half written snapshot. Only the newest keep
+    snapshots are kept; workers still mapping a removed one keep their pages until they swap.
+    """
+    snapshot_name = get_snapshot_name(graph.version)
+    snapshot_path = os.path.join(snapshot_dir, snapshot_name)
+    partial_path = os.path.join(snapshot_dir, '.' + snapshot_name)
+    os.makedirs(partial_path)
+    for array_name, array in graph.arrays.items():
+        np.save(os.path.join(partial_path, array_name + '.npy'), np.ascontiguousarray(array))
+    with open(os.path.join(partial_path, SNAPSHOT_MANIFEST), 'w') as manifest_file:
+        json.dump({
+            'version': graph.version,
+            'arrays': sorted(graph.arrays.keys()),
+            'edge_count': len(graph.edge_id),
+            'node_count': len(graph.node_id)
+        }, manifest_file)
+    os.rename(partial_path, snapshot_path)
+
+    partial_pointer_path = os.path.join(snapshot_dir, '.' + SNAPSHOT_POINTER)
+    with open(partial_pointer_path, 'w') as pointer_file:
+        pointer_file.write(snapshot_name)
+    os.replace(partial_pointer_path, os.path.join(snapshot_dir, SNAPSHOT_POINTER))
+
+    snapshot_names = sorted(
+        (name for name in os.listdir(snapshot_dir) if name.startswith('road_graph-')),
+        key=lambda name: os.path.getmtime(os.path.join(snapshot_dir, name))
+    )
+    for old_snapshot_name in snapshot_names[:-keep]:
+        if old_snapshot_name != snapshot_name:
+            shutil.rmtree(os.path.join(snapshot_dir, old_snapshot_name), ignore_errors=True)
+    return snapshot_name
+
+
+def load_road_graph_snapshot(snapshot_dir):
+    """
+    RoadGraph of the current snapshot with its arrays memory-mapped read-only, or None when there is none.
+    Mapping copies nothing: every worker shares the same page cache pages, RSS grows only with the pages touched.
+    """
+    current_snapshot = read_current_snapshot(snapshot_dir)
+    if current_snapshot is None:
+        return None
+    snapshot_name, manifest = current_snapshot
+    return RoadGraph({
+        array_name: np.load(os.path.join(snapshot_dir, snapshot_name, array_name + '.npy'), mmap_mode='r')
+        for array_name in manifest['arrays']
+    }, manifest['version'], snapshot_name)
+
+
+def load_current_road_graph(version):
+    # From the shared snapshot when ROAD_GRAPH_SNAPSHOT_DIR has one of this network version, else from the database
+    snapshot_dir = getattr(settings, 'ROAD_GRAPH_SNAPSHOT_DIR', None)
+    if snapshot_dir:
+        graph = load_road_graph_snapshot(snapshot_dir)
+        if graph is not None and graph.version == version:
+            return graph
+    return load_road_graph(version=version)
+
+
+_road_graph = None
+_road_graph_lock = threading.Lock()
+_snapshot_checked_at = 0.0
+
+
+def is_newer_snapshot_available(graph, version):
+    """
+    Whether the snapshot pointer names another snapshot of version than the one graph is mapped from (e.g. it was
+    re-exported, or graph was loaded from the database before the export). Checked at most every
+    ROAD_GRAPH_SNAPSHOT_CHECK_INTERVAL seconds.
+    """
+    global _snapshot_checked_at
+    snapshot_dir = getattr(settings, 'ROAD_GRAPH_SNAPSHOT_DIR', None)
+    check_interval = getattr(settings, 'ROAD_GRAPH_SNAPSHOT_CHECK_INTERVAL', DEFAULT_SNAPSHOT_CHECK_INTERVAL)
+    if not snapshot_dir or time.time() - _snapshot_checked_at < check_interval:
+        return False
+    _snapshot_checked_at = time.time()
+    current_snapshot = read_current_snapshot(snapshot_dir)
+    return current_snapshot is not None and current_snapshot[0] != graph.snapshot_name \
+        and current_snapshot[1]['version'] == version
+
+
+def get_road_graph():
+    global _road_graph
+    version = get_current_road_network_version()
+    if _road_graph is None:
+        with _road_graph_lock:
+            if _road_graph is None:
+                _road_graph = load_current_road_graph(version)
+    elif (_road_graph.version != version or is_newer_snapshot_available(_road_graph, version)) \
+            and _road_graph_lock.acquire(blocking=False):
+        # Network or snapshot changed: one thread swaps while the others keep routing on the previous graph
+        try:
+            _road_graph = load_current_road_graph(version)
+        finally:
+            _road_graph_lock.release()
+    return _road_graph
@@ -0,0 +1,125 @@
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+import os
+import threading
+import time
+import requests
+
+
+DEFAULT_RIDEWITHGPS_BASE_URL = 'https://ridewithgps.com'
+DEFAULT_RIDEWITHGPS_AUTHTOKEN_TTL = 3600  # seconds
+DEFAULT_RIDEWITHGPS_POOL_SIZE = 10
+DEFAULT_RIDEWITHGPS_TIMEOUT = 30  # seconds
+
+
+def get_base_url():
+    return getattr(settings, 'RIDEWITHGPS_BASE_URL', DEFAULT_RIDEWITHGPS_BASE_URL).rstrip('/')
+
+
+def get_timeout():
+    return getattr(settings, 'RIDEWITHGPS_TIMEOUT', DEFAULT_RIDEWITHGPS_TIMEOUT)
+
+
+def get_login_params():
+    return {
+        'email': settings.RIDEWITHGPS_EMAIL,
+        'password': settings.RIDEWITHGPS_PASSWORD,
+        'apikey': settings.RIDEWITHGPS_APIKEY
+    }
+
+
+def get_api_params(authtoken):
+    return {
+        'apikey': settings.RIDEWITHGPS_APIKEY,
+        'version': settings.RIDEWITHGPS_APIVERSION,
+        'auth_token': authtoken
+    }
+
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """
+    Shared keep-alive session for all RideWithGPS calls, connections are pooled per host.
+    """
+    global _session, _session_pid
+    # (Re)create lazily per process, pooled sockets must not be shared across forked workers
+    if _session is None or _session_pid != os.getpid():
+        with _session_lock:
+            if _session is None or _session_pid != os.getpid():
+                pool_size = getattr(settings, 'RIDEWITHGPS_POOL_SIZE', DEFAULT_RIDEWITHGPS_POOL_SIZE)
+                session = requests.Session()
+                session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+                session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+                _session, _session_pid = session, os.getpid()
+    return _session
+
+
+_authtoken = None
+_authtoken_expires_at = 0.0
+_authtoken_lock = threading.Lock()
+
+
+def get_authtoken():
+    """
+    Auth token of the configured RideWithGPS user, logged in again only after RIDEWITHGPS_AUTHTOKEN_TTL
+    seconds or after invalidate_authtoken().
+    """
+    authtoken = get_cached_authtoken()
+    if authtoken is not None:
+        return authtoken
+    with _authtoken_lock:
+        authtoken = get_cached_authtoken()
+        if authtoken is None:
+            r = get_session().get(get_base_url() + '/users/current.json', params=get_login_params(), timeout=get_timeout())
+            r.raise_for_status()
+            authtoken = _store_authtoken(r.json()['user']['auth_token'])
+        return authtoken
+
+
+def get_cached_authtoken():
+    # Token within its TTL, or None; shared by the sync and async (app_lib_ridewithgps_async) clients
+    if _authtoken is not None and time.time() < _authtoken_expires_at:
+        return _authtoken
+    return None
+
+
+def _store_authtoken(authtoken):
+    global _authtoken, _authtoken_expires_at
+    _authtoken = authtoken
+    _authtoken_expires_at = time.time() + getattr(settings, 'RIDEWITHGPS_AUTHTOKEN_TTL', DEFAULT_RIDEWITHGPS_AUTHTOKEN_TTL)
+    return authtoken
+
+
+def store_authtoken(authtoken):
+    with _authtoken_lock:
+        return _store_authtoken(authtoken)
+
+
+def invalidate_authtoken(authtoken=None):
+    # Only drop the token the caller saw rejected, a concurrent refresh may already have replaced it
+    global _authtoken
+    with _authtoken_lock:
+        if authtoken is None or authtoken == _authtoken:
+            _authtoken = None
+
+
+def ridewithgps_get(path, params=None):
+    """
+    Authenticated GET against the RideWithGPS API (apikey, version and auth_token are added to params).
+    A 401 invalidates the cached token and the request is retried once with a fresh one.
+    """
+    for attempt in range(2):
+        authtoken = get_authtoken()
+        r = get_session().get(
+            get_base_url() + path,
+            params=dict(params or {}, **get_api_params(authtoken)),
+            timeout=get_timeout()
+        )
+        if r.status_code != 401:
+            return r
+        invalidate_authtoken(authtoken)
+    return r
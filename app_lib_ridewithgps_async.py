@@ -0,0 +1,140 @@
+"""
+asyncio counterpart of app_lib_ridewithgps (aiohttp), for the async views in ridewithgps_async.
+
+The auth token cache is shared with the sync client. Sessions are per event loop, an aiohttp session can't be used
+from another loop than the one it was created on, and are closed when their loop shuts down.
+"""
+from django.conf import settings
+from collections import namedtuple
+import asyncio
+import aiohttp
+
+from .app_lib_ridewithgps import get_base_url, get_timeout, get_login_params, get_api_params, \
+    get_cached_authtoken, store_authtoken, invalidate_authtoken, DEFAULT_RIDEWITHGPS_POOL_SIZE
+from .app_lib_ridewithgps_ingest import parse_route_reference, DEFAULT_INGEST_RETRIES, RETRY_BACKOFF_SECONDS
+
+
+# Just what the views use of a requests.Response
+RidewithgpsResponse = namedtuple('RidewithgpsResponse', ('status_code', 'text'))
+
+_sessions = {}  # event loop -> aiohttp.ClientSession
+_session_lifetimes = {}  # event loop -> (_session_lifetime() generator, task running it up to its yield)
+_login_locks = {}  # event loop -> asyncio.Lock
+
+
+async def _session_lifetime(session):
+    # Parked on the session's loop until loop.shutdown_asyncgens() (run by asyncio.run() and async_to_sync before
+    # they close their loops) finalizes it: the session is closed while its loop still runs, no connector leaks
+    try:
+        yield
+    finally:
+        await session.close()
+
+
+def get_async_session():
+    loop = asyncio.get_event_loop()
+    session = _sessions.get(loop)
+    if session is None or session.closed:
+        # Forget sessions of loops that have been closed meanwhile (e.g. per-request loops of async_to_sync),
+        # closed along with their loop
+        for closed_loop in [other for other in _sessions if other.is_closed()]:
+            _sessions.pop(closed_loop)
+            _session_lifetimes.pop(closed_loop, None)
+            _login_locks.pop(closed_loop, None)
+        session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=getattr(settings, 'RIDEWITHGPS_POOL_SIZE', DEFAULT_RIDEWITHGPS_POOL_SIZE)
+            ),
+            timeout=aiohttp.ClientTimeout(total=get_timeout())
+        )
+        lifetime = _session_lifetime(session)
+        _session_lifetimes[loop] = (lifetime, asyncio.ensure_future(lifetime.__anext__()))
+        _sessions[loop] = session
+        _login_locks[loop] = asyncio.Lock()
+    return session
+
+
+async def close_async_session():
+    # For server shutdown hooks and tests, the session of the running loop is recreated on next use
+    loop = asyncio.get_event_loop()
+    session = _sessions.pop(loop, None)
+    lifetime = _session_lifetimes.pop(loop, None)
+    if lifetime is not None:
+        generator, task = lifetime
+        task.cancel()
+        await generator.aclose()
+    if session is not None:
+        await session.close()
+
+
+async def get_authtoken_async():
+    """
+    As app_lib_ridewithgps.get_authtoken(), concurrent callers on one loop wait for a single login.
+    """
+    authtoken = get_cached_authtoken()
+    if authtoken is not None:
+        return authtoken
+    session = get_async_session()
+    async with _login_locks[asyncio.get_event_loop()]:
+        authtoken = get_cached_authtoken()
+        if authtoken is None:
+            async with session.get(get_base_url() + '/users/current.json', params=get_login_params()) as r:
+                r.raise_for_status()
+                response_obj = await r.json(content_type=None)
+            authtoken = store_authtoken(response_obj['user']['auth_token'])
+    return authtoken
+
+
+async def ridewithgps_get_async(path, params=None):
+    """
+    As app_lib_ridewithgps.ridewithgps_get(), returns a RidewithgpsResponse.
+    """
+    for attempt in range(2):
+        authtoken = await get_authtoken_async()
+        async with get_async_session().get(
+            get_base_url() + path,
+            params=dict(params or {}, **get_api_params(authtoken))
+        ) as r:
+            response = RidewithgpsResponse(r.status, await r.text())
+        if response.status_code != 401:
+            return response
+        invalidate_authtoken(authtoken)
+    return response
+
+
+async def fetch_route_text_async(objtype, identifier, retries=DEFAULT_INGEST_RETRIES):
+    """
+    Routes/trips JSON text, retrying connection errors and 5xx/429 responses with exponential backoff
+    like app_lib_ridewithgps_ingest.fetch_route_payload(). Other non-2xx responses raise ValueError.
+    """
+    endpoint = "trips" if objtype == "trip" else "routes"
+    for attempt in range(retries + 1):
+        try:
+            r = await ridewithgps_get_async('/%s/%s.json' % (endpoint, identifier))
+            if r.status_code < 500 and r.status_code != 429:
+                if r.status_code >= 400:
+                    raise ValueError('RideWithGPS responded {} for {}:{}'.format(r.status_code, objtype, identifier))
+                return r.text
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            if attempt == retries:
+                raise
+        if attempt < retries:
+            await asyncio.sleep(RETRY_BACKOFF_SECONDS * (2 ** attempt))
+    raise ValueError('RideWithGPS responded {} for {}:{}'.format(r.status_code, objtype, identifier))
+
+
+async def fetch_route_texts_async(references, concurrency=None, retries=DEFAULT_INGEST_RETRIES):
+    """
+    Fetch many routes/trips ("route:123", "trip:456", ...) concurrently, at most concurrency (default
+    RIDEWITHGPS_POOL_SIZE) in flight. Returns {reference: JSON text or the exception it failed with}.
+    """
+    if concurrency is None:
+        concurrency = getattr(settings, 'RIDEWITHGPS_POOL_SIZE', DEFAULT_RIDEWITHGPS_POOL_SIZE)
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+
+    async def fetch(reference):
+        async with semaphore:
+            return await fetch_route_text_async(*parse_route_reference(reference), retries=retries)
+
+    results = await asyncio.gather(*[fetch(reference) for reference in references], return_exceptions=True)
+    return dict(zip(references, results))
@@ -0,0 +1,179 @@
+from django.core.exceptions import ObjectDoesNotExist
+from concurrent.futures import ThreadPoolExecutor
+import json
+import time
+import requests
+
+from .models import Route, ThirdPartyProvider
+from .app_lib_ridewithgps import ridewithgps_get
+
+
+DEFAULT_INGEST_WORKERS = 8
+DEFAULT_INGEST_RETRIES = 3
+DEFAULT_INGEST_BATCH_SIZE = 200
+RETRY_BACKOFF_SECONDS = 0.5  # doubled on every retry
+
+
+def get_ridewithgps_provider():
+    # Ensure existence of the ThirdPartyProvider
+    try:
+        return ThirdPartyProvider.objects.get(name='RIDEWITHGPS')
+    except ObjectDoesNotExist:
+        third_party_provider = ThirdPartyProvider(name='RIDEWITHGPS')
+        third_party_provider.save()
+        return third_party_provider
+
+
+def parse_route_reference(reference):
+    # "route:123", "trip:456" or a bare route id
+    objtype, _, identifier = str(reference).rpartition(':')
+    return (objtype or 'route'), identifier
+
+
+def format_external_id(typekey, identifier):
+    # Route.external_id of RideWithGPS routes and trips, typekey is either "route" or "trip"
+    return "%s:%s" % (typekey, identifier)
+
+
+def get_external_id(response_obj):
+    typekey = response_obj['type']  # Either "route" or "trip"
+    return format_external_id(typekey, response_obj[typekey]['id'])
+
+
+def build_route(response_obj, third_party_provider):
+    """
+    Unsaved Route from a RideWithGPS routes/trips JSON payload. Raises ValueError for invalid routes.
+    """
+    typekey = response_obj['type']
+    bounding_box_ne = max(response_obj[typekey]['bounding_box'], key=lambda x: x['lat'])
+    bounding_box_sw = min(response_obj[typekey]['bounding_box'], key=lambda x: x['lat'])
+    the_route = Route(
+        external_system=third_party_provider,
+        external_id=get_external_id(response_obj),
+        is_public=True,
+        bounding_box_larger_edge_lat=bounding_box_ne['lat'],
+        bounding_box_larger_edge_lng=bounding_box_ne['lng'],
+        bounding_box_lesser_edge_lat=bounding_box_sw['lat'],
+        bounding_box_lesser_edge_lng=bounding_box_sw['lng'],
+        distance=response_obj[typekey]['distance'],
+        accumulated_elevation_gain=response_obj[typekey]['elevation_gain'],
+        accumulated_elevation_loss=response_obj[typekey]['elevation_loss'],
+        first_lat=response_obj[typekey]['first_lat'],
+        first_lng=response_obj[typekey]['first_lng'],
+        last_lat=response_obj[typekey]['last_lat'],
+        last_lng=response_obj[typekey]['last_lng']
+    )
+    the_route.set_track_points(response_obj[typekey]['track_points'])  # Saved packed BinaryField
+    return the_route
+
+
+def fetch_route_payload(objtype, identifier, retries=DEFAULT_INGEST_RETRIES):
+    # Retries connection errors and 5xx/429 responses with exponential backoff
+    endpoint = "trips" if objtype == "trip" else "routes"
+    for attempt in range(retries + 1):
+        try:
+            r = ridewithgps_get('/%s/%s.json' % (endpoint, identifier))
+            if r.status_code < 500 and r.status_code != 429:
+                r.raise_for_status()
+                return json.loads(r.text)
+        except (requests.ConnectionError, requests.Timeout):
+            if attempt == retries:
+                raise
+        if attempt < retries:
+            time.sleep(RETRY_BACKOFF_SECONDS * (2 ** attempt))
+    r.raise_for_status()
+
+
+def search_route_references(search_params, max_results=None):
+    """
+    Route/trip references ("route:123") found by a RideWithGPS search, search_params as for /find/search.json
+    without the "search[...]" wrapping, e.g. {'start_location': 'Helsinki', 'limit': 100}.
+    """
+    r = ridewithgps_get('/find/search.json', {
+        "search[%s]" % name: value
+        for name, value in search_params.items()
+    })
+    response_obj = json.loads(r.text)
+    references = [
+        "%s:%s" % (result['type'], result[result['type']]['id'])
+        for result in response_obj['results']
+        if result['type'] == "route" or result['type'] == "trip"
+    ]
+    return references[:max_results] if max_results else references
+
+
+def ingest_routes(references,
+                  workers=DEFAULT_INGEST_WORKERS,
+                  retries=DEFAULT_INGEST_RETRIES,
+                  batch_size=DEFAULT_INGEST_BATCH_SIZE):
+    """
+    Fetch and store many RideWithGPS routes/trips ("route:123", "trip:456", ...).
+    Already stored ones are not fetched again; the rest are fetched by a bounded thread pool and written with
+    bulk_create, where conflicts on (external_system, external_id) from concurrent writers are skipped.
+    Returns counters including throughput.
+    """
+    started = time.time()
+    third_party_provider = get_ridewithgps_provider()
+    wanted = {}
+    for reference in references:
+        objtype, identifier = parse_route_reference(reference)
+        wanted[format_external_id(objtype, identifier)] = (objtype, identifier)
+    existing = set(
+        Route.objects
+        .filter(external_system=third_party_provider, external_id__in=list(wanted.keys()))
+        .values_list('external_id', flat=True)
+    )
+    to_fetch = [ref for external_id, ref in wanted.items() if external_id not in existing]
+
+    stats = {
+        'requested': len(wanted),
+        'already_stored': len(existing),
+        'fetched': 0,
+        'written': 0,
+        'conflicts': 0,  # Stored by a concurrent writer between the lookup above and bulk_create
+        'invalid': 0,
+        'failed': 0
+    }
+
+    def fetch(ref):
+        try:
+            return fetch_route_payload(ref[0], ref[1], retries)
+        except (requests.RequestException, ValueError):
+            return None
+
+    pending_routes = []
+
+    def flush():
+        # ignore_conflicts gives no count of what was inserted, so the batch's rows are counted before and after
+        batch_rows = Route.objects.filter(
+            external_system=third_party_provider,
+            external_id__in=[the_route.external_id for the_route in pending_routes]
+        )
+        stored_before = batch_rows.count()
+        Route.objects.bulk_create(pending_routes, batch_size=batch_size, ignore_conflicts=True)
+        written = batch_rows.count() - stored_before
+        stats['written'] += written
+        stats['conflicts'] += len(pending_routes) - written
+        del pending_routes[:]
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        for response_obj in executor.map(fetch, to_fetch):
+            if response_obj is None:
+                stats['failed'] += 1
+                continue
+            stats['fetched'] += 1
+            try:
+                the_route = build_route(response_obj, third_party_provider)
+                the_route.normalize_fields()
+            except (ValueError, KeyError, TypeError):
+                stats['invalid'] += 1
+                continue
+            pending_routes.append(the_route)
+            if len(pending_routes) >= batch_size:
+                flush()
+        if pending_routes:
+            flush()
+
+    stats['seconds'] = time.time() - started
+    stats['routes_per_second'] = stats['fetched'] / stats['seconds'] if stats['seconds'] > 0 else 0.0
+    return stats
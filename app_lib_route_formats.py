@@ -0,0 +1,132 @@
+"""
+Compact output formats for route geometry, as an alternative to GeoJSON / track point dicts.
+
+"geojson": round trips as GeoJSON of their merged edges (the round trip views' default).
+"json": stored routes as Route.to_dict() with their track points (the route views' default).
+"polyline": Google encoded polyline algorithm (lat, lon pairs), with precision decimal digits (5 is the usual one).
+"binary": header (magic, format version, precision, point count, length in metres) followed by little-endian int32
+lat, lon pairs at 10^precision fixed point, the first pair absolute and the rest as deltas to the previous pair.
+"""
+from django.conf import settings
+import re
+import struct
+import numpy as np
+
+
+ROUTE_FORMAT_GEOJSON = 'geojson'
+ROUTE_FORMAT_JSON = 'json'
+ROUTE_FORMAT_POLYLINE = 'polyline'
+ROUTE_FORMAT_BINARY = 'binary'
+# Formats of each kind of view, the first one is the default
+ROUND_TRIP_FORMATS = (ROUTE_FORMAT_GEOJSON, ROUTE_FORMAT_POLYLINE, ROUTE_FORMAT_BINARY)
+STORED_ROUTE_FORMATS = (ROUTE_FORMAT_JSON, ROUTE_FORMAT_POLYLINE, ROUTE_FORMAT_BINARY)
+DEFAULT_ROUTE_FORMAT_PRECISION = 5  # ~1m
+MAX_ROUTE_FORMAT_PRECISION = 7
+
+BINARY_MAGIC = b'RTBN'
+BINARY_FORMAT_VERSION = 1
+BINARY_HEADER = struct.Struct('<4sBBId')
+BINARY_CONTENT_TYPE = 'application/octet-stream'
+
+INT32_MIN, INT32_MAX = -2 ** 31, 2 ** 31 - 1
+
+
+def quantize_deltas(lats, lons, precision):
+    # Fixed-point lat, lon pairs as an (n, 2) int64 array, first row absolute and the rest deltas
+    fixed = np.round(np.column_stack((
+        np.asarray(lats, dtype=np.float64),
+        np.asarray(lons, dtype=np.float64)
+    )) * (10 ** precision)).astype(np.int64)
+    return np.diff(fixed, axis=0, prepend=np.zeros((1, 2), dtype=np.int64))
+
+
+def encode_polyline(lats, lons, precision=DEFAULT_ROUTE_FORMAT_PRECISION):
+    deltas = quantize_deltas(lats, lons, precision).ravel()
+    # Zigzag to unsigned, then 5 bit chunks (least significant first), 0x20 marking "more chunks follow"
+    values = np.where(deltas < 0, ~(deltas << 1), deltas << 1).tolist()
+    chars = []
+    for value in values:
+        while value >= 0x20:
+            chars.append(chr((0x20 | (value & 0x1f)) + 63))
+            value >>= 5
+        chars.append(chr(value + 63))
+    return ''.join(chars)
+
+
+def decode_polyline(polyline, precision=DEFAULT_ROUTE_FORMAT_PRECISION):
+    values, value, shift = [], 0, 0
+    for char in polyline:
+        chunk = ord(char) - 63
+        value |= (chunk & 0x1f) << shift
+        shift += 5
+        if chunk < 0x20:
+            values.append(~(value >> 1) if value & 1 else value >> 1)
+            value, shift = 0, 0
+    fixed = np.cumsum(np.asarray(values, dtype=np.int64).reshape(-1, 2), axis=0)
+    return fixed[:, 0] / (10 ** precision), fixed[:, 1] / (10 ** precision)
+
+
+def encode_binary_points(lats, lons, precision=DEFAULT_ROUTE_FORMAT_PRECISION, length_m=0.0):
+    deltas = quantize_deltas(lats, lons, precision)
+    if len(deltas) and (deltas.min() < INT32_MIN or deltas.max() > INT32_MAX):
+        raise ValueError('Coordinates out of range for precision {}'.format(precision))
+    header = BINARY_HEADER.pack(BINARY_MAGIC, BINARY_FORMAT_VERSION, precision, len(deltas), float(length_m or 0))
+    return header + deltas.astype('<i4').tobytes()
+
+
+def decode_binary_points(packed):
+    """
+    Returns (lats, lons, length_m).
+    """
+    magic, version, precision, count, length_m = BINARY_HEADER.unpack_from(packed, 0)
+    if magic != BINARY_MAGIC or version != BINARY_FORMAT_VERSION:
+        raise ValueError('Not a binary route (version {})'.format(BINARY_FORMAT_VERSION))
+    deltas = np.frombuffer(packed, dtype='<i4', count=count * 2, offset=BINARY_HEADER.size).reshape(-1, 2)
+    fixed = np.cumsum(deltas, axis=0, dtype=np.int64)
+    return fixed[:, 0] / (10 ** precision), fixed[:, 1] / (10 ** precision), length_m
+
+
+def stitch_path_points(edge_ids, edge_points):
+    """
+    Ordered [(lat, lon), ...] along a path given as edge ids in travel order, edge_points mapping edge id to its
+    vertices. Each edge is flipped when its far end is the one touching the previous edge, shared vertices are
+    kept once.
+    """
+    points = []
+    for i, edge_id in enumerate(edge_ids):
+        vertices = list(edge_points[edge_id])
+        if points:
+            # Continue from where the previous edge ended
+            if vertices[0] != points[-1] and vertices[-1] == points[-1]:
+                vertices.reverse()
+        elif i + 1 < len(edge_ids):
+            # First edge: its far end is the one touching the next edge
+            next_vertices = edge_points[edge_ids[i + 1]]
+            next_ends = (next_vertices[0], next_vertices[-1])
+            if vertices[-1] not in next_ends and vertices[0] in next_ends:
+                vertices.reverse()
+        points.extend(vertices[1:] if points and vertices[0] == points[-1] else vertices)
+    return points
+
+
+def stitch_round_trip_points(path_edge_ids, alt_path_edge_ids, edge_points):
+    # Out along the first path, back along the alternative one (both go start -> round trip point)
+    points = stitch_path_points(path_edge_ids, edge_points)
+    return_points = stitch_path_points(alt_path_edge_ids, edge_points)[::-1]
+    return points + (return_points[1:] if points and return_points and return_points[0] == points[-1] else return_points)
+
+
+def parse_route_format_params(query_dict, formats):
+    """
+    ("format", "precision") GET params as (output_format, precision), "format" one of formats (default the first).
+    Invalid params raise ValueError with the message for the client.
+    """
+    output_format = query_dict.get('format', formats[0])
+    precision = query_dict.get('precision', None)
+    if output_format not in formats:
+        raise ValueError('Invalid GET param "format", one of: {}'.format(', '.join(formats)))
+    if precision is None:
+        return output_format, getattr(settings, 'ROUTE_FORMAT_PRECISION', DEFAULT_ROUTE_FORMAT_PRECISION)
+    if not re.compile(r'^\d$').match(precision) or int(precision) > MAX_ROUTE_FORMAT_PRECISION:
+        raise ValueError('Invalid GET param "precision" (decimals) 0-{}'.format(MAX_ROUTE_FORMAT_PRECISION))
+    return output_format, int(precision)
@@ -0,0 +1,138 @@
+from django.conf import settings
+from .app_lib_db import gisdb_connection
+from .app_lib_sql import get_current_road_network_version
+import math
+import threading
+import numpy as np
+
+
+DEFAULT_NODE_INDEX_CELL_SIZE_DEG = 0.01  # ~1.1km north-south, cells are widened east-west by 1/cos(lat)
+
+
+class NearestNodeIndex:
+    """
+    Uniform grid over node coordinates for nearest-node lookups.
+    Distances are equirectangular (longitude scaled by cos(lat) of the query point), which is exact enough
+    for snapping within a few kilometres.
+    """
+
+    def __init__(self, node_ids, lats, lons, cell_size_deg=DEFAULT_NODE_INDEX_CELL_SIZE_DEG, version=None):
+        self.version = version
+        self.node_ids = np.asarray(node_ids, dtype=np.int64)
+        self.lats = np.asarray(lats, dtype=np.float64)
+        self.lons = np.asarray(lons, dtype=np.float64)
+        self.cell_height = cell_size_deg
+        mean_lat = float(self.lats.mean()) if len(self.lats) else 0.0
+        self.cell_width = cell_size_deg / max(math.cos(math.radians(mean_lat)), 0.01)
+
+        # Sort nodes by grid cell, each cell maps to a contiguous slice of the arrays
+        cell_rows = np.floor(self.lats / self.cell_height).astype(np.int64)
+        cell_cols = np.floor(self.lons / self.cell_width).astype(np.int64)
+        order = np.lexsort((cell_cols, cell_rows))
+        self.node_ids, self.lats, self.lons = self.node_ids[order], self.lats[order], self.lons[order]
+        cell_rows, cell_cols = cell_rows[order], cell_cols[order]
+        boundaries = np.flatnonzero((np.diff(cell_rows) != 0) | (np.diff(cell_cols) != 0)) + 1
+        starts = np.concatenate(([0], boundaries)).tolist()
+        ends = np.concatenate((boundaries, [len(order)])).tolist()
+        self.cells = {
+            (int(cell_rows[start]), int(cell_cols[start])): (start, end)
+            for start, end in zip(starts, ends)
+            if start < end
+        }
+        self.row_range = (int(cell_rows.min()), int(cell_rows.max())) if len(order) else (0, 0)
+        self.col_range = (int(cell_cols.min()), int(cell_cols.max())) if len(order) else (0, 0)
+
+    def nearest(self, lat, lon):
+        """
+        Returns (lat, lon, node_id) of the node nearest to the point, or None when the index is empty.
+        """
+        if not self.cells:
+            return None
+        row, col = int(math.floor(lat / self.cell_height)), int(math.floor(lon / self.cell_width))
+        lon_scale = math.cos(math.radians(lat))
+        best_index, best_distance = None, float('inf')
+        min_row, max_row = self.row_range
+        min_col, max_col = self.col_range
+        max_ring = max(abs(row - min_row), abs(row - max_row), abs(col - min_col), abs(col - max_col))
+        # Rings are clamped to the grid's rows and columns, and the ones short of reaching the grid are skipped
+        # (a query far outside the network mustn't walk thousands of empty rings)
+        ring = max(0, min_row - row, row - max_row, min_col - col, col - max_col)
+        # Distance from the query point to the grid's extent, per axis
+        grid_lat_gap = max(0.0, min_row * self.cell_height - lat, lat - (max_row + 1) * self.cell_height)
+        grid_lon_gap = max(0.0, min_col * self.cell_width - lon, lon - (max_col + 1) * self.cell_width) * lon_scale
+        while ring <= max_ring:
+            # Visit the cells on the square ring at Chebyshev distance "ring" around the query cell
+            for ring_row in range(max(row - ring, min_row), min(row + ring, max_row) + 1):
+                if abs(ring_row - row) == ring:
+                    ring_cols = range(max(col - ring, min_col), min(col + ring, max_col) + 1)
+                else:
+                    ring_cols = [ring_col for ring_col in (col - ring, col + ring) if min_col <= ring_col <= max_col]
+                for ring_col in ring_cols:
+                    cell = self.cells.get((ring_row, ring_col))
+                    if cell is None:
+                        continue
+                    start, end = cell
+                    distances = np.hypot(self.lats[start:end] - lat, (self.lons[start:end] - lon) * lon_scale)
+                    i = int(distances.argmin())
+                    if distances[i] < best_distance:
+                        best_index, best_distance = start + i, float(distances[i])
+            # Unvisited cells lie within the grid and beyond this ring, in rows or in columns not yet covered
+            if best_index is not None:
+                lower_bounds = []
+                if row - ring > min_row or row + ring < max_row:
+                    lower_bounds.append(math.hypot(max(ring * self.cell_height, grid_lat_gap), grid_lon_gap))
+                if col - ring > min_col or col + ring < max_col:
+                    lower_bounds.append(math.hypot(grid_lat_gap, max(ring * self.cell_width * lon_scale, grid_lon_gap)))
+                if best_distance <= min(lower_bounds or [float('inf')]):
+                    break
+            ring += 1
+        return float(self.lats[best_index]), float(self.lons[best_index]), int(self.node_ids[best_index])
+
+    def nearest_many(self, lats, lons):
+        return [self.nearest(lat, lon) for lat, lon in zip(lats, lons)]
+
+
+def load_nearest_node_index(dbh=None, version=None):
+    database_query = ("""
+        SELECT DISTINCT ON (source) source, y1, x1
+          FROM fi_2po_4pgr
+          WHERE y1 IS NOT NULL AND x1 IS NOT NULL;
+        """)
+    with gisdb_connection(dbh) as dbh:
+        cursor = dbh.cursor()
+        cursor.execute(database_query)
+        nodes = np.array(cursor.fetchall(), dtype=np.float64).reshape(-1, 3)
+        cursor.close()
+    return NearestNodeIndex(
+        nodes[:, 0], nodes[:, 1], nodes[:, 2],
+        getattr(settings, 'NODE_INDEX_CELL_SIZE_DEG', DEFAULT_NODE_INDEX_CELL_SIZE_DEG),
+        version
+    )
+
+
+_node_index = None
+_node_index_lock = threading.Lock()
+
+
+def get_nearest_node_index():
+    global _node_index
+    version = get_current_road_network_version()
+    if _node_index is None:
+        with _node_index_lock:
+            if _node_index is None:
+                _node_index = load_nearest_node_index(version=version)
+    elif _node_index.version != version and _node_index_lock.acquire(blocking=False):
+        # Network changed: one thread rebuilds while the others keep snapping on the previous index
+        try:
+            _node_index = load_nearest_node_index(version=version)
+        finally:
+            _node_index_lock.release()
+    return _node_index
+
+
+def get_nearest_node_lat_lon_id(lat, lon):
+    return get_nearest_node_index().nearest(lat, lon)
+
+
+def get_nearest_nodes_lat_lon_id(lats, lons):
+    return get_nearest_node_index().nearest_many(lats, lons)
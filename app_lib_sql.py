@@ -1,9 +1,37 @@
 from django.conf import settings
 from .app_lib import calculate_wgs84_lat_lon_by_offset
-import psycopg2
+from .app_lib_db import gisdb_connection
+import math
+import threading
+import time
 
 
-def get_nearest_point_lat_lon_id(lat, lon):
+DEFAULT_ROAD_NETWORK_VERSION_CHECK_INTERVAL = 60  # seconds
+DEFAULT_KSP_EDGE_TILE_SIZE_DEG = 0.05  # ~5.5km north-south, ~2.8km east-west at 60N
+MISC_OTHER_WAY_TYPE = 69
+WAY_PRIORITY = [31, 81, MISC_OTHER_WAY_TYPE]  # 31 -> tertiary, 81 -> cycleway ; ref: osm2po.config
+
+# 32-wind compass points, every 11.25 degrees clockwise from north; sectors are named after their middle bearing
+COMPASS_POINTS = [
+    'N', 'NbE', 'NNE', 'NEbN', 'NE', 'NEbE', 'ENE', 'EbN',
+    'E', 'EbS', 'ESE', 'SEbE', 'SE', 'SEbS', 'SSE', 'SbE',
+    'S', 'SbW', 'SSW', 'SWbS', 'SW', 'SWbW', 'WSW', 'WbS',
+    'W', 'WbN', 'WNW', 'NWbW', 'NW', 'NWbN', 'NNW', 'NbW'
+]
+SUPPORTED_SECTOR_COUNTS = (4, 8, 16)
+
+
+def get_sector_names(sector_count):
+    # Sector i covers bearings [i*360/n, (i+1)*360/n), e.g. 4 -> NE, SE, SW, NW
+    if sector_count not in SUPPORTED_SECTOR_COUNTS:
+        raise ValueError('Sector count must be one of {}'.format(SUPPORTED_SECTOR_COUNTS))
+    return [
+        COMPASS_POINTS[int(round((i + 0.5) * 32 / sector_count))]
+        for i in range(sector_count)
+    ]
+
+
+def get_nearest_point_lat_lon_id(lat, lon, dbh=None):
 
     database_query = ("""
         SELECT y1, x1, source
@@ -17,23 +45,12 @@ def get_nearest_point_lat_lon_id(lat, lon):
         """)
     query_params = (lon, lat)
 
-    # Create db connection
-    data_source_name = "host={} dbname={} user={} password={}".format(
-        settings.GISDB_HOST,
-        settings.GISDB_NAME,
-        settings.GISDB_USER,
-        settings.GISDB_PASSWORD
-    )
-    dbh = psycopg2.connect(data_source_name)
-
-    # Execute query
-    cursor = dbh.cursor()
-    cursor.execute(database_query, query_params)
-    result_tuple = cursor.fetchone()
-
-    # Close db connection
-    cursor.close()
-    dbh.close()
+    # Execute query (on a pooled connection, unless the caller already holds one)
+    with gisdb_connection(dbh) as dbh:
+        cursor = dbh.cursor()
+        cursor.execute(database_query, query_params)
+        result_tuple = cursor.fetchone()
+        cursor.close()
 
     # Process result
     if not result_tuple or not (result_tuple[0] and result_tuple[1]):
@@ -43,11 +60,50 @@ def get_nearest_point_lat_lon_id(lat, lon):
         return way_source_lat, way_source_lon, way_source_id
 
 
+def get_nearest_points_lat_lon_id(lat_lons, dbh=None):
+    """
+    get_nearest_point_lat_lon_id() for many (lat, lon) points in one query, results (or None) in input order.
+    """
+    if not lat_lons:
+        return []
+
+    database_query = ("""
+        SELECT q.i, n.y1, n.x1, n.source
+          FROM unnest(%s::double precision[], %s::double precision[]) WITH ORDINALITY AS q(lat, lon, i)
+          CROSS JOIN LATERAL (
+            SELECT y1, x1, source
+              FROM fi_2po_4pgr
+              ORDER BY
+                ST_Distance(
+                  geom_way,
+                  ST_SetSRID(ST_MakePoint(q.lon, q.lat), 4326) -- SRID: WGS84
+                )
+              LIMIT 1
+          ) AS n;
+        """)
+    query_params = ([float(lat) for lat, _ in lat_lons], [float(lon) for _, lon in lat_lons])
+
+    # Execute query
+    with gisdb_connection(dbh) as dbh:
+        cursor = dbh.cursor()
+        cursor.execute(database_query, query_params)
+        result_tuples = cursor.fetchall()
+        cursor.close()
+
+    # Process result (ordinality is 1-based)
+    nearest_points = [None] * len(lat_lons)
+    for i, lat, lon, source in result_tuples:
+        if lat and lon:
+            nearest_points[int(i) - 1] = (float(lat), float(lon), float(source))
+    return nearest_points
+
+
 def get_points_lat_lon_id_distance_per_sector_within_range(center_lat,
                                                            center_lon,
                                                            optimal_range_km,
                                                            lowest_permitted_range_km,
-                                                           highest_permitted_range_km):
+                                                           highest_permitted_range_km,
+                                                           dbh=None):
 
     # Calculate bbox
     extent_m, n_extent_m = highest_permitted_range_km*1000*2, (-1)*highest_permitted_range_km*1000*2
@@ -94,92 +150,539 @@ def get_points_lat_lon_id_distance_per_sector_within_range(center_lat,
         int(optimal_range_km * 1000)
     )
 
-    # Create db connection
-    data_source_name = "host={} dbname={} user={} password={}".format(
-        settings.GISDB_HOST,
-        settings.GISDB_NAME,
-        settings.GISDB_USER,
-        settings.GISDB_PASSWORD
+    # Execute query (on a pooled connection, unless the caller already holds one)
+    with gisdb_connection(dbh) as dbh:
+        cursor = dbh.cursor()
+        cursor.execute(database_query, query_params)
+        sectors = {
+            "NE": None,
+            "SE": None,
+            "SW": None,
+            "NW": None
+        }
+        way_priority = WAY_PRIORITY
+        result_tuple = cursor.fetchone()
+        while result_tuple:
+            # End condition (all sectors filled with nearest match && optimal type), early return
+            if (
+                        (sectors['NE'] and sectors['NE']['way_type'] == way_priority[0])
+                    and (sectors['SE'] and sectors['SE']['way_type'] == way_priority[0])
+                    and (sectors['SW'] and sectors['SW']['way_type'] == way_priority[0])
+                    and (sectors['NW'] and sectors['NW']['way_type'] == way_priority[0])):
+                break
+
+            # Unpack the (single) result
+            lat, lon, way_source, distance, way_type = map(lambda v: float(v), result_tuple)
+            if way_type not in way_priority or not way_type:
+                way_type = MISC_OTHER_WAY_TYPE
+
+            # Find what sector the result belongs to, and if empty then add it
+            if lon > center_lon:
+                # Then it's to east
+                if lat > center_lat:
+                    # then it's to north-east
+                    if not sectors['NE'] or way_priority.index(way_type) < way_priority.index(sectors['NE']['way_type']):
+                        sectors['NE'] = {
+                            'lat': lat,
+                            'lon': lon,
+                            'node_id': way_source,
+                            'distance': distance,
+                            'way_type': way_type
+                        }
+                else:
+                    # it's to south-east
+                    if not sectors['SE'] or way_priority.index(way_type) < way_priority.index(sectors['SE']['way_type']):
+                        sectors['SE'] = {
+                            'lat': lat,
+                            'lon': lon,
+                            'node_id': way_source,
+                            'distance': distance,
+                            'way_type': way_type
+                        }
+            else:
+                # it's to west
+                if lat > center_lat:
+                    # then it's to north-west
+                    if not sectors['NW'] or way_priority.index(way_type) < way_priority.index(sectors['NW']['way_type']):
+                        sectors['NW'] = {
+                            'lat': lat,
+                            'lon': lon,
+                            'node_id': way_source,
+                            'distance': distance,
+                            'way_type': way_type
+                        }
+                else:
+                    # it's to south-west
+                    if not sectors['SW'] or way_priority.index(way_type) < way_priority.index(sectors['SW']['way_type']):
+                        sectors['SW'] = {
+                            'lat': lat,
+                            'lon': lon,
+                            'node_id': way_source,
+                            'distance': distance,
+                            'way_type': way_type
+                        }
+
+            # Continue iterating results (end condition in beginning of loop)
+            result_tuple = cursor.fetchone()
+        cursor.close()
+
+    return sectors
+
+
+def get_k_shortest_paths_edge_ids(start_node_id, end_node_id, k, extent, excluded_edge_ids=(), dbh=None):
+
+    # Edges of the disposed paths are left out of the graph given to PGR_KSP (ids are ints, safe to inline)
+    excluded_edges_condition = ""
+    if len(excluded_edge_ids):
+        excluded_edges_condition = "AND id NOT IN (" + ','.join(str(int(e)) for e in excluded_edge_ids) + ")"
+
+    # Precomputed costs from the covering tiles when "manage.py refresh_ksp_edge_tiles" is up to date,
+    # otherwise every edge in the bbox and its geodesic length straight from fi_2po_4pgr
+    with gisdb_connection(dbh) as dbh:
+        edge_tiles_meta = get_current_ksp_edge_tiles_meta(dbh)
+    xmin, xmax = min(extent[0], extent[2]), max(extent[0], extent[2])
+    ymin, ymax = min(extent[1], extent[3]), max(extent[1], extent[3])
+    if edge_tiles_meta is not None:
+        edges_query = """SELECT 
+               t.id as id, 
+               t.source as source, 
+               t.target as target, 
+               t.cost as cost
+                   FROM ksp_edge_tiles as t
+                   WHERE t.tile_x BETWEEN %s AND %s AND t.tile_y BETWEEN %s AND %s -- covering tiles
+                   AND t.xmin <= %s AND t.xmax >= %s AND t.ymin <= %s AND t.ymax >= %s -- within bbox"""
+        edges_query_params = get_covering_tile_range(edge_tiles_meta, xmin, ymin, xmax, ymax) + (
+            xmax, xmin, ymax, ymin
+        )
+    else:
+        edges_query = """SELECT 
+               s.id as id, 
+               s.source as source, 
+               s.target as target, 
+               ST_Length(s.geom_way::geography) as cost
+                   FROM fi_2po_4pgr as s
+                   WHERE s.geom_way && ST_MakeEnvelope(%s, %s, %s, %s, 4326) -- within bbox"""
+        edges_query_params = (xmin, ymin, xmax, ymax)
+
+    database_query = ("""
+        SELECT 
+        id1 as route, 
+        id3 as edge
+          FROM PGR_KSP(
+              '""" + edges_query + """
+                      """ + excluded_edges_condition + """
+               ',
+              %s, -- start location ("way -> source (-> id)")
+              %s, -- end location ("round trip" -spot)
+              %s,
+              false
+          )
+          WHERE id3 <> -1 -- K-S-P marks the end node of each path with edge -1
+          ORDER BY seq ASC;
+        """)
+    query_params = edges_query_params + (
+        int(start_node_id),
+        int(end_node_id),
+        int(k)
     )
-    dbh = psycopg2.connect(data_source_name)
 
     # Execute query
-    cursor = dbh.cursor()
-    cursor.execute(database_query, query_params)
-    sectors = {
-        "NE": None,
-        "SE": None,
-        "SW": None,
-        "NW": None
-    }
-    MISC_OTHER_WAY_TYPE = 69
-    way_priority = [31, 81, MISC_OTHER_WAY_TYPE]  # 31 -> tertiary, 81 -> cycleway ; ref: osm2po.config
-    result_tuple = cursor.fetchone()
-    while result_tuple:
-        # End condition (all sectors filled with nearest match && optimal type), early return
-        if (
-                    (sectors['NE'] and sectors['NE']['way_type'] == way_priority[0])
-                and (sectors['SE'] and sectors['SE']['way_type'] == way_priority[0])
-                and (sectors['SW'] and sectors['SW']['way_type'] == way_priority[0])
-                and (sectors['NW'] and sectors['NW']['way_type'] == way_priority[0])):
-            break
-
-        # Unpack the (single) result
-        lat, lon, way_source, distance, way_type = map(lambda v: float(v), result_tuple)
-        if way_type not in way_priority or not way_type:
-            way_type = MISC_OTHER_WAY_TYPE
-
-        # Find what sector the result belongs to, and if empty then add it
-        if lon > center_lon:
-            # Then it's to east
-            if lat > center_lat:
-                # then it's to north-east
-                if not sectors['NE'] or way_priority.index(way_type) < way_priority.index(sectors['NE']['way_type']):
-                    sectors['NE'] = {
-                        'lat': lat,
-                        'lon': lon,
-                        'node_id': way_source,
-                        'distance': distance,
-                        'way_type': way_type
-                    }
-            else:
-                # it's to south-east
-                if not sectors['SE'] or way_priority.index(way_type) < way_priority.index(sectors['SE']['way_type']):
-                    sectors['SE'] = {
-                        'lat': lat,
-                        'lon': lon,
-                        'node_id': way_source,
-                        'distance': distance,
-                        'way_type': way_type
-                    }
-        else:
-            # it's to west
-            if lat > center_lat:
-                # then it's to north-west
-                if not sectors['NW'] or way_priority.index(way_type) < way_priority.index(sectors['NW']['way_type']):
-                    sectors['NW'] = {
-                        'lat': lat,
-                        'lon': lon,
-                        'node_id': way_source,
-                        'distance': distance,
-                        'way_type': way_type
-                    }
-            else:
-                # it's to south-west
-                if not sectors['SW'] or way_priority.index(way_type) < way_priority.index(sectors['SW']['way_type']):
-                    sectors['SW'] = {
-                        'lat': lat,
-                        'lon': lon,
-                        'node_id': way_source,
-                        'distance': distance,
-                        'way_type': way_type
-                    }
-
-        # Continue iterating results (end condition in beginning of loop)
+    with gisdb_connection(dbh) as dbh:
+        cursor = dbh.cursor()
+        cursor.execute(database_query, query_params)
+        result_tuples = cursor.fetchall()
+        cursor.close()
+
+    # Segments come in order of route ids: 0, 1, 2, ...
+    paths = []
+    for route_id, edge in result_tuples:
+        if len(paths) < (int(route_id)+1):
+            paths.append([])
+        paths[int(route_id)].append(int(edge))
+    return paths
+
+
+def get_edges_union_geojson_and_length(edge_ids, dbh=None):
+
+    database_query = ("""
+        SELECT 
+        ST_AsGeoJSON(ST_UNION(geom_way)) as geojson, 
+        ST_Length(ST_UNION(geom_way)::geography) as length
+          FROM fi_2po_4pgr
+          WHERE id = ANY(%s);
+        """)
+    query_params = (list(map(int, edge_ids)),)
+
+    # Execute query
+    with gisdb_connection(dbh) as dbh:
+        cursor = dbh.cursor()
+        cursor.execute(database_query, query_params)
         result_tuple = cursor.fetchone()
+        cursor.close()
+
+    # Process result
+    if not result_tuple or not result_tuple[0]:
+        return None, None
+    return result_tuple[0], result_tuple[1]
+
+
+def get_edges_points(edge_ids, dbh=None):
+    """
+    {edge id: [(lat, lon), ...]} vertices of every edge, in geometry order (source -> target).
+    """
+
+    database_query = ("""
+        SELECT
+        s.id as edge,
+        ST_Y(p.geom) as lat,
+        ST_X(p.geom) as lon
+          FROM fi_2po_4pgr as s, ST_DumpPoints(ST_LineMerge(s.geom_way)) as p
+          WHERE s.id = ANY(%s)
+          ORDER BY s.id, p.path;
+        """)
+    query_params = (list(map(int, edge_ids)),)
+
+    # Execute query
+    with gisdb_connection(dbh) as dbh:
+        cursor = dbh.cursor()
+        cursor.execute(database_query, query_params)
+        result_tuples = cursor.fetchall()
+        cursor.close()
+
+    # Process result
+    edge_points = {}
+    for edge, lat, lon in result_tuples:
+        edge_points.setdefault(int(edge), []).append((lat, lon))
+    return edge_points
+
+
+def get_road_network_version(dbh=None):
+
+    # "relfilenode:revision". The table's file node changes when the network is re-imported (osm2po drops and
+    # recreates it) or rewritten (TRUNCATE, VACUUM FULL, CLUSTER); the road_network_revision row is bumped by
+    # "manage.py bump_road_network_version" after edits in place. Catalog lookups only, no scan of the table
+    database_query = ("""
+        SELECT pg_relation_filenode('fi_2po_4pgr'), to_regclass('road_network_revision') IS NOT NULL;
+        """)
+    revision_query = ("""
+        SELECT revision FROM road_network_revision;
+        """)
+
+    # Execute queries, no revision row before the first bump
+    with gisdb_connection(dbh) as dbh:
+        cursor = dbh.cursor()
+        cursor.execute(database_query)
+        filenode, revision_table_exists = cursor.fetchone()
+        revision = None
+        if revision_table_exists:
+            cursor.execute(revision_query)
+            revision = cursor.fetchone()
+        cursor.close()
+
+    return '{}:{}'.format(filenode, revision[0] if revision else 0)
+
+
+def bump_road_network_version(dbh=None):
+    """
+    Mark fi_2po_4pgr as changed, for edits that keep the table (a re-import changes the version by itself).
+    Returns the new version, workers pick it up within ROAD_NETWORK_VERSION_CHECK_INTERVAL seconds.
+    """
+    database_queries = ("""
+        CREATE TABLE IF NOT EXISTS road_network_revision (
+          id boolean PRIMARY KEY DEFAULT true CHECK (id), -- one row only
+          revision bigint NOT NULL,
+          bumped_at timestamp with time zone NOT NULL
+        );
+        """, """
+        INSERT INTO road_network_revision (revision, bumped_at) VALUES (1, now())
+          ON CONFLICT (id) DO UPDATE SET revision = road_network_revision.revision + 1, bumped_at = now();
+        """)
+
+    # Execute queries
+    with gisdb_connection(dbh) as dbh:
+        cursor = dbh.cursor()
+        try:
+            for database_query in database_queries:
+                cursor.execute(database_query)
+            dbh.commit()
+        except Exception:
+            dbh.rollback()
+            raise
+        finally:
+            cursor.close()
+
+    return get_road_network_version(dbh)
+
+
+_road_network_version = None
+_road_network_version_checked_at = 0.0
+_road_network_version_lock = threading.Lock()  # Held by whichever thread is re-reading the version
+
+
+def _refresh_road_network_version():
+    global _road_network_version, _road_network_version_checked_at
+    try:
+        _road_network_version = get_road_network_version()
+    except Exception:
+        pass  # Keep the previous version, retried after another interval
+    finally:
+        _road_network_version_checked_at = time.time()
+        _road_network_version_lock.release()
+
+
+def get_current_road_network_version(dbh=None):
+    """
+    Road network version, re-read at most every ROAD_NETWORK_VERSION_CHECK_INTERVAL seconds.
+    In-memory structures built from fi_2po_4pgr compare against this to know when to rebuild.
+    Only the first call waits for the query, later re-reads run in one background thread at a time while
+    callers keep getting the previous version.
+    """
+    global _road_network_version, _road_network_version_checked_at
+    check_interval = getattr(settings, 'ROAD_NETWORK_VERSION_CHECK_INTERVAL', DEFAULT_ROAD_NETWORK_VERSION_CHECK_INTERVAL)
+    if _road_network_version is None:
+        with _road_network_version_lock:
+            if _road_network_version is None:
+                _road_network_version = get_road_network_version(dbh)
+                _road_network_version_checked_at = time.time()
+    elif time.time() - _road_network_version_checked_at > check_interval \
+            and _road_network_version_lock.acquire(blocking=False):
+        threading.Thread(target=_refresh_road_network_version, daemon=True).start()
+    return _road_network_version
+
+
+def refresh_ksp_edge_tiles(tile_size_deg, dbh=None):
+    """
+    (Re)build ksp_edge_tiles: every fi_2po_4pgr edge with its geodesic length precomputed, keyed by the tile
+    holding the lower-left corner of its bbox and stored in tile order. Built and indexed aside as ksp_edge_tiles_new,
+    then swapped in by renames in a short transaction, so KSP queries keep running against the old table meanwhile
+    and are only blocked for the swap itself. Run after every network re-import.
+    """
+    build_queries = ("""
+        DROP TABLE IF EXISTS ksp_edge_tiles_new;
+        """, """
+        CREATE TABLE ksp_edge_tiles_new AS
+          SELECT
+          s.id as id,
+          s.source as source,
+          s.target as target,
+          ST_Length(s.geom_way::geography) as cost,
+          floor(ST_XMin(s.geom_way) / %(tile_size)s)::integer as tile_x,
+          floor(ST_YMin(s.geom_way) / %(tile_size)s)::integer as tile_y,
+          ST_XMin(s.geom_way) as xmin,
+          ST_YMin(s.geom_way) as ymin,
+          ST_XMax(s.geom_way) as xmax,
+          ST_YMax(s.geom_way) as ymax
+            FROM fi_2po_4pgr as s
+            ORDER BY tile_x, tile_y; -- edges of a tile end up on neighbouring pages
+        """, """
+        CREATE INDEX ksp_edge_tiles_new_tile_idx ON ksp_edge_tiles_new (tile_x, tile_y);
+        """, """
+        ANALYZE ksp_edge_tiles_new;
+        """, """
+        CREATE TABLE IF NOT EXISTS ksp_edge_tiles_meta (
+          network_version text,
+          tile_size double precision,
+          max_span_x integer,
+          max_span_y integer,
+          edge_count integer,
+          refreshed_at timestamp with time zone
+        );
+        """)
+    meta_query = ("""
+        SELECT
+        coalesce(max(floor(t.xmax / %(tile_size)s)::integer - t.tile_x), 0), -- how many tiles edges reach over
+        coalesce(max(floor(t.ymax / %(tile_size)s)::integer - t.tile_y), 0),
+        count(*)
+          FROM ksp_edge_tiles_new as t;
+        """)
+    swap_queries = ("""
+        DROP TABLE IF EXISTS ksp_edge_tiles_old;
+        """, """
+        ALTER TABLE IF EXISTS ksp_edge_tiles RENAME TO ksp_edge_tiles_old;
+        """, """
+        ALTER INDEX IF EXISTS ksp_edge_tiles_tile_idx RENAME TO ksp_edge_tiles_old_tile_idx;
+        """, """
+        ALTER TABLE ksp_edge_tiles_new RENAME TO ksp_edge_tiles;
+        """, """
+        ALTER INDEX ksp_edge_tiles_new_tile_idx RENAME TO ksp_edge_tiles_tile_idx;
+        """, """
+        DELETE FROM ksp_edge_tiles_meta;
+        """, """
+        INSERT INTO ksp_edge_tiles_meta
+          VALUES (%(network_version)s, %(tile_size)s, %(max_span_x)s, %(max_span_y)s, %(edge_count)s, now());
+        """)
+
+    # Execute queries, the version is read first so a re-import during the build leaves the tiles outdated
+    with gisdb_connection(dbh) as dbh:
+        query_params = {
+            'tile_size': float(tile_size_deg),
+            'network_version': get_road_network_version(dbh)
+        }
+        cursor = dbh.cursor()
+        try:
+            # Build, nothing the KSP queries read is locked
+            for database_query in build_queries:
+                cursor.execute(database_query, query_params)
+            cursor.execute(meta_query, query_params)
+            query_params['max_span_x'], query_params['max_span_y'], query_params['edge_count'] = cursor.fetchone()
+            dbh.commit()
+            # Swap, renames and the one meta row only
+            for database_query in swap_queries:
+                cursor.execute(database_query, query_params)
+            dbh.commit()
+            # The old table is out of use now, dropping it waits only for queries still reading it
+            cursor.execute("DROP TABLE IF EXISTS ksp_edge_tiles_old;")
+            dbh.commit()
+        except Exception:
+            dbh.rollback()
+            raise
+        finally:
+            cursor.close()
+
+    return get_ksp_edge_tiles_meta(dbh)
+
+
+def get_ksp_edge_tiles_meta(dbh=None):
+
+    database_query = ("""
+        SELECT network_version, tile_size, max_span_x, max_span_y, edge_count, refreshed_at
+          FROM ksp_edge_tiles_meta;
+        """)
+
+    # Execute query, not having run "manage.py refresh_ksp_edge_tiles" yet is no error
+    with gisdb_connection(dbh) as dbh:
+        cursor = dbh.cursor()
+        cursor.execute("SELECT to_regclass('ksp_edge_tiles_meta') IS NOT NULL;")
+        table_exists = cursor.fetchone()[0]
+        result_tuple = None
+        if table_exists:
+            cursor.execute(database_query)
+            result_tuple = cursor.fetchone()
+        cursor.close()
+
+    # Process result
+    if not result_tuple:
+        return None
+    return {
+        'network_version': result_tuple[0],
+        'tile_size': result_tuple[1],
+        'max_span_x': result_tuple[2],
+        'max_span_y': result_tuple[3],
+        'edge_count': result_tuple[4],
+        'refreshed_at': result_tuple[5]
+    }
+
+
+_ksp_edge_tiles_meta = None
+_ksp_edge_tiles_meta_checked_at = 0.0
+
+
+def get_current_ksp_edge_tiles_meta(dbh=None):
+    """
+    Edge tiles metadata if settings.KSP_EDGE_TILES is on and the tiles match the current road network version,
+    otherwise None (KSP queries then read fi_2po_4pgr directly). Re-read like get_current_road_network_version().
+    """
+    global _ksp_edge_tiles_meta, _ksp_edge_tiles_meta_checked_at
+    if not getattr(settings, 'KSP_EDGE_TILES', False):
+        return None
+    check_interval = getattr(settings, 'ROAD_NETWORK_VERSION_CHECK_INTERVAL', DEFAULT_ROAD_NETWORK_VERSION_CHECK_INTERVAL)
+    if time.time() - _ksp_edge_tiles_meta_checked_at > check_interval:
+        _ksp_edge_tiles_meta = get_ksp_edge_tiles_meta(dbh)
+        _ksp_edge_tiles_meta_checked_at = time.time()
+    if _ksp_edge_tiles_meta is None \
+            or _ksp_edge_tiles_meta['network_version'] != get_current_road_network_version(dbh):
+        return None
+    return _ksp_edge_tiles_meta
+
+
+def get_covering_tile_range(edge_tiles_meta, xmin, ymin, xmax, ymax):
+    # Edges are keyed by their lower-left tile, so reach back by the widest edge to catch ones entering from below/left
+    tile_size = edge_tiles_meta['tile_size']
+    return (
+        int(math.floor(xmin / tile_size)) - edge_tiles_meta['max_span_x'],
+        int(math.floor(xmax / tile_size)),
+        int(math.floor(ymin / tile_size)) - edge_tiles_meta['max_span_y'],
+        int(math.floor(ymax / tile_size))
+    )
+
+
+def get_ranked_points_per_sector_within_range(center_lat,
+                                              center_lon,
+                                              optimal_range_km,
+                                              lowest_permitted_range_km,
+                                              highest_permitted_range_km,
+                                              sector_count=4,
+                                              candidates_per_way_type=3,
+                                              dbh=None):
+
+    # Calculate bbox
+    extent_m, n_extent_m = highest_permitted_range_km*1000*2, (-1)*highest_permitted_range_km*1000*2
+    extent_high_lat, extent_high_lon = calculate_wgs84_lat_lon_by_offset(center_lat, center_lon, extent_m, extent_m)
+    extent_low_lat, extent_low_lon = calculate_wgs84_lat_lon_by_offset(center_lat, center_lon, n_extent_m, n_extent_m)
+
+    # Prepare DB query, ranking is done server-side so only a few rows per (sector, way priority) are returned
+    way_priority_case = "CASE clazz " + " ".join(
+        "WHEN {} THEN {}".format(way_type, priority)
+        for priority, way_type in enumerate(WAY_PRIORITY[:-1])
+    ) + " ELSE {} END".format(len(WAY_PRIORITY) - 1)
+    database_query = ("""
+        SELECT lat, lon, source, metres_away, way_priority, sector
+          FROM (
+            SELECT 
+            lat, lon, source, metres_away, way_priority, sector,
+            ROW_NUMBER() OVER (
+              PARTITION BY sector, way_priority
+              ORDER BY ABS(metres_away - %s) ASC -- "ABSolute distance nearest to center"
+            ) as rank_in_way_type
+              FROM (
+                SELECT 
+                y1 as lat, 
+                x1 as lon, 
+                source as source,
+                ST_Distance_Sphere(ST_SetSRID(ST_MakePoint(%s,%s), 4326), geom_way) as metres_away,
+                """ + way_priority_case + """ as way_priority,
+                MOD(FLOOR(DEGREES(ST_Azimuth(
+                  ST_SetSRID(ST_MakePoint(%s,%s), 4326)::geography, -- SRID: WGS84
+                  ST_SetSRID(ST_MakePoint(x1,y1), 4326)::geography
+                )) / (360.0 / %s))::integer, %s) as sector
+                  FROM fi_2po_4pgr
+                  WHERE geom_way && ST_MakeEnvelope(%s,%s,%s,%s,4326)
+              ) AS ways_in_bbox
+              WHERE
+                metres_away > %s -- "minimum metres away from center"
+                AND metres_away < %s -- "maximum metres away from center"
+                AND sector IS NOT NULL
+          ) AS ranked_ways
+          WHERE rank_in_way_type <= %s
+          ORDER BY sector ASC, way_priority ASC, rank_in_way_type ASC;
+        """)
+    query_params = (
+        int(optimal_range_km * 1000),
+        center_lon, center_lat,
+        center_lon, center_lat,
+        sector_count, sector_count,
+        extent_high_lon, extent_high_lat, extent_low_lon, extent_low_lat,
+        int(lowest_permitted_range_km * 1000),
+        int(highest_permitted_range_km * 1000),
+        int(candidates_per_way_type)
+    )
 
-    # Close db connection
-    cursor.close()
-    dbh.close()
+    # Execute query (on a pooled connection, unless the caller already holds one)
+    with gisdb_connection(dbh) as dbh:
+        cursor = dbh.cursor()
+        cursor.execute(database_query, query_params)
+        result_tuples = cursor.fetchall()
+        cursor.close()
 
+    # Rows come ranked per sector: best way type first, then nearest to optimal range
+    sector_names = get_sector_names(sector_count)
+    sectors = {sector_name: [] for sector_name in sector_names}
+    for lat, lon, way_source, distance, way_priority, sector in result_tuples:
+        sectors[sector_names[int(sector)]].append({
+            'lat': float(lat),
+            'lon': float(lon),
+            'node_id': float(way_source),
+            'distance': float(distance),
+            'way_type': float(WAY_PRIORITY[int(way_priority)])
+        })
     return sectors
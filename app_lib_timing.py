@@ -0,0 +1,183 @@
+"""
+Per-phase request timing.
+
+Views start a timer with start_phase_timer(view_name) and wrap their phases in "with timer.phase(name):".
+The phases of a request go out as a Server-Timing header and are aggregated into per (view, phase) histograms
+for the metrics view. With settings.PHASE_TIMING off (the default) a shared no-op timer is returned.
+"""
+from django.conf import settings
+from collections import OrderedDict
+import threading
+import time
+
+
+# Histogram upper bounds in seconds, the last (implicit) bucket is +Inf
+PHASE_TIMING_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_histograms = {}  # (view_name, phase) -> {'buckets': [count per bucket + Inf], 'count': n, 'sum': seconds}
+_histograms_lock = threading.Lock()
+
+
+def record_phase_seconds(view_name, phase, seconds):
+    with _histograms_lock:
+        histogram = _histograms.get((view_name, phase))
+        if histogram is None:
+            histogram = _histograms[(view_name, phase)] = {
+                'buckets': [0] * (len(PHASE_TIMING_BUCKETS) + 1),
+                'count': 0,
+                'sum': 0.0
+            }
+        bucket = 0
+        while bucket < len(PHASE_TIMING_BUCKETS) and seconds > PHASE_TIMING_BUCKETS[bucket]:
+            bucket += 1
+        histogram['buckets'][bucket] += 1
+        histogram['count'] += 1
+        histogram['sum'] += seconds
+
+
+class PhaseTimer:
+    """
+    Wall time per named phase of one request. Phases may repeat (e.g. once per sector) and run in several
+    threads at once, their times add up.
+    """
+
+    def __init__(self, view_name):
+        self.view_name = view_name
+        self.started_at = time.perf_counter()
+        self._phases = OrderedDict()  # phase -> [seconds, count]
+        self._lock = threading.Lock()
+        self._finished = False
+
+    def add(self, phase, seconds):
+        with self._lock:
+            totals = self._phases.setdefault(phase, [0.0, 0])
+            totals[0] += seconds
+            totals[1] += 1
+
+    def phase(self, phase):
+        return _TimedPhase(self, phase)
+
+    def server_timing_header(self):
+        with self._lock:
+            phases = list(self._phases.items())
+        return ', '.join(
+            '{};dur={:.1f}'.format(phase, seconds * 1000) + (';desc="{}x"'.format(count) if count > 1 else '')
+            for phase, (seconds, count) in phases
+        )
+
+    def set_server_timing(self, response):
+        response['Server-Timing'] = self.server_timing_header()
+        return response
+
+    def iter_timed(self, iterable, phase):
+        """
+        Pass a response body iterator through, timing its production as phase; the request is finished
+        (histograms recorded) once the body has been consumed.
+        """
+        iterator = iter(iterable)
+        while True:
+            phase_started = time.perf_counter()
+            try:
+                chunk = next(iterator)
+            except StopIteration:
+                self.add(phase, time.perf_counter() - phase_started)
+                break
+            self.add(phase, time.perf_counter() - phase_started)
+            yield chunk
+        self.finish()
+
+    def finish(self, response=None):
+        """
+        Record the phases (and the total so far) into the histograms, once; set Server-Timing on response if given.
+        """
+        if response is not None:
+            self.set_server_timing(response)
+        if self._finished:
+            return response
+        self._finished = True
+        with self._lock:
+            phases = list(self._phases.items())
+        for phase, (seconds, _) in phases:
+            record_phase_seconds(self.view_name, phase, seconds)
+        record_phase_seconds(self.view_name, 'total', time.perf_counter() - self.started_at)
+        return response
+
+
+class _TimedPhase:
+
+    def __init__(self, timer, phase):
+        self.timer = timer
+        self.phase = phase
+
+    def __enter__(self):
+        self.started_at = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.timer.add(self.phase, time.perf_counter() - self.started_at)
+
+
+class _NullPhaseTimer:
+    # Stand-in while timing is disabled: nothing is measured, responses and iterators pass through untouched
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def phase(self, phase):
+        return self
+
+    def add(self, phase, seconds):
+        pass
+
+    def set_server_timing(self, response):
+        return response
+
+    def iter_timed(self, iterable, phase):
+        return iterable
+
+    def finish(self, response=None):
+        return response
+
+
+NULL_PHASE_TIMER = _NullPhaseTimer()
+
+
+def start_phase_timer(view_name):
+    if not getattr(settings, 'PHASE_TIMING', False):
+        return NULL_PHASE_TIMER
+    return PhaseTimer(view_name)
+
+
+def get_phase_timing_metrics():
+    """
+    {view_name: {phase: {'count', 'sum_seconds', 'buckets': {upper bound: cumulative count, '+Inf': count}}}}
+    """
+    with _histograms_lock:
+        histograms = {key: dict(histogram, buckets=list(histogram['buckets'])) for key, histogram in _histograms.items()}
+    metrics = {}
+    for (view_name, phase), histogram in sorted(histograms.items()):
+        cumulative, buckets = 0, OrderedDict()
+        for upper_bound, count in zip(PHASE_TIMING_BUCKETS + ('+Inf',), histogram['buckets']):
+            cumulative += count
+            buckets[str(upper_bound)] = cumulative
+        metrics.setdefault(view_name, {})[phase] = {
+            'count': histogram['count'],
+            'sum_seconds': histogram['sum'],
+            'buckets': buckets
+        }
+    return metrics
+
+
+def render_phase_timing_prometheus():
+    # Prometheus text exposition of the histograms
+    lines = ['# TYPE request_phase_seconds histogram']
+    for view_name, phases in get_phase_timing_metrics().items():
+        for phase, histogram in phases.items():
+            labels = 'view="{}",phase="{}"'.format(view_name, phase)
+            for upper_bound, count in histogram['buckets'].items():
+                lines.append('request_phase_seconds_bucket{{{},le="{}"}} {}'.format(labels, upper_bound, count))
+            lines.append('request_phase_seconds_sum{{{}}} {}'.format(labels, histogram['sum_seconds']))
+            lines.append('request_phase_seconds_count{{{}}} {}'.format(labels, histogram['count']))
+    return '\n'.join(lines) + '\n'
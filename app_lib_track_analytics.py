@@ -0,0 +1,115 @@
+"""
+Route summary fields derived from the track itself, for user-created or edited routes and to recompute stored ones.
+
+Distance is the haversine length of the track. Elevation gain and loss sum the rises and drops of the elevation
+profile after a moving average over ELEVATION_SMOOTHING_WINDOW_M metres of track, so that GPS/DEM noise doesn't add up.
+Tracks are processed many at a time: concatenated and reduced per track with np.bincount / np.*.reduceat, a batch
+costs a handful of vectorized passes however many routes it holds.
+"""
+from django.conf import settings
+import numpy as np
+
+
+EARTH_RADIUS_M = 6371008.8
+DEFAULT_ELEVATION_SMOOTHING_WINDOW_M = 100
+
+# Route fields calculate_track_summaries() gives values for
+TRACK_SUMMARY_FIELDS = (
+    'bounding_box_larger_edge_lat', 'bounding_box_larger_edge_lng',
+    'bounding_box_lesser_edge_lat', 'bounding_box_lesser_edge_lng',
+    'distance', 'accumulated_elevation_gain', 'accumulated_elevation_loss',
+    'first_lat', 'first_lng', 'last_lat', 'last_lng'
+)
+
+
+def haversine_segment_lengths(lats, lons):
+    # Metres between consecutive points, one less than there are points
+    lat, lon = np.radians(lats), np.radians(lons)
+    a = np.sin(np.diff(lat) / 2) ** 2 + np.cos(lat[:-1]) * np.cos(lat[1:]) * np.sin(np.diff(lon) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def smooth_elevations(track_distances, elevations, window_m):
+    """
+    Mean elevation of the points within window_m / 2 metres along the track (track_distances, ascending) on either
+    side of every point.
+    """
+    elevation_sums = np.concatenate(([0.0], np.cumsum(elevations)))
+    window_starts = np.searchsorted(track_distances, track_distances - window_m / 2, side='left')
+    window_ends = np.searchsorted(track_distances, track_distances + window_m / 2, side='right')
+    return (elevation_sums[window_ends] - elevation_sums[window_starts]) / (window_ends - window_starts)
+
+
+def get_track_arrays(track_points):
+    # (lats, lons, elevations) of a decoded TrackPoints, NaN where a point lacks the channel
+    missing = np.full(track_points.count, np.nan)
+    return tuple(track_points.channels.get(key, missing) for key in ('y', 'x', 'e'))
+
+
+def calculate_track_summaries(tracks, window_m=None):
+    """
+    {Route field: value} of TRACK_SUMMARY_FIELDS per track given as (lats, lons, elevations) arrays, or None for
+    tracks without a point having both coordinates. Points lacking a coordinate are left out, elevation
+    gain/loss are None for tracks without elevations.
+    """
+    if window_m is None:
+        window_m = getattr(settings, 'ELEVATION_SMOOTHING_WINDOW_M', DEFAULT_ELEVATION_SMOOTHING_WINDOW_M)
+    track_count = len(tracks)
+    if track_count == 0:
+        return []
+    lats = np.concatenate([np.asarray(track[0], dtype=np.float64) for track in tracks])
+    lons = np.concatenate([np.asarray(track[1], dtype=np.float64) for track in tracks])
+    elevations = np.concatenate([np.asarray(track[2], dtype=np.float64) for track in tracks])
+    track = np.repeat(np.arange(track_count), [len(track[0]) for track in tracks])
+    present = ~np.isnan(lats) & ~np.isnan(lons)
+    lats, lons, elevations, track = lats[present], lons[present], elevations[present], track[present]
+
+    point_counts = np.bincount(track, minlength=track_count)
+    starts = np.concatenate(([0], np.cumsum(point_counts)[:-1]))
+    has_points = point_counts > 0
+
+    # Segments joining the last point of a track to the first of the next one don't count
+    segment_lengths = haversine_segment_lengths(lats, lons)
+    same_track = track[1:] == track[:-1]
+    distances = np.bincount(track[1:][same_track], weights=segment_lengths[same_track], minlength=track_count)
+
+    # Distance along the concatenated tracks, with gaps wider than the window so that no window spans two tracks
+    track_distances = np.concatenate(([0.0], np.cumsum(np.where(same_track, segment_lengths, window_m + 1))))
+    has_elevation = ~np.isnan(elevations)
+    smoothed = smooth_elevations(track_distances[has_elevation], elevations[has_elevation], window_m)
+    elevation_track = track[has_elevation]
+    rises = np.diff(smoothed)
+    same_elevation_track = elevation_track[1:] == elevation_track[:-1]
+    rise_track = elevation_track[1:][same_elevation_track]
+    rises = rises[same_elevation_track]
+    gains = np.bincount(rise_track, weights=np.maximum(rises, 0), minlength=track_count)
+    losses = np.bincount(rise_track, weights=np.maximum(-rises, 0), minlength=track_count)
+    has_elevations = np.bincount(elevation_track, minlength=track_count) > 0
+
+    # Bounding box and end points of the tracks having points
+    first = starts[has_points]
+    last = first + point_counts[has_points] - 1
+    max_lats, min_lats = np.maximum.reduceat(lats, first), np.minimum.reduceat(lats, first)
+    max_lons, min_lons = np.maximum.reduceat(lons, first), np.minimum.reduceat(lons, first)
+
+    summaries = [None] * track_count
+    for i, t in enumerate(np.flatnonzero(has_points).tolist()):
+        summaries[t] = {
+            'bounding_box_larger_edge_lat': float(max_lats[i]),
+            'bounding_box_larger_edge_lng': float(max_lons[i]),
+            'bounding_box_lesser_edge_lat': float(min_lats[i]),
+            'bounding_box_lesser_edge_lng': float(min_lons[i]),
+            'distance': int(round(distances[t])),
+            'accumulated_elevation_gain': int(round(gains[t])) if has_elevations[t] else None,
+            'accumulated_elevation_loss': int(round(losses[t])) if has_elevations[t] else None,
+            'first_lat': float(lats[first[i]]),
+            'first_lng': float(lons[first[i]]),
+            'last_lat': float(lats[last[i]]),
+            'last_lng': float(lons[last[i]])
+        }
+    return summaries
+
+
+def calculate_track_summary(track_points, window_m=None):
+    # calculate_track_summaries() of a single decoded TrackPoints
+    return calculate_track_summaries([get_track_arrays(track_points)], window_m)[0]
@@ -0,0 +1,101 @@
+"""
+Level-of-detail (LOD) simplification of tracks with Douglas-Peucker.
+
+Instead of storing every simplified version, one "importance" value per point is stored: the largest tolerance
+(in metres) at which Douglas-Peucker still keeps the point. Any level is then a single comparison,
+points with importance > tolerance. First and last points are always kept.
+"""
+import math
+import zlib
+import numpy as np
+
+
+EARTH_RADIUS_M = 6371008.8
+# Levels offered to clients, requested tolerances are snapped down to one of these (metres)
+LOD_TOLERANCES_M = (1, 4, 16, 64, 256, 1024)
+# Web mercator ground resolution at zoom 0 on the equator, metres per 256px tile pixel
+MERCATOR_METRES_PER_PIXEL_Z0 = 156543.03392
+
+
+def calculate_douglas_peucker_importance(lats, lons):
+    """
+    Douglas-Peucker over the whole track at once: every recursion depth is handled with one set of
+    vectorized operations over all segments still being split.
+    """
+    count = len(lats)
+    importance = np.zeros(count, dtype=np.float64)
+    if count == 0:
+        return importance
+    importance[0] = importance[-1] = np.inf
+
+    # Local equirectangular projection to metres
+    lat0 = math.radians(float(np.mean(lats)))
+    ys = np.radians(np.asarray(lats, dtype=np.float64)) * EARTH_RADIUS_M
+    xs = np.radians(np.asarray(lons, dtype=np.float64)) * EARTH_RADIUS_M * math.cos(lat0)
+
+    starts = np.array([0], dtype=np.int64)
+    ends = np.array([count - 1], dtype=np.int64)
+    parent_importance = np.array([np.inf])
+    while len(starts):
+        # Only segments with interior points can be split further
+        splittable = ends - starts >= 2
+        starts, ends, parent_importance = starts[splittable], ends[splittable], parent_importance[splittable]
+        if not len(starts):
+            break
+        interior_counts = ends - starts - 1
+        offsets = np.concatenate(([0], np.cumsum(interior_counts)[:-1]))
+        segment_of = np.repeat(np.arange(len(starts)), interior_counts)
+        points = np.repeat(starts, interior_counts) + (np.arange(int(interior_counts.sum())) - offsets[segment_of]) + 1
+
+        # Distance of every interior point to its segment (clamped, so closed loops with start == end work too)
+        ax, ay = xs[starts][segment_of], ys[starts][segment_of]
+        dx, dy = xs[ends][segment_of] - ax, ys[ends][segment_of] - ay
+        length_squared = dx * dx + dy * dy
+        t = np.where(
+            length_squared > 0,
+            ((xs[points] - ax) * dx + (ys[points] - ay) * dy) / np.where(length_squared > 0, length_squared, 1),
+            0
+        )
+        t = np.clip(t, 0, 1)
+        distances = np.hypot(xs[points] - (ax + t * dx), ys[points] - (ay + t * dy))
+
+        # Farthest point of each segment splits it; a point never outranks the point that split its parent
+        max_distances = np.maximum.reduceat(distances, offsets)
+        farthest = np.flatnonzero(distances == max_distances[segment_of])
+        farthest = farthest[np.unique(segment_of[farthest], return_index=True)[1]]
+        splits = points[farthest]
+        split_importance = np.minimum(max_distances, parent_importance)
+        importance[splits] = split_importance
+
+        starts, ends = np.concatenate((starts, splits)), np.concatenate((splits, ends))
+        parent_importance = np.concatenate((split_importance, split_importance))
+    return importance
+
+
+def encode_importance(importance):
+    return zlib.compress(importance.astype('<f4').tobytes(), 6)
+
+
+def decode_importance(packed):
+    return np.frombuffer(zlib.decompress(memoryview(packed)), dtype='<f4')
+
+
+def snap_tolerance(tolerance_m):
+    # Largest offered level not above the requested tolerance, None means full detail
+    levels = [level for level in LOD_TOLERANCES_M if level <= tolerance_m]
+    return levels[-1] if levels else None
+
+
+def zoom_to_tolerance(zoom, lat):
+    # About one screen pixel at the given web map zoom level
+    return MERCATOR_METRES_PER_PIXEL_Z0 * math.cos(math.radians(lat)) / (2 ** zoom)
+
+
+def select_level_of_detail(importance, tolerance_m):
+    """
+    Indices of the points kept at the given tolerance (snapped to LOD_TOLERANCES_M), all points for None.
+    """
+    level = snap_tolerance(tolerance_m) if tolerance_m is not None else None
+    if level is None:
+        return np.arange(len(importance))
+    return np.flatnonzero(importance > level)
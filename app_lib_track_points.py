@@ -0,0 +1,179 @@
+"""
+Compact columnar encoding of track points ([{d: .., x: .., y: .., e: ..}, ...]).
+
+Layout: header (magic, format version, point count, one presence byte per channel) followed by a zlib-compressed
+body. Every channel is stored as fixed-point int32 deltas of the points that have it, preceded by a packed
+presence bitmap when only some points do. Keys outside the known channels, and channel keys whose value is null,
+are kept as sparse JSON.
+"""
+import json
+import struct
+import zlib
+import numpy as np
+
+
+MAGIC = b'TRKP'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<4sBI')
+
+# (key, fixed-point scale): coordinates to 1e-6 degrees (~0.1m), distance and elevation to decimetres, time to seconds
+CHANNELS = (
+    ('x', 1000000),
+    ('y', 1000000),
+    ('d', 10),
+    ('e', 10),
+    ('t', 1)
+)
+CHANNEL_KEYS = frozenset(key for key, _ in CHANNELS)
+INTEGER_CHANNEL_KEYS = frozenset(key for key, scale in CHANNELS if scale == 1)
+
+PRESENCE_NONE = 0
+PRESENCE_ALL = 1
+PRESENCE_PARTIAL = 2
+
+INT32_MIN, INT32_MAX = -2 ** 31, 2 ** 31 - 1
+
+
+class TrackPoints:
+    """
+    Decoded track: one float64 array per channel (NaN where a point lacks the channel) plus sparse extra keys.
+    Arrays are built once from the packed bytes, dicts only if to_list() is called.
+    """
+
+    def __init__(self, count, channels, extras=None):
+        self.count = count
+        self.channels = channels  # key -> np.ndarray of length count
+        self.extras = extras or {}  # point index -> {key: value}
+
+    def __len__(self):
+        return self.count
+
+    def take(self, indices):
+        # Subset of the points (e.g. a simplified level of detail), in the given order
+        indices = np.asarray(indices, dtype=np.int64)
+        index_positions = {int(i): position for position, i in enumerate(indices.tolist())}
+        return TrackPoints(
+            len(indices),
+            {key: values[indices] for key, values in self.channels.items()},
+            {index_positions[i]: extra for i, extra in self.extras.items() if i in index_positions}
+        )
+
+    def to_list(self):
+        columns = []
+        for key, values in self.channels.items():
+            present = ~np.isnan(values)
+            if key in INTEGER_CHANNEL_KEYS:
+                values = np.where(present, values, 0).astype(np.int64)
+            columns.append((key, values.tolist(), present.tolist()))
+        points = []
+        for i in range(self.count):
+            point = {key: values[i] for key, values, present in columns if present[i]}
+            if i in self.extras:
+                point.update(self.extras[i])
+            points.append(point)
+        return points
+
+
+def encode_track_points(points):
+    """
+    Pack a list of track point dicts into bytes.
+    """
+    count = len(points)
+    presence_bytes = []
+    body_parts = []
+    for key, scale in CHANNELS:
+        present = np.fromiter((point.get(key) is not None for point in points), dtype=bool, count=count)
+        if not present.any():
+            presence_bytes.append(PRESENCE_NONE)
+            continue
+        if present.all():
+            presence_bytes.append(PRESENCE_ALL)
+        else:
+            presence_bytes.append(PRESENCE_PARTIAL)
+            body_parts.append(np.packbits(present).tobytes())
+        values = np.array([point[key] for point in points if point.get(key) is not None], dtype=np.float64)
+        fixed = np.round(values * scale).astype(np.int64)
+        deltas = np.diff(fixed, prepend=0)
+        if len(deltas) and (deltas.min() < INT32_MIN or deltas.max() > INT32_MAX):
+            raise ValueError('Track point "{}" values out of range for packed storage'.format(key))
+        body_parts.append(deltas.astype('<i4').tobytes())
+
+    # Channel keys given as null go with the other keys, so they come back as null instead of missing
+    extras = []
+    for i, point in enumerate(points):
+        extra = {k: v for k, v in point.items() if k not in CHANNEL_KEYS or v is None}
+        if extra:
+            extras.append([i, extra])
+    body_parts.append(json.dumps(extras, separators=(',', ':')).encode('utf-8') if extras else b'')
+
+    header = HEADER.pack(MAGIC, FORMAT_VERSION, count) + bytes(presence_bytes)
+    return header + zlib.compress(b''.join(body_parts), 6)
+
+
+def decode_track_points(packed):
+    """
+    Unpack bytes (or a memoryview, as Postgres BinaryFields come back) into TrackPoints.
+    """
+    packed = memoryview(packed)
+    magic, version, count = HEADER.unpack_from(packed, 0)
+    if magic != MAGIC or version != FORMAT_VERSION:
+        raise ValueError('Not a packed track points value (version {})'.format(FORMAT_VERSION))
+    presence_bytes = packed[HEADER.size:HEADER.size + len(CHANNELS)].tobytes()
+    body = zlib.decompress(packed[HEADER.size + len(CHANNELS):])
+
+    offset = 0
+    channels = {}
+    for (key, scale), presence in zip(CHANNELS, presence_bytes):
+        if presence == PRESENCE_NONE:
+            continue
+        if presence == PRESENCE_ALL:
+            present = None
+            present_count = count
+        else:
+            mask_length = (count + 7) // 8
+            present = np.unpackbits(np.frombuffer(body, dtype=np.uint8, count=mask_length, offset=offset))[:count]
+            present = present.astype(bool)
+            present_count = int(present.sum())
+            offset += mask_length
+        deltas = np.frombuffer(body, dtype='<i4', count=present_count, offset=offset)
+        offset += present_count * 4
+        values = np.cumsum(deltas, dtype=np.int64) / scale
+        if present is None:
+            channels[key] = values
+        else:
+            channels[key] = np.full(count, np.nan)
+            channels[key][present] = values
+
+    extras = {}
+    if offset < len(body):
+        extras = {i: extra for i, extra in json.loads(body[offset:].decode('utf-8'))}
+    return TrackPoints(count, channels, extras)
+
+
+def iter_track_points_json(track_points, chunk_size=2000):
+    """
+    JSON array text of the points, yielded in chunks of chunk_size points without building the dicts.
+    Produces the same text as json.dumps(track_points.to_list()).
+    """
+    yield '['
+    for chunk_start in range(0, track_points.count, chunk_size):
+        chunk_end = min(chunk_start + chunk_size, track_points.count)
+        columns = []
+        for key, values in track_points.channels.items():
+            values = values[chunk_start:chunk_end]
+            present = ~np.isnan(values)
+            if key in INTEGER_CHANNEL_KEYS:
+                values = np.where(present, values, 0).astype(np.int64)
+            prefix = '"{}": '.format(key)
+            columns.append([
+                prefix + repr(value) if is_present else None
+                for value, is_present in zip(values.tolist(), present.tolist())
+            ])
+        points = []
+        for i, fields in enumerate(zip(*columns), chunk_start):
+            fields = [field for field in fields if field is not None]
+            if i in track_points.extras:
+                fields.append(json.dumps(track_points.extras[i])[1:-1])
+            points.append('{' + ', '.join(fields) + '}')
+        yield (', ' if chunk_start else '') + ', '.join(points)
+    yield ']'
@@ -1,323 +1,583 @@
 from django.conf import settings
-from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseNotFound, HttpResponseServerError
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseNotFound, HttpResponseServerError, \
+    StreamingHttpResponse
 from ..app_lib import calculate_wgs84_lat_lon_by_offset, calculate_wgs84_lat_lon_by_degree_and_distance
-from ..app_lib_sql import get_nearest_point_lat_lon_id, get_points_lat_lon_id_distance_per_sector_within_range
+from ..app_lib_sql import get_nearest_point_lat_lon_id, get_nearest_points_lat_lon_id, \
+    get_points_lat_lon_id_distance_per_sector_within_range, \
+    get_ranked_points_per_sector_within_range, get_k_shortest_paths_edge_ids, get_edges_union_geojson_and_length, \
+    get_current_road_network_version, get_edges_points
+from ..app_lib_db import gisdb_connection, GisdbPoolExhausted
+from ..app_lib_graph import get_road_graph
+from ..app_lib_spatial import get_nearest_node_lat_lon_id, get_nearest_nodes_lat_lon_id
+from ..app_lib_cache import TTLLRUCache, DjangoCacheAdapter
+from ..app_lib_edge_scoring import select_disposed_edges
+from ..app_lib_timing import start_phase_timer, NULL_PHASE_TIMER
+from ..app_lib_budget import RequestBudget, BudgetExhausted, start_request_budget
+from ..app_lib_route_formats import encode_polyline, encode_binary_points, stitch_round_trip_points, \
+    parse_route_format_params, ROUND_TRIP_FORMATS, ROUTE_FORMAT_GEOJSON, ROUTE_FORMAT_BINARY, \
+    BINARY_CONTENT_TYPE, DEFAULT_ROUTE_FORMAT_PRECISION
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FuturesTimeoutError
+import functools
 import re
-import psycopg2
 import json
 import math
 
 
 DISTANCE_MARGIN = 0.25
 DISPOSE_MARGIN = 0.4
+DEFAULT_SECTOR_CONCURRENCY = 4  # Per-request cap, 1 runs the sectors serially
+KSP_BACKEND_SQL = 'sql'
+KSP_BACKEND_GRAPH = 'graph'
+NEAREST_NODE_BACKEND_SQL = 'sql'
+NEAREST_NODE_BACKEND_INDEX = 'index'
+SECTOR_SELECTION_SCAN = 'scan'
+SECTOR_SELECTION_RANKED = 'ranked'
+DEFAULT_SECTOR_COUNT = 4
+DEFAULT_SECTOR_CANDIDATES_PER_WAY_TYPE = 3
+DEFAULT_ROUND_TRIP_CACHE_SIZE = 0  # Disabled unless configured
+DEFAULT_ROUND_TRIP_CACHE_TTL = 3600  # seconds
+DEFAULT_ROUND_TRIP_CACHE_DISTANCE_STEP_KM = 1.0
+ROUND_TRIP_NOT_FOUND = ''  # Cached as well, so unreachable origins aren't recomputed either
+ROUND_TRIP_ROUTE_KEYS = ('geojson', 'length_m', 'sector')  # Of the route dicts, what the client gets as JSON
+DEFAULT_GOOD_ENOUGH_TOLERANCE = 0  # Fraction of distance_km, 0 always evaluates every sector
+SECTOR_TIMED_OUT = 'Timed out'
+SECTOR_STOPPED_EARLY = 'Not needed, a route within tolerance was found'
+SECTOR_WITHOUT_POINT = 'No round trip point in sector'
+SECTOR_WITHOUT_GEOMETRY = 'No route geometry'
+ROUND_TRIP_TIMED_OUT = 'Ran out of time generating a round trip, try again.'
+ROUND_TRIP_POOL_EXHAUSTED = 'Too many round trips being generated right now, try again.'
+STREAM_NDJSON = 'ndjson'
+STREAM_SSE = 'sse'
+STREAM_CONTENT_TYPES = {
+    STREAM_NDJSON: 'application/x-ndjson',
+    STREAM_SSE: 'text/event-stream'
+}
+
+
+def find_k_shortest_paths(start_point_id, end_point_id, k, extent, excluded_edge_ids=(), dbh=None, graph=None,
+                          budget=None):
+    """
+    K shortest paths as lists of fi_2po_4pgr edge ids, from the backend chosen by KSP_BACKEND:
+    "sql" runs PGR_KSP in PostGIS, "graph" answers from the in-process road graph (giving up when budget runs out).
+    A given graph (e.g. a subgraph extracted once for a batch) is used regardless of the backend.
+    """
+    if graph is not None:
+        return graph.k_shortest_paths(start_point_id, end_point_id, k, extent, excluded_edge_ids, budget)
+    if getattr(settings, 'KSP_BACKEND', KSP_BACKEND_SQL) == KSP_BACKEND_GRAPH:
+        return get_road_graph().k_shortest_paths(start_point_id, end_point_id, k, extent, excluded_edge_ids, budget)
+    return get_k_shortest_paths_edge_ids(start_point_id, end_point_id, k, extent, excluded_edge_ids, dbh)
+
+
+def find_k_shortest_paths_within_budget(start_point_id, end_point_id, k, extent, excluded_edge_ids=(), graph=None,
+                                       budget=None):
+    """
+    find_k_shortest_paths() limited to what is left of budget (raises BudgetExhausted).
+    A pooled connection is only checked out for the "sql" backend, and only for as long as its query runs.
+    """
+    budget = budget or RequestBudget()
+    if graph is not None or getattr(settings, 'KSP_BACKEND', KSP_BACKEND_SQL) == KSP_BACKEND_GRAPH:
+        budget.check()
+        return find_k_shortest_paths(
+            start_point_id, end_point_id, k, extent, excluded_edge_ids, graph=graph, budget=budget
+        )
+    with gisdb_connection() as dbh, budget.query_scope(dbh):
+        return find_k_shortest_paths(start_point_id, end_point_id, k, extent, excluded_edge_ids, dbh)
+
+
+def select_round_trip_points_per_sector(center_lat, center_lon, optimal_range_km, lowest_permitted_range_km,
+                                        highest_permitted_range_km, dbh=None):
+    """
+    Round trip point per sector (or None), keyed by sector name.
+    SECTOR_SELECTION_MODE "scan" streams the whole ring into the NE/SE/SW/NW quadrants, "ranked" only fetches
+    a few ranked candidates per sector and way type, for ROUND_TRIP_SECTOR_COUNT (4, 8 or 16) sectors.
+    """
+    if getattr(settings, 'SECTOR_SELECTION_MODE', SECTOR_SELECTION_SCAN) != SECTOR_SELECTION_RANKED:
+        return get_points_lat_lon_id_distance_per_sector_within_range(
+            center_lat, center_lon, optimal_range_km, lowest_permitted_range_km, highest_permitted_range_km, dbh
+        )
+    ranking_args = (
+        center_lat, center_lon, optimal_range_km, lowest_permitted_range_km, highest_permitted_range_km,
+        getattr(settings, 'ROUND_TRIP_SECTOR_COUNT', DEFAULT_SECTOR_COUNT),
+        getattr(settings, 'SECTOR_CANDIDATES_PER_WAY_TYPE', DEFAULT_SECTOR_CANDIDATES_PER_WAY_TYPE)
+    )
+    if getattr(settings, 'KSP_BACKEND', KSP_BACKEND_SQL) == KSP_BACKEND_GRAPH:
+        ranked_sectors = get_road_graph().ranked_points_per_sector(*ranking_args)
+    else:
+        ranked_sectors = get_ranked_points_per_sector_within_range(*ranking_args, dbh=dbh)
+    return {
+        sector_key: candidates[0] if candidates else None
+        for sector_key, candidates in ranked_sectors.items()
+    }
+
+
+def generate_sector_route(sector_key, sector_node_id, start_point_id,
+                          extent_high_lon, extent_high_lat, extent_low_lon, extent_low_lat, timer=NULL_PHASE_TIMER,
+                          graph=None, budget=None):
+    """
+    Run the KSP -> dispose -> alternative KSP -> merge pipeline for one sector, timing each step on timer.
+    Returns the route dict, a string describing why the sector was skipped, or None.
+    Queries are limited to what is left of budget, SECTOR_TIMED_OUT is returned once it has run out or was cancelled.
+    Pooled connections are only checked out around the queries, none is held during the CPU-bound steps.
+    """
+    extent = (extent_high_lon, extent_high_lat, extent_low_lon, extent_low_lat)
+    budget = budget or RequestBudget()
+
+    try:
+        with timer.phase('ksp'):
+            paths = find_k_shortest_paths_within_budget(start_point_id, sector_node_id, 3, extent, (), graph, budget)
 
+        # IF NO ROUTES, then skip sector
+        if len(paths) == 0:
+            return "No routes at all for sector {}".format(sector_key)
 
-def generate_ksp_path(request):
-    # Gather arguments
-    input_start = request.GET.get('start_coordinates', None)
-    distance_km = request.GET.get('distance_km', None)
+        # Dispose the first path's edges that the routes share the most around their middle
+        # (see app_lib_edge_scoring)
+        with timer.phase('dispose'):
+            disposed_edge_ids = select_disposed_edges(paths, DISPOSE_MARGIN)
 
-    # Validate arguments
-    if input_start is None or ',' not in input_start:
-        return HttpResponseBadRequest('Invalid GET param "start_coordinates". Should be "lat,lon" (without quotes).')
-    elif not len(input_start.split(',')) == 2:
-        return HttpResponseBadRequest('Invalid coordinate(s) in GET param "start_coordinates". Provide both "lat,lon"')
-    elif not all(re.compile(r'^\d+([.]\d+)?$').match(c) for c in input_start.split(',')):
-        return HttpResponseBadRequest('Invalid coordinate(s) in GET param "start_coordinates". Format: "nn.mm,nn.mm"')
-    if distance_km is None:
-        return HttpResponseBadRequest('Invalid GET param "distance_km".')
-    elif not re.compile(r'^\d+([.]\d+)?$').match(distance_km):
-        return HttpResponseBadRequest('Invalid GET param "distance_km" e.g. "1", "12.3", "99"')
+        # IF NOTHING DISPOSED, then skip sector
+        if len(disposed_edge_ids) == 0:
+            return "No paths disposed in sector {}".format(sector_key)
+
+        # Alternative ("secondary") route with the disposed edges left out of the graph
+        with timer.phase('alt_ksp'):
+            alt_paths = find_k_shortest_paths_within_budget(
+                start_point_id, sector_node_id, 1, extent, disposed_edge_ids, graph, budget
+            )
+
+        # IF NO ALT ROUTE, then skip sector
+        if len(alt_paths) == 0 or len(alt_paths[0]) == 0:
+            return "Couldn't create alt route"
+
+        # Merge first and alternative route using ST_UNION
+        with timer.phase('merge'), gisdb_connection() as dbh, budget.query_scope(dbh):
+            geojson, length = get_edges_union_geojson_and_length(set(paths[0]) | set(alt_paths[0]), dbh)
+            geojson = None if not geojson else json.loads(geojson)
+    except BudgetExhausted:
+        return SECTOR_TIMED_OUT
+
+    if not geojson:
+        return None
+    return {
+        'geojson': geojson,
+        'length_m': length,
+        'sector': sector_key,
+        'path_edge_ids': (paths[0], alt_paths[0])  # Out and back, for the ordered output formats
+    }
+
+
+def run_sector_pipelines(pipeline, sector_args_list, concurrency=None):
+    """
+    Call pipeline(*sector_args) for every sector, at most concurrency (default KSP_SECTOR_CONCURRENCY) at a time.
+    Results are returned in the same order as sector_args_list, so the outcome is identical to serial mode.
+    """
+    if concurrency is None:
+        concurrency = getattr(settings, 'KSP_SECTOR_CONCURRENCY', DEFAULT_SECTOR_CONCURRENCY)
+    concurrency = min(concurrency, len(sector_args_list))
+    if concurrency <= 1:
+        return [pipeline(*sector_args) for sector_args in sector_args_list]
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [executor.submit(pipeline, *sector_args) for sector_args in sector_args_list]
+        return [future.result() for future in futures]
+
+
+def iter_sector_pipelines_as_completed(pipeline, sector_args_list, concurrency=None, budget=None):
+    """
+    As run_sector_pipelines(), but yields (index in sector_args_list, result) as soon as each sector finishes.
+    If the consumer stops early (e.g. the client went away) sectors not yet started are cancelled. Sectors still
+    unfinished when budget runs out are yielded as SECTOR_TIMED_OUT right away, their queries get cancelled.
+    """
+    if concurrency is None:
+        concurrency = getattr(settings, 'KSP_SECTOR_CONCURRENCY', DEFAULT_SECTOR_CONCURRENCY)
+    concurrency = min(concurrency, len(sector_args_list))
+    if concurrency <= 1:
+        for index, sector_args in enumerate(sector_args_list):
+            if budget is not None and budget.is_exhausted():
+                yield index, SECTOR_TIMED_OUT
+            else:
+                yield index, pipeline(*sector_args)
+        return
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    futures = {executor.submit(pipeline, *sector_args): index for index, sector_args in enumerate(sector_args_list)}
+    unfinished = set(futures.values())
+    try:
+        try:
+            for future in as_completed(futures, timeout=budget.remaining_seconds() if budget is not None else None):
+                unfinished.discard(futures[future])
+                yield futures[future], future.result()
+        except FuturesTimeoutError:
+            budget.cancel()
+            for index in sorted(unfinished):
+                yield index, SECTOR_TIMED_OUT
+    finally:
+        for future in futures:
+            future.cancel()
+        # Sectors left running are not waited for, cancelling the budget stops their queries and graph searches
+        if unfinished and budget is not None:
+            budget.cancel()
+        executor.shutdown(wait=False)
+
+
+def is_good_enough_route(sector_route, distance_km):
+    # Sector route within ROUND_TRIP_GOOD_ENOUGH_TOLERANCE of distance_km, no other sector needs to be waited for
+    tolerance = getattr(settings, 'ROUND_TRIP_GOOD_ENOUGH_TOLERANCE', DEFAULT_GOOD_ENOUGH_TOLERANCE)
+    return tolerance > 0 and isinstance(sector_route, dict) \
+        and abs((distance_km * 1000) - sector_route['length_m']) <= distance_km * 1000 * tolerance
+
+
+def iter_sector_results(sector_args_list, distance_km, budget=None):
+    """
+    (index in sector_args_list, generate_sector_route() result) of every sector, in the order they finish.
+    Once a route is within ROUND_TRIP_GOOD_ENOUGH_TOLERANCE of distance_km the remaining sectors are cancelled
+    and yielded as SECTOR_STOPPED_EARLY.
+    """
+    budget = budget or RequestBudget()
+    unfinished = set(range(len(sector_args_list)))
+    sector_results = iter_sector_pipelines_as_completed(generate_sector_route, sector_args_list, budget=budget)
+    for index, sector_route in sector_results:
+        unfinished.discard(index)
+        yield index, sector_route
+        if is_good_enough_route(sector_route, distance_km):
+            break
+    else:
+        return
+    budget.cancel()
+    sector_results.close()
+    for index in sorted(unfinished):
+        yield index, SECTOR_STOPPED_EARLY
 
-    # Transform value arguments
-    start_lat, start_lon = map(lambda coord: float(coord), input_start.split(','))
-    distance_km = float(distance_km)
 
-    # Query database for actual start point (nearest node)
-    start_point_lat, start_point_lon, start_point_id = get_nearest_point_lat_lon_id(start_lat, start_lon)
+def snap_start_point(start_lat, start_lon, dbh=None):
+    # Nearest node as (lat, lon, node_id), from the in-memory node index or by querying database
+    if getattr(settings, 'NEAREST_NODE_BACKEND', NEAREST_NODE_BACKEND_SQL) == NEAREST_NODE_BACKEND_INDEX:
+        return get_nearest_node_lat_lon_id(start_lat, start_lon)
+    return get_nearest_point_lat_lon_id(start_lat, start_lon, dbh)
 
-    # Guesstimate city routes as rectangular -> calculate route length based on trigonometry
-    def calc_round_trip_point_range(route_distance):
-        one_square_edge_length = route_distance/4
-        return math.sqrt(math.pow(one_square_edge_length,2)+math.pow(one_square_edge_length, 2))
+
+def snap_start_points(lat_lons, dbh=None):
+    # snap_start_point() for many points at once, (lat, lon, node_id) or None each
+    if getattr(settings, 'NEAREST_NODE_BACKEND', NEAREST_NODE_BACKEND_SQL) == NEAREST_NODE_BACKEND_INDEX:
+        return get_nearest_nodes_lat_lon_id([lat for lat, _ in lat_lons], [lon for _, lon in lat_lons])
+    return get_nearest_points_lat_lon_id(lat_lons, dbh)
+
+
+# Guesstimate city routes as rectangular -> calculate route length based on trigonometry
+def calc_round_trip_point_range(route_distance):
+    one_square_edge_length = route_distance/4
+    return math.sqrt(math.pow(one_square_edge_length,2)+math.pow(one_square_edge_length, 2))
+
+
+def select_round_trip_sectors(start_point, distance_km, dbh=None):
+    start_point_lat, start_point_lon, start_point_id = start_point
     round_trip_point_optimal_range = calc_round_trip_point_range(distance_km)
     round_trip_point_minimum_range = calc_round_trip_point_range(distance_km * (1 - DISTANCE_MARGIN))
     round_trip_point_maximum_range = calc_round_trip_point_range(distance_km * (1 + DISTANCE_MARGIN))
-
-    # Query database destination/round trip points per sector
-    sectors = get_points_lat_lon_id_distance_per_sector_within_range(
+    return select_round_trip_points_per_sector(
         start_point_lat,
         start_point_lon,
         round_trip_point_optimal_range,
         round_trip_point_minimum_range,
-        round_trip_point_maximum_range
+        round_trip_point_maximum_range,
+        dbh
     )
 
-    # Construct extent / bbox
+
+def calc_round_trip_extent(start_lat, start_lon, distance_km):
+    # Construct extent / bbox, as (extent_high_lon, extent_high_lat, extent_low_lon, extent_low_lat)
     extent_m, n_extent_m = (distance_km*(1+DISTANCE_MARGIN)*1000)+1000, ((-1)*distance_km*(1+DISTANCE_MARGIN)*1000)-1000
     extent_high_lat, extent_high_lon = calculate_wgs84_lat_lon_by_offset(start_lat, start_lon, extent_m, extent_m)
     extent_low_lat, extent_low_lon = calculate_wgs84_lat_lon_by_offset(start_lat, start_lon, n_extent_m, n_extent_m)
+    return extent_high_lon, extent_high_lat, extent_low_lon, extent_low_lat
+
+
+def get_sector_route_args(start_point_id, sectors, extent, timer=NULL_PHASE_TIMER, graph=None, budget=None):
+    # generate_sector_route() arguments of every sector that has a round trip point
+    return [
+        (sector_key, sectors[sector_key]['node_id'], start_point_id) + tuple(extent) + (timer, graph, budget)
+        for sector_key in sectors.keys()
+        if sectors[sector_key] is not None
+    ]
 
-    known_predefined_sectors = ['NE', 'SE', 'SW', 'NW']
-    available_sectors = filter(lambda sector_key: sectors[sector_key] is not None, known_predefined_sectors)
+
+def collect_sector_routes(sectors, sector_args_list, sector_results):
+    # Route dicts of the sector results (also stored on the sectors), skipped sectors left out
     final_routes = []
-    for available_key in available_sectors:
-
-        # Create SQL queries
-        temp_table_query = """
-            CREATE 
-                TEMP TABLE temp_ksp_result
-                    ON COMMIT 
-                        DROP
-                AS SELECT 
-                seq,
-                id1 as route,
-                id2 as from_node,
-                id3 as edge,
-                geom_way,
-                result.cost as seq_cost, -- currently we calculate cost from geography but could compare to this
-                -- currently un-used properties of edge below
-                id, osm_id, osm_name, osm_meta, osm_source_id, osm_target_id, clazz, flags, source, target, km,
-                kmh, s.cost as cost, reverse_cost, x1, y1, x2, y2
-                    FROM PGR_KSP(
-                        'SELECT 
-                         s.id as id, 
-                         s.source as source, 
-                         s.target as target, 
-                         ST_Length(s.geom_way::geography) as cost
-                             FROM fi_2po_4pgr as s
-                             WHERE s.geom_way && ST_MakeEnvelope(%s, %s, %s, %s, 4326) -- within bbox
-                         ',
-                        %s, -- start location ("way -> source (-> id)")
-                        %s, -- end location ("round trip" -spot)
-                        3,
-                        false
-                    )
-                    AS result
-                        -- join K-S-P's result set with main table -> to retrieve (ways') geometry
-                        INNER JOIN fi_2po_4pgr AS s ON result.id3 = s.id;
-        """
-        temp_table_query_params = (
-            extent_high_lon, extent_high_lat, extent_low_lon, extent_low_lat,
-            int(start_point_id),
-            int(sectors[available_key]['node_id'])
+    for sector_args, sector_route in zip(sector_args_list, sector_results):
+        if sector_route is None:
+            continue
+        sectors[sector_args[0]]['route'] = sector_route
+        if isinstance(sector_route, dict):
+            final_routes.append(sector_route)
+    return final_routes
+
+
+def get_skipped_sectors(sectors):
+    # {sector key: why it has no route}, after collect_sector_routes()
+    skipped_sectors = {}
+    for sector_key, sector in sectors.items():
+        if sector is None:
+            skipped_sectors[sector_key] = SECTOR_WITHOUT_POINT
+        elif not isinstance(sector.get('route'), dict):
+            skipped_sectors[sector_key] = sector.get('route') or SECTOR_WITHOUT_GEOMETRY
+    return skipped_sectors
+
+
+def generate_sector_routes(start_lat, start_lon, start_point_id, sectors, distance_km, timer=NULL_PHASE_TIMER,
+                           budget=None):
+    """
+    Route candidates of all sectors that produced one, in sector order (see iter_sector_results() for how budget and
+    ROUND_TRIP_GOOD_ENOUGH_TOLERANCE cut it short).
+    """
+    extent = calc_round_trip_extent(start_lat, start_lon, distance_km)
+    sector_args_list = get_sector_route_args(start_point_id, sectors, extent, timer, budget=budget)
+
+    # Run the sector pipelines, each on its own pooled connection; results are put back in sector order
+    sector_results = [None] * len(sector_args_list)
+    for index, sector_route in iter_sector_results(sector_args_list, distance_km, budget):
+        sector_results[index] = sector_route
+    return collect_sector_routes(sectors, sector_args_list, sector_results)
+
+
+def pick_closest_route(final_routes, distance_km):
+    closest_route = dict(min(
+        [route for route in final_routes],
+        key=lambda route: abs((distance_km*1000) - route['length_m'])
+    ))
+    closest_route['length_m'] = int(round(closest_route['length_m']))
+    return closest_route
+
+
+_round_trip_cache = None
+
+
+def get_round_trip_cache():
+    """
+    Cache of round trip responses keyed by get_round_trip_cache_key() (road network version, start node, quantized
+    distance, KSP backend) plus any non-default output format, or None when ROUND_TRIP_CACHE_SIZE is 0. With
+    ROUND_TRIP_CACHE_ALIAS the Django cache of that alias is used instead, so all workers share it. Keys include the network version, a reloaded network never hits entries of the previous one.
+    """
+    global _round_trip_cache
+    if _round_trip_cache is None:
+        cache_size = getattr(settings, 'ROUND_TRIP_CACHE_SIZE', DEFAULT_ROUND_TRIP_CACHE_SIZE)
+        cache_ttl = getattr(settings, 'ROUND_TRIP_CACHE_TTL', DEFAULT_ROUND_TRIP_CACHE_TTL)
+        cache_alias = getattr(settings, 'ROUND_TRIP_CACHE_ALIAS', None)
+        if cache_alias:
+            _round_trip_cache = DjangoCacheAdapter(cache_alias, cache_ttl, 'round_trip')
+        elif cache_size > 0:
+            _round_trip_cache = TTLLRUCache(cache_size, cache_ttl)
+    return _round_trip_cache
+
+
+def get_round_trip_cache_key(start_point_id, distance_km, ksp_backend, dbh=None):
+    # PGR_KSP and the in-process graph may break ties between equally short paths differently, and so pick other
+    # round trips: what each backend computed is cached apart
+    return get_current_road_network_version(dbh), int(start_point_id), distance_km, ksp_backend
+
+
+def quantize_distance_km(distance_km):
+    # Requests within the same step share a cache entry, and are computed with the quantized distance
+    step = getattr(settings, 'ROUND_TRIP_CACHE_DISTANCE_STEP_KM', DEFAULT_ROUND_TRIP_CACHE_DISTANCE_STEP_KM)
+    return max(step, round(distance_km / step) * step)
+
+
+def round_trip_route_dict(route):
+    return {key: route[key] for key in ROUND_TRIP_ROUTE_KEYS}
+
+
+def serialize_round_trip(route, output_format=ROUTE_FORMAT_GEOJSON, precision=DEFAULT_ROUTE_FORMAT_PRECISION,
+                         skipped_sectors=None):
+    """
+    Payload of a picked route: ROUND_TRIP_ROUTE_KEYS as JSON, or for the "polyline" and "binary" formats the
+    stitched path (out along the first path, back along the alternative) instead of the unordered GeoJSON.
+    The JSON formats also list skipped_sectors, when given.
+    """
+    report = {} if skipped_sectors is None else {'skipped_sectors': skipped_sectors}
+    if output_format == ROUTE_FORMAT_GEOJSON:
+        return json.dumps(dict(round_trip_route_dict(route), **report))
+    path_edge_ids, alt_path_edge_ids = route['path_edge_ids']
+    points = stitch_round_trip_points(
+        path_edge_ids, alt_path_edge_ids, get_edges_points(set(path_edge_ids) | set(alt_path_edge_ids))
+    )
+    lats, lons = [lat for lat, _ in points], [lon for _, lon in points]
+    if output_format == ROUTE_FORMAT_BINARY:
+        return encode_binary_points(lats, lons, precision, route['length_m'])
+    return json.dumps(dict({
+        'polyline': encode_polyline(lats, lons, precision),
+        'precision': precision,
+        'length_m': route['length_m'],
+        'sector': route['sector']
+    }, **report))
+
+
+def format_stream_event(stream_mode, event_type, data):
+    # One NDJSON line {"type": event_type, ...data}, or one server-sent event of event_type with data as JSON
+    if stream_mode == STREAM_SSE:
+        return 'event: {}\ndata: {}\n\n'.format(event_type, json.dumps(data))
+    return json.dumps(dict(data, type=event_type)) + '\n'
+
+
+def iter_round_trip_stream(stream_mode, start_lat, start_lon, start_point_id, sectors, distance_km,
+                           timer=NULL_PHASE_TIMER, round_trip_cache=None, cache_key=None, budget=None):
+    """
+    Events of a streamed round trip: "route" for every sector route as soon as it is ready, "skipped" for sectors
+    without one (timed out ones too), then "best" with the route generate_ksp_path would have returned (null if none)
+    and the skipped sectors, and with PHASE_TIMING on a "timing" event with what Server-Timing would have been.
+    If no database connection frees up in time the stream ends with an "error" event.
+    """
+    budget = budget or RequestBudget()
+    extent = calc_round_trip_extent(start_lat, start_lon, distance_km)
+    sector_args_list = get_sector_route_args(start_point_id, sectors, extent, timer, budget=budget)
+    sector_results = [None] * len(sector_args_list)
+    try:
+        for index, sector_route in iter_sector_results(sector_args_list, distance_km, budget):
+            sector_results[index] = sector_route
+            if isinstance(sector_route, dict):
+                yield format_stream_event(stream_mode, 'route', {
+                    'route': dict(round_trip_route_dict(sector_route), length_m=int(round(sector_route['length_m'])))
+                })
+            else:
+                yield format_stream_event(stream_mode, 'skipped', {
+                    'sector': sector_args_list[index][0],
+                    'reason': sector_route or SECTOR_WITHOUT_GEOMETRY
+                })
+    except GisdbPoolExhausted:
+        # The 200 status went out with the first event, the 503 the other responses get is sent as an event instead
+        budget.cancel()
+        yield format_stream_event(stream_mode, 'error', {'status': 503, 'message': ROUND_TRIP_POOL_EXHAUSTED})
+        timer.finish()
+        return
+
+    # Best is picked in sector order like the non-streaming response, whatever order the sectors finished in
+    final_routes = collect_sector_routes(sectors, sector_args_list, sector_results)
+    best_route = round_trip_route_dict(pick_closest_route(final_routes, distance_km)) if final_routes else None
+    skipped_sectors = get_skipped_sectors(sectors)
+    if round_trip_cache is not None and SECTOR_TIMED_OUT not in skipped_sectors.values():
+        round_trip_cache.set(
+            cache_key,
+            serialize_round_trip(best_route, skipped_sectors=skipped_sectors) if best_route else ROUND_TRIP_NOT_FOUND
         )
+    yield format_stream_event(stream_mode, 'best', {'route': best_route, 'skipped_sectors': skipped_sectors})
+    # Headers went out before any sector ran, so the phase timings trail the stream instead of a Server-Timing header
+    if timer is not NULL_PHASE_TIMER:
+        yield format_stream_event(stream_mode, 'timing', {'server_timing': timer.server_timing_header()})
+    timer.finish()
 
-        ten_routes_query = """
-            SELECT seq, route, edge, geom_way FROM temp_ksp_result ORDER BY seq ASC;
-        """
 
-        # Create db connection
-        data_source_name = "host={} dbname={} user={} password={}".format(
-            settings.GISDB_HOST,
-            settings.GISDB_NAME,
-            settings.GISDB_USER,
-            settings.GISDB_PASSWORD
-        )
-        dbh = psycopg2.connect(data_source_name)
-
-        # Execute queries
-        cursor = dbh.cursor()
-        cursor.execute(temp_table_query, temp_table_query_params)
-        cursor.execute(ten_routes_query)
-
-        # Gather query results to aggregate sequences/segments
-        routes = []
-        edge_repetitions = {}
-        result_tuple = cursor.fetchone()
-        current_route, route_start_sequence = None, None
-        while result_tuple:
-            seq, route_id, edge, geom_way = result_tuple
-            seq = int(seq)
-            route_id = int(route_id)
-            # Check start of new path
-            if current_route != route_id:
-                current_route = route_id
-                route_start_sequence = seq  # Mark start of new path and use it to have all sequences 0 .. M
-            # Segments come in order of route ids: 0, 1, 2, ...; Ensure we have an array for this route
-            if len(routes) < (route_id+1):
-                routes.append([])
-            # Add segment data
-            routes[route_id].append({
-                # Ensure all sequences start from 0 per each route
-                'seq': seq - route_start_sequence,
-                'edge': edge
-            })
-            # Add to repetitions per edge counter
-            if edge not in edge_repetitions:
-                edge_repetitions[edge] = 0
-            edge_repetitions[edge] += 1
-            # Continue iterating results
-            result_tuple = cursor.fetchone()
+def round_trip_stream_response(stream_mode, events):
+    response = StreamingHttpResponse(events, content_type=STREAM_CONTENT_TYPES[stream_mode])
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'  # Keep proxies (nginx) from holding events back
+    return response
 
-        # IF NO ROUTES, then skip sector
-        if len(routes) == 0:
-            sectors[available_key]['route'] = "No routes at all for sector {}".format(available_key)
-            continue
 
-        # Calculate edges' mid-distance weights (based on "how close to middle sequence is")
-        all_mid_distance_edge_weights = {}
-        for r in routes:
-            total_sequences_in_route = len(r)
-            for segment in r:
-                edge_id = segment['edge']
-                if edge_id not in all_mid_distance_edge_weights:
-                    all_mid_distance_edge_weights[edge_id] = []
-                # total_sequences/2 is middle point
-                # abs(middle_point - seq) is "how off middle point this is"
-                # / middle point gives the offset as a 1..0..1 ratio
-                # we reduce this of 1, to have it around as 0..1..0 instead
-                weight = 1 - (abs((total_sequences_in_route/2) - segment['seq']) / (total_sequences_in_route/2))
-                all_mid_distance_edge_weights[edge_id].append(weight)
-
-        # Calculate mid-distance weight averages per each edge
-        average_mid_distance_edge_weights = {
-            edge_id: sum(all_weights)/float(len(all_weights))
-            for edge_id, all_weights
-            in all_mid_distance_edge_weights.items()
-        }
-
-        # Calculate repetition weights per each edge (based on "how many times of all routes, edge was crossed"
-        repetition_edge_weights = {
-            edge_id: counts_crossed/len(routes)
-            for edge_id, counts_crossed
-            in edge_repetitions.items()
-        }
-
-        # Apply mid-distance-ratio averages to ratio-times-crossed, to have a "dispose or not" value between 0 and 1
-        dispose_values_per_edge = [
-            {'edge_id': edge_id, 'value': repetition_ratio * average_mid_distance_edge_weights[edge_id]}
-            for edge_id, repetition_ratio
-            in repetition_edge_weights.items()
-        ]
-
-        # (Less aggressive disposing for more options)
-        # Restrict disposed edges to those found in first path
-        edge_ids_in_first_path = list(map(lambda seg: seg['edge'], routes[0]))
-        limited_dispose_values_per_edge = [
-            edge
-            for edge
-            in dispose_values_per_edge
-            if edge['edge_id'] in edge_ids_in_first_path
-        ]
-
-        disposed_edges_strings = list(map(
-            lambda e: str(e['edge_id']),
-            filter(
-                lambda e: e['value'] > DISPOSE_MARGIN,
-                limited_dispose_values_per_edge
-            )
-        ))
+def round_trip_payload_response(payload, output_format=ROUTE_FORMAT_GEOJSON):
+    if payload == ROUND_TRIP_NOT_FOUND:
+        return HttpResponseNotFound('No path available, try with other arguments.')
+    if output_format == ROUTE_FORMAT_BINARY:
+        return HttpResponse(payload, content_type=BINARY_CONTENT_TYPE)
+    return HttpResponse(payload, content_type='application/json')
 
-        # IF NOTHING DISPOSED, then skip sector
-        if len(disposed_edges_strings) == 0:
-            sectors[available_key]['route'] = "No paths disposed in sector {}".format(available_key)
-            continue
 
-        # Create temp table also for the alternative ("secondary") route, as we first check if it's valid, then UNION
-        alt_temp_table_query = """
-            CREATE 
-                TEMP TABLE temp_alternative_ksp_result
-                    ON COMMIT 
-                        DROP
-                AS SELECT 
-                seq,
-                id1 as route,
-                id2 as from_node,
-                id3 as edge,
-                geom_way,
-                result.cost as seq_cost, -- currently we calculate cost from geography but could compare to this
-                -- currently un-used properties of edge below
-                id, osm_id, osm_name, osm_meta, osm_source_id, osm_target_id, clazz, flags, source, target, km,
-                kmh, s.cost as cost, reverse_cost, x1, y1, x2, y2
-                    FROM PGR_KSP(
-                        'SELECT 
-                         s.id as id, 
-                         s.source as source, 
-                         s.target as target, 
-                         ST_Length(s.geom_way::geography) as cost
-                             FROM fi_2po_4pgr as s
-                             WHERE s.geom_way && ST_MakeEnvelope(%s, %s, %s, %s, 4326) -- within bbox
-                                AND id NOT IN (""" + ','.join(disposed_edges_strings) + """)
-                         ',
-                        %s, -- start location ("way -> source (-> id)")
-                        %s, -- end location ("round trip" -spot)
-                        1,
-                        false
-                    )
-                    AS result
-                        -- join K-S-P's result set with main table -> to retrieve (ways') geometry
-                        INNER JOIN fi_2po_4pgr AS s ON result.id3 = s.id;
-        """
-        alt_temp_table_query_params = (
-            extent_high_lon, extent_high_lat, extent_low_lon, extent_low_lat,
-            int(start_point_id),
-            int(sectors[available_key]['node_id'])
-        )
+def respond_503_on_pool_exhausted(view):
+    # No pooled GIS database connection freed up within GISDB_POOL_CHECKOUT_TIMEOUT, the server is overloaded
+    @functools.wraps(view)
+    def wrapped_view(request, *args, **kwargs):
+        try:
+            return view(request, *args, **kwargs)
+        except GisdbPoolExhausted:
+            return HttpResponse(ROUND_TRIP_POOL_EXHAUSTED, status=503)
+    return wrapped_view
 
-        one_alt_route_query = """
-            SELECT 
-            ST_AsGeoJSON(ST_UNION(geom_way)) as geojson,
-            ST_Length(ST_UNION(geom_way)::geography) as length 
-                FROM temp_alternative_ksp_result;
-        """
 
-        cursor.execute(alt_temp_table_query, alt_temp_table_query_params)
-        cursor.execute(one_alt_route_query)
+@respond_503_on_pool_exhausted
+def generate_ksp_path(request):
+    # Gather arguments
+    input_start = request.GET.get('start_coordinates', None)
+    distance_km = request.GET.get('distance_km', None)
 
-        result_tuple = cursor.fetchone()
-        geojson = None if (not result_tuple or not result_tuple[0]) else json.loads(result_tuple[0])
-        length = None if (not result_tuple or not result_tuple[1]) else result_tuple[1]
+    # Validate arguments
+    if input_start is None or ',' not in input_start:
+        return HttpResponseBadRequest('Invalid GET param "start_coordinates". Should be "lat,lon" (without quotes).')
+    elif not len(input_start.split(',')) == 2:
+        return HttpResponseBadRequest('Invalid coordinate(s) in GET param "start_coordinates". Provide both "lat,lon"')
+    elif not all(re.compile(r'^\d+([.]\d+)?$').match(c) for c in input_start.split(',')):
+        return HttpResponseBadRequest('Invalid coordinate(s) in GET param "start_coordinates". Format: "nn.mm,nn.mm"')
+    if distance_km is None:
+        return HttpResponseBadRequest('Invalid GET param "distance_km".')
+    elif not re.compile(r'^\d+([.]\d+)?$').match(distance_km):
+        return HttpResponseBadRequest('Invalid GET param "distance_km" e.g. "1", "12.3", "99"')
 
-        # IF NO ALT ROUTE, then skip sector
-        if not geojson:
-            sectors[available_key]['route'] = "Couldn't create alt route"
-            continue
+    try:
+        output_format, precision = parse_route_format_params(request.GET, ROUND_TRIP_FORMATS)
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+    stream_mode = request.GET.get('stream', None)
+    if stream_mode is not None and stream_mode not in STREAM_CONTENT_TYPES:
+        return HttpResponseBadRequest('Invalid GET param "stream", one of: {}'.format(', '.join(STREAM_CONTENT_TYPES)))
+    if stream_mode is not None and output_format != ROUTE_FORMAT_GEOJSON:
+        return HttpResponseBadRequest('GET param "stream" only streams "format=geojson" routes')
 
-        # Merge routes using ST_UNION
-        first_and_alt_route_query = """
-            SELECT 
-            ST_AsGeoJSON(ST_UNION(both_routes.geom_way)) as geojson, 
-            ST_Length(ST_UNION(both_routes.geom_way)::geography) as length
-            FROM
-            (
-                SELECT geom_way 
-                    FROM temp_ksp_result 
-                    WHERE route=0
-                UNION
-                SELECT geom_way
-                    FROM temp_alternative_ksp_result
-                    -- only 1 alt route fetched so no need a where -clause
-            ) AS both_routes;
-        """
-
-        cursor.execute(first_and_alt_route_query)
-
-        result_tuple = cursor.fetchone()
-        geojson = None if (not result_tuple or not result_tuple[0]) else json.loads(result_tuple[0])
-        length = None if (not result_tuple or not result_tuple[1]) else result_tuple[1]
-
-        # Close db connection
-        cursor.close()
-        dbh.commit()
-        dbh.close()
-
-        if geojson:
-            route_obj = {
-                'geojson': geojson,
-                'length_m': length,
-                'sector': available_key
-            }
-            sectors[available_key]['route'] = route_obj
-            final_routes.append(route_obj)
+    # Transform value arguments
+    start_lat, start_lon = map(lambda coord: float(coord), input_start.split(','))
+    distance_km = float(distance_km)
+
+    # Phase timings go out as a Server-Timing header when settings.PHASE_TIMING is on
+    timer = start_phase_timer('generate_ksp_path')
+    # Sector queries get what is left of settings.ROUND_TRIP_TIME_BUDGET, counted from here
+    budget = start_request_budget()
+
+    # One pooled connection is shared by the snapping and sector lookups of this request
+    with gisdb_connection() as dbh:
+
+        # Actual start point (nearest node)
+        with timer.phase('snap'):
+            start_point = snap_start_point(start_lat, start_lon, dbh)
+        if start_point is None:
+            return timer.finish(HttpResponseNotFound('No path available, try with other arguments.'))
+
+        # Popular origins and distances are answered from the round trip cache, when enabled
+        round_trip_cache = get_round_trip_cache()
+        if round_trip_cache is not None:
+            with timer.phase('cache'):
+                distance_km = quantize_distance_km(distance_km)
+                cache_key = get_round_trip_cache_key(
+                    start_point[2], distance_km, getattr(settings, 'KSP_BACKEND', KSP_BACKEND_SQL), dbh
+                )
+                if output_format != ROUTE_FORMAT_GEOJSON:
+                    cache_key += (output_format, precision)
+                payload = round_trip_cache.get(cache_key)
+            if payload is not None and stream_mode is not None:
+                best_route = json.loads(payload) if payload != ROUND_TRIP_NOT_FOUND else None
+                skipped_sectors = best_route.pop('skipped_sectors', {}) if best_route else {}
+                # Every phase has run already, so a cached stream still gets its Server-Timing header
+                return timer.finish(round_trip_stream_response(stream_mode, [
+                    format_stream_event(stream_mode, 'best', {'route': best_route, 'skipped_sectors': skipped_sectors})
+                ]))
+            if payload is not None:
+                return timer.finish(round_trip_payload_response(payload, output_format))
+
+        # Query destination/round trip points per sector
+        with timer.phase('sectors'):
+            sectors = select_round_trip_sectors(start_point, distance_km, dbh)
+
+    # Sector pipelines take their own connections, the one above is back in the pool by now
+    if stream_mode is not None:
+        return round_trip_stream_response(stream_mode, iter_round_trip_stream(
+            stream_mode, start_lat, start_lon, start_point[2], sectors, distance_km,
+            timer, round_trip_cache, cache_key if round_trip_cache is not None else None, budget
+        ))
+    final_routes = generate_sector_routes(start_lat, start_lon, start_point[2], sectors, distance_km, timer, budget)
+    skipped_sectors = get_skipped_sectors(sectors)
+    timed_out = SECTOR_TIMED_OUT in skipped_sectors.values()
+    if not final_routes and timed_out:
+        return timer.finish(HttpResponse(ROUND_TRIP_TIMED_OUT, status=504))
 
     # Process result
-    if len(final_routes) == 0:
-        return HttpResponseNotFound('No path available, try with other arguments.')
-    else:
-        closest_route = min(
-            [route for route in final_routes],
-            key=lambda route: abs((distance_km*1000) - route['length_m'])
-        )
-        closest_route['length_m'] = int(round(closest_route['length_m']))
-        return HttpResponse(json.dumps(closest_route), content_type='application/json')
+    with timer.phase('serialize'):
+        payload = serialize_round_trip(
+            pick_closest_route(final_routes, distance_km), output_format, precision, skipped_sectors
+        ) if final_routes else ROUND_TRIP_NOT_FOUND
+    # Results cut short by the time budget are not cached, the next request may well get every sector done
+    if round_trip_cache is not None and not timed_out:
+        round_trip_cache.set(cache_key, payload)
+    return timer.finish(round_trip_payload_response(payload, output_format))
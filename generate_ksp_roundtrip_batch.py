@@ -0,0 +1,197 @@
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseBadRequest
+import json
+import re
+
+from ..app_lib_db import gisdb_connection
+from ..app_lib_graph import load_road_graph
+from ..app_lib_timing import start_phase_timer
+from ..app_lib_budget import start_request_budget
+from .generate_ksp_roundtrip import snap_start_points, select_round_trip_sectors, calc_round_trip_extent, \
+    get_sector_route_args, generate_sector_route, iter_sector_pipelines_as_completed, is_good_enough_route, \
+    collect_sector_routes, pick_closest_route, round_trip_route_dict, serialize_round_trip, get_skipped_sectors, \
+    get_round_trip_cache, get_round_trip_cache_key, quantize_distance_km, respond_503_on_pool_exhausted, \
+    ROUND_TRIP_NOT_FOUND, ROUND_TRIP_TIMED_OUT, SECTOR_TIMED_OUT, SECTOR_STOPPED_EARLY, KSP_BACKEND_SQL, \
+    KSP_BACKEND_GRAPH, DEFAULT_SECTOR_CONCURRENCY
+
+
+MAX_BATCH_ITEMS = 100
+DEFAULT_BATCH_GROUP_SIZE = 16  # Most round trips sharing one extracted subgraph
+NO_PATH_AVAILABLE = 'No path available, try with other arguments.'
+
+
+def parse_batch_items(trips_param):
+    """
+    "lat,lon,distance_km;lat,lon,distance_km;..." -> [(trip, (lat, lon, distance_km) or an error message), ...]
+    """
+    number = re.compile(r'^\d+([.]\d+)?$')
+    items = []
+    for trip in trips_param.split(';'):
+        values = trip.split(',')
+        if len(values) != 3 or not all(number.match(value) for value in values):
+            items.append((trip, 'Invalid trip "{}", format: "nn.mm,nn.mm,km"'.format(trip)))
+        else:
+            items.append((trip, tuple(float(value) for value in values)))
+    return items
+
+
+def extents_overlap(extent, other_extent):
+    # Extents as (x, y, x, y) of two opposite corners
+    return (
+        min(extent[0], extent[2]) <= max(other_extent[0], other_extent[2])
+        and min(other_extent[0], other_extent[2]) <= max(extent[0], extent[2])
+        and min(extent[1], extent[3]) <= max(other_extent[1], other_extent[3])
+        and min(other_extent[1], other_extent[3]) <= max(extent[1], extent[3])
+    )
+
+
+def union_extent(extents):
+    return (
+        max(max(extent[0], extent[2]) for extent in extents),
+        max(max(extent[1], extent[3]) for extent in extents),
+        min(min(extent[0], extent[2]) for extent in extents),
+        min(min(extent[1], extent[3]) for extent in extents)
+    )
+
+
+def group_overlapping_extents(extents, max_group_size):
+    """
+    Greedily group indices of extents: an extent joins the first group whose union extent it overlaps.
+    Returns [(group union extent, [indices])].
+    """
+    groups = []
+    for i, extent in enumerate(extents):
+        for group_index, (group_extent, indices) in enumerate(groups):
+            if len(indices) < max_group_size and extents_overlap(extent, group_extent):
+                groups[group_index] = (union_extent([group_extent, extent]), indices + [i])
+                break
+        else:
+            groups.append((extent, [i]))
+    return groups
+
+
+def batch_result(item, route=None, error=None):
+    # The trip as requested, also its start coordinates and distance unless it couldn't be parsed
+    trip, values = item
+    result = {'trip': trip}
+    if not isinstance(values, str):
+        result['start_coordinates'] = trip.rsplit(',', 1)[0]
+        result['distance_km'] = values[2]
+    if error is not None:
+        result['error'] = error
+    else:
+        result['route'] = route
+    return result
+
+
+# Returns {'results': [{'trip', 'start_coordinates', 'distance_km', 'route': <as generate_ksp_path>}
+#                      or {.., 'error'}, ..]}, each echoing its trip as requested
+# GET param "trips" is "lat,lon,distance_km;lat,lon,distance_km;..." (at most MAX_BATCH_ITEMS), results in that order
+@respond_503_on_pool_exhausted
+def generate_ksp_paths(request):
+    trips_param = request.GET.get('trips', None)
+    if not trips_param:
+        return HttpResponseBadRequest('Invalid GET param "trips". Should be "lat,lon,distance_km;..." (without quotes).')
+    items = parse_batch_items(trips_param)
+    if len(items) > MAX_BATCH_ITEMS:
+        return HttpResponseBadRequest('At most {} "trips" per request'.format(MAX_BATCH_ITEMS))
+
+    timer = start_phase_timer('generate_ksp_paths')
+    # One deadline for the whole batch, settings.ROUND_TRIP_TIME_BUDGET as for a single round trip, counted from here
+    batch_budget = start_request_budget()
+    results = [batch_result(item, error=item[1]) if isinstance(item[1], str) else None for item in items]
+    pending = [i for i, item in enumerate(items) if results[i] is None]
+    round_trip_cache = get_round_trip_cache()
+    start_points, distances_km, cache_keys, sectors = {}, {}, {}, {}
+
+    # One pooled connection for snapping (in one query), cache lookups and sector selection of all items
+    with gisdb_connection() as dbh:
+        with timer.phase('snap'):
+            snapped = snap_start_points([items[i][1][:2] for i in pending], dbh)
+        for i, start_point in zip(pending, snapped):
+            if start_point is None:
+                results[i] = batch_result(items[i], error=NO_PATH_AVAILABLE)
+                continue
+            start_points[i] = start_point
+            # Computed with the quantized distance when cached, results still echo the requested one
+            distances_km[i] = items[i][1][2]
+            if round_trip_cache is not None:
+                distances_km[i] = quantize_distance_km(distances_km[i])
+                # Computed on a graph whatever KSP_BACKEND is, see below
+                cache_keys[i] = get_round_trip_cache_key(start_point[2], distances_km[i], KSP_BACKEND_GRAPH, dbh)
+                with timer.phase('cache'):
+                    payload = round_trip_cache.get(cache_keys[i])
+                if payload is not None:
+                    results[i] = batch_result(items[i], error=NO_PATH_AVAILABLE) if payload == ROUND_TRIP_NOT_FOUND \
+                        else batch_result(items[i], route=json.loads(payload))
+                    continue
+            with timer.phase('sectors'):
+                sectors[i] = select_round_trip_sectors(start_point, distances_km[i], dbh)
+
+    # Round trips with overlapping extents share one subgraph, extracted once instead of by every PGR_KSP call
+    pending = sorted(sectors.keys())
+    extents = [calc_round_trip_extent(start_points[i][0], start_points[i][1], distances_km[i]) for i in pending]
+    max_group_size = getattr(settings, 'ROUND_TRIP_BATCH_GROUP_SIZE', DEFAULT_BATCH_GROUP_SIZE)
+    for group_extent, group in group_overlapping_extents(extents, max_group_size):
+        # With KSP_BACKEND "sql" too, paths come from Yen's on the extracted subgraph rather than PGR_KSP, which is
+        # why the cache keys above say "graph"
+        graph = None
+        if getattr(settings, 'KSP_BACKEND', KSP_BACKEND_SQL) != KSP_BACKEND_GRAPH and not batch_budget.is_exhausted():
+            with timer.phase('subgraph'):
+                graph = load_road_graph(extent=group_extent)
+
+        # Round trips share what is left of the batch deadline, each in a sub budget of its own so that it can be
+        # stopped early alone. Sectors still unfinished when the deadline passes are given up on as in
+        # generate_ksp_path: cancelling batch_budget cancels their queries and graph searches
+        budgets = {pending[g]: batch_budget.sub_budget() for g in group}
+        sector_args_lists = [
+            get_sector_route_args(
+                start_points[pending[g]][2], sectors[pending[g]], extents[g], timer, graph, budgets[pending[g]]
+            )
+            for g in group
+        ]
+        sector_items = [pending[g] for g, sector_args_list in zip(group, sector_args_lists) for _ in sector_args_list]
+
+        # All sectors of the group's round trips in parallel, results put back in order. Like generate_ksp_path,
+        # a round trip stops once one of its routes is good enough: its other sectors are cancelled
+        sector_results = [None] * len(sector_items)
+        stopped_early = set()
+        for index, sector_route in iter_sector_pipelines_as_completed(
+            generate_sector_route,
+            [sector_args for sector_args_list in sector_args_lists for sector_args in sector_args_list],
+            getattr(settings, 'ROUND_TRIP_BATCH_CONCURRENCY', DEFAULT_SECTOR_CONCURRENCY),
+            batch_budget
+        ):
+            i = sector_items[index]
+            if i in stopped_early and sector_route == SECTOR_TIMED_OUT:
+                sector_route = SECTOR_STOPPED_EARLY
+            sector_results[index] = sector_route
+            if i not in stopped_early and is_good_enough_route(sector_route, distances_km[i]):
+                stopped_early.add(i)
+                budgets[i].cancel()
+
+        for g, sector_args_list in zip(group, sector_args_lists):
+            i = pending[g]
+            final_routes = collect_sector_routes(sectors[i], sector_args_list, sector_results[:len(sector_args_list)])
+            sector_results = sector_results[len(sector_args_list):]
+            closest_route = pick_closest_route(final_routes, distances_km[i]) if final_routes else None
+            skipped_sectors = get_skipped_sectors(sectors[i])
+            timed_out = SECTOR_TIMED_OUT in skipped_sectors.values()
+            if not closest_route and timed_out:
+                results[i] = batch_result(items[i], error=ROUND_TRIP_TIMED_OUT)
+                continue
+            # Same payload as generate_ksp_path caches, so with KSP_BACKEND "graph" either view can answer from the
+            # other's entries. Round trips cut short by their time budget are not cached
+            if round_trip_cache is not None and not timed_out:
+                round_trip_cache.set(
+                    cache_keys[i],
+                    serialize_round_trip(closest_route, skipped_sectors=skipped_sectors) if closest_route
+                    else ROUND_TRIP_NOT_FOUND
+                )
+            results[i] = batch_result(
+                items[i], route=dict(round_trip_route_dict(closest_route), skipped_sectors=skipped_sectors)
+            ) if closest_route else batch_result(items[i], error=NO_PATH_AVAILABLE)
+
+    with timer.phase('serialize'):
+        payload = json.dumps({'results': results})
+    return timer.finish(HttpResponse(payload, content_type='application/json'))
@@ -0,0 +1,266 @@
+"""
+Round trip benchmark on synthetic road networks (see app_lib_benchmark), or on the configured road network.
+
+Requests go through the generate_ksp_roundtrip view's own pipeline (snap_start_point, select_round_trip_sectors,
+generate_sector_routes, pick_closest_route), only its response cache is left out. On a synthetic network ("grid",
+"geometric") no database or network access is needed: the view runs on its in-process backends (NEAREST_NODE_BACKEND
+"index", KSP_BACKEND "graph", SECTOR_SELECTION_MODE "ranked") given the synthetic network, and the one query left, the
+ST_UNION merge, is stood in for by the merged edges' segments and summed costs. On "database" the view runs as
+configured in settings (any backend and sector selection mode) against fi_2po_4pgr.
+
+Latencies are measured first, memory (tracemalloc) in a separate pass over the same requests, so that tracing
+doesn't slow down the timed pass.
+"""
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, ExitStack
+from unittest import mock
+import json
+import math
+import time
+import numpy as np
+
+from ... import app_lib_graph, app_lib_spatial
+from ...app_lib_benchmark import build_network, measure_peak_bytes, summarize_seconds, compare_to_baseline, \
+    PhaseRecorder, NETWORK_KINDS, SYNTHETIC_NETWORK_KINDS, PHASES, DEFAULT_CENTER_LAT, DEFAULT_CENTER_LON, \
+    METRES_PER_DEGREE_LAT
+from ...app_lib_budget import start_request_budget
+from ...views import generate_ksp_roundtrip
+from ...views.generate_ksp_roundtrip import snap_start_point, select_round_trip_sectors, generate_sector_routes, \
+    pick_closest_route, KSP_BACKEND_GRAPH, NEAREST_NODE_BACKEND_INDEX, SECTOR_SELECTION_RANKED, \
+    DEFAULT_SECTOR_CONCURRENCY, KSP_BACKEND_SQL, NEAREST_NODE_BACKEND_SQL, SECTOR_SELECTION_SCAN
+
+
+class _OfflineConnection:
+    # Stands in for the pooled connections the view checks out, nothing queries it offline
+
+    def cancel(self):
+        pass
+
+
+@contextmanager
+def offline_connection(dbh=None):
+    yield dbh if dbh is not None else _OfflineConnection()
+
+
+@contextmanager
+def offline_backends(graph, node_index):
+    """
+    Run the generate_ksp_roundtrip view on its in-process backends, given graph and node_index instead of ones
+    loaded from fi_2po_4pgr, for the duration of the block.
+    """
+    def edges_union_geojson_and_length(edge_ids, dbh=None):
+        # ST_UNION stand-in: every edge as a straight segment, the length is the sum of the edges' costs
+        edges = graph.edge_indices(edge_ids)
+        sources, targets = graph.edge_source[edges], graph.edge_target[edges]
+        coordinates = np.stack((
+            np.stack((graph.node_lon[sources], graph.node_lat[sources]), axis=1),
+            np.stack((graph.node_lon[targets], graph.node_lat[targets]), axis=1)
+        ), axis=1)
+        geojson = json.dumps({'type': 'MultiLineString', 'coordinates': coordinates.tolist()})
+        return geojson, float(graph.edge_cost[edges].sum())
+
+    with ExitStack() as stack:
+        stack.enter_context(override_settings(
+            KSP_BACKEND=KSP_BACKEND_GRAPH,
+            NEAREST_NODE_BACKEND=NEAREST_NODE_BACKEND_INDEX,
+            SECTOR_SELECTION_MODE=SECTOR_SELECTION_RANKED,
+            ROAD_GRAPH_SNAPSHOT_DIR=None,
+            ROUND_TRIP_TIME_BUDGET=None
+        ))
+        for module, name, value in (
+            (app_lib_graph, '_road_graph', graph),
+            (app_lib_graph, 'get_current_road_network_version', lambda dbh=None: graph.version),
+            (app_lib_spatial, '_node_index', node_index),
+            (app_lib_spatial, 'get_current_road_network_version', lambda dbh=None: node_index.version),
+            (generate_ksp_roundtrip, 'gisdb_connection', offline_connection),
+            (generate_ksp_roundtrip, 'get_edges_union_geojson_and_length', edges_union_geojson_and_length)
+        ):
+            stack.enter_context(mock.patch.object(module, name, value))
+        yield
+
+
+def run_round_trip(start_lat, start_lon, distance_km, timer):
+    """
+    One round trip the way the generate_ksp_path view computes it (without its cache), phases timed on timer.
+    Returns the picked route's length in metres, or None.
+    """
+    budget = start_request_budget()
+    with generate_ksp_roundtrip.gisdb_connection() as dbh:
+        with timer.phase('snap'):
+            start_point = snap_start_point(start_lat, start_lon, dbh)
+        if start_point is None:
+            return None
+        with timer.phase('sectors'):
+            sectors = select_round_trip_sectors(start_point, distance_km, dbh)
+    final_routes = generate_sector_routes(start_lat, start_lon, start_point[2], sectors, distance_km, timer, budget)
+    if not final_routes:
+        return None
+    return pick_closest_route(final_routes, distance_km)['length_m']
+
+
+def run_workload(starts, distance_km, workers, timer):
+    # run_round_trip() from every start, workers requests at a time; returns (lengths, seconds per request)
+    request_seconds = []
+
+    def timed_request(start):
+        request_started = time.perf_counter()
+        length = run_round_trip(start[0], start[1], distance_km, timer)
+        request_seconds.append(time.perf_counter() - request_started)
+        return length
+
+    if workers <= 1:
+        return [timed_request(start) for start in starts], request_seconds
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(timed_request, starts)), request_seconds
+
+
+def run_benchmark(kind='grid', size_km=20, distances_km=(5, 10, 20), requests=20, concurrency=(1, 4),
+                  node_count=40000, seed=0, landmark_count=0, center_lat=DEFAULT_CENTER_LAT,
+                  center_lon=DEFAULT_CENTER_LON):
+    """
+    Run "requests" round trips per distance and concurrency level from random start points around the middle of
+    the network: a synthetic one built first (with ALT preprocessing of landmark_count landmarks, if any), or for
+    kind "database" fi_2po_4pgr around (center_lat, center_lon).
+    Returns a JSON-serializable report.
+    """
+    if kind not in NETWORK_KINDS:
+        raise ValueError('Network kind must be one of {}'.format(NETWORK_KINDS))
+
+    random = np.random.RandomState(seed)
+    with ExitStack() as stack:
+        if kind in SYNTHETIC_NETWORK_KINDS:
+            build_started = time.perf_counter()
+            graph, node_index = build_network(kind, size_km, node_count, seed, landmark_count)
+            build_seconds = time.perf_counter() - build_started
+            build_peak = measure_peak_bytes(build_network, kind, size_km, node_count, seed, landmark_count)
+            stack.enter_context(offline_backends(graph, node_index))
+            network = {
+                'nodes': len(graph.node_id),
+                'edges': len(graph.edge_id),
+                'graph_bytes': sum(array.nbytes for array in graph.arrays.values()),
+                'build_seconds': build_seconds,
+                'build_peak_bytes': build_peak
+            }
+            center_lat, center_lon = float(np.median(graph.node_lat)), float(np.median(graph.node_lon))
+            spread_lat = (graph.node_lat.max() - graph.node_lat.min()) / 8
+            spread_lon = (graph.node_lon.max() - graph.node_lon.min()) / 8
+        else:
+            network = {}
+            spread_lat = size_km * 1000 / 8 / METRES_PER_DEGREE_LAT
+            spread_lon = spread_lat / math.cos(math.radians(center_lat))
+        network.update({
+            'kind': kind,
+            'size_km': size_km,
+            'landmarks': landmark_count,
+            'ksp_backend': getattr(settings, 'KSP_BACKEND', KSP_BACKEND_SQL),
+            'nearest_node_backend': getattr(settings, 'NEAREST_NODE_BACKEND', NEAREST_NODE_BACKEND_SQL),
+            'sector_selection_mode': getattr(settings, 'SECTOR_SELECTION_MODE', SECTOR_SELECTION_SCAN),
+            'sector_concurrency': getattr(settings, 'KSP_SECTOR_CONCURRENCY', DEFAULT_SECTOR_CONCURRENCY)
+        })
+        report = {'network': network, 'workloads': []}
+
+        # Warm-up, lazily loaded backends (graph, node index, connection pool) aren't counted in the first request
+        run_round_trip(center_lat, center_lon, distances_km[0], PhaseRecorder({}))
+
+        for distance_km in distances_km:
+            for workers in concurrency:
+                starts = list(zip(
+                    random.uniform(center_lat - spread_lat, center_lat + spread_lat, requests).tolist(),
+                    random.uniform(center_lon - spread_lon, center_lon + spread_lon, requests).tolist()
+                ))
+                phase_seconds = {phase: [] for phase in PHASES}
+
+                workload_started = time.perf_counter()
+                lengths, request_seconds = run_workload(starts, distance_km, workers, PhaseRecorder(phase_seconds))
+                wall_seconds = time.perf_counter() - workload_started
+                peak_bytes = measure_peak_bytes(run_workload, starts, distance_km, workers, PhaseRecorder({}))
+
+                report['workloads'].append({
+                    'distance_km': distance_km,
+                    'concurrency': workers,
+                    'requests': requests,
+                    'found': sum(1 for length in lengths if length is not None),
+                    'requests_per_second': requests / wall_seconds if wall_seconds else None,
+                    'request': summarize_seconds(request_seconds),
+                    'phases': {phase: summarize_seconds(seconds) for phase, seconds in phase_seconds.items()},
+                    'peak_bytes': peak_bytes
+                })
+    return report
+
+
+class Command(BaseCommand):
+    help = 'Benchmark round trip generation through the generate_ksp_path pipeline, offline on a synthetic road ' \
+           'network with the in-process backends or ("--kind database") on fi_2po_4pgr as configured in settings, ' \
+           'reporting per-phase latency percentiles, throughput and memory'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--kind', choices=NETWORK_KINDS, default='grid')
+        parser.add_argument('--size-km', type=float, default=20, help='Network size, on "database" where to start from')
+        parser.add_argument('--center-lat', type=float, default=DEFAULT_CENTER_LAT, help='Middle of "database" starts')
+        parser.add_argument('--center-lon', type=float, default=DEFAULT_CENTER_LON, help='Middle of "database" starts')
+        parser.add_argument('--nodes', type=int, default=40000, help='Node count of geometric networks')
+        parser.add_argument('--distances', default='5,10,20', help='Comma separated round trip distances (km)')
+        parser.add_argument('--requests', type=int, default=20, help='Requests per distance and concurrency')
+        parser.add_argument('--concurrency', default='1,4', help='Comma separated worker thread counts')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--landmarks', type=int, default=0, help='ALT landmarks to preprocess, 0 for Dijkstra')
+        parser.add_argument('--output', help='Write the JSON report here, e.g. to use as a later --baseline')
+        parser.add_argument('--baseline', help='JSON report of an earlier run to compare against')
+
+    def handle(self, *args, **options):
+        try:
+            distances_km = [float(distance) for distance in options['distances'].split(',')]
+            concurrency = [int(workers) for workers in options['concurrency'].split(',')]
+        except ValueError:
+            raise CommandError('--distances and --concurrency take comma separated numbers')
+
+        report = run_benchmark(
+            kind=options['kind'],
+            size_km=options['size_km'],
+            distances_km=distances_km,
+            requests=options['requests'],
+            concurrency=concurrency,
+            node_count=options['nodes'],
+            seed=options['seed'],
+            landmark_count=options['landmarks'],
+            center_lat=options['center_lat'],
+            center_lon=options['center_lon']
+        )
+
+        network = report['network']
+        if network['kind'] in SYNTHETIC_NETWORK_KINDS:
+            self.stdout.write(
+                '{kind} network {size_km}km ({landmarks} landmarks): {nodes} nodes, {edges} edges, {graph_bytes} bytes '
+                'of arrays, built in {build_seconds:.2f}s (peak {build_peak_bytes} bytes)'.format(**network)
+            )
+        self.stdout.write(
+            'ksp backend {ksp_backend}, nearest node backend {nearest_node_backend}, sector selection '
+            '{sector_selection_mode}, {sector_concurrency} sectors at a time'.format(**network)
+        )
+        for workload in report['workloads']:
+            self.stdout.write(
+                '{distance_km}km x{concurrency}: {found}/{requests} found, {requests_per_second:.2f} req/s, '
+                'peak {peak_bytes} bytes'.format(**workload)
+            )
+            for phase in ('request',) + PHASES:
+                summary = workload['request'] if phase == 'request' else workload['phases'][phase]
+                if summary:
+                    self.stdout.write(
+                        '  {:<8} n={count:<5} p50={p50_ms:.2f}ms p90={p90_ms:.2f}ms p99={p99_ms:.2f}ms'
+                        .format(phase, **summary)
+                    )
+
+        if options['baseline']:
+            with open(options['baseline']) as baseline_file:
+                comparisons = compare_to_baseline(report, json.load(baseline_file))
+            for comparison in comparisons:
+                self.stdout.write(
+                    'vs baseline {distance_km}km x{concurrency}: p50 x{p50_ratio:.2f}, p99 x{p99_ratio:.2f}, '
+                    'throughput x{throughput_ratio:.2f}'.format(**comparison)
+                )
+        if options['output']:
+            with open(options['output'], 'w') as output_file:
+                json.dump(report, output_file, indent=2)
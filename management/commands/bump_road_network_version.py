@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from ...app_lib_sql import bump_road_network_version
+
+
+class Command(BaseCommand):
+    help = 'Mark fi_2po_4pgr as changed after editing it in place, so workers rebuild their road graph, node index ' \
+           'and caches. A re-import (osm2po recreating the table) changes the road network version by itself'
+
+    def handle(self, *args, **options):
+        version = bump_road_network_version()
+        self.stdout.write(self.style.SUCCESS('Done, road network version is now {}'.format(version)))
@@ -0,0 +1,45 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from ...app_lib_graph import load_road_graph, export_road_graph_snapshot, DEFAULT_SNAPSHOTS_KEPT, \
+    DEFAULT_LANDMARK_COUNT
+from ...app_lib_sql import get_road_network_version
+
+
+class Command(BaseCommand):
+    help = 'Export fi_2po_4pgr as a memory-mapped road graph snapshot that all workers share, run after every ' \
+           'road network re-import. Workers swap to it without a restart when settings.ROAD_GRAPH_SNAPSHOT_DIR is set'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dir',
+            default=getattr(settings, 'ROAD_GRAPH_SNAPSHOT_DIR', None),
+            help='Snapshot directory (default settings.ROAD_GRAPH_SNAPSHOT_DIR)'
+        )
+        parser.add_argument(
+            '--keep',
+            type=int,
+            default=DEFAULT_SNAPSHOTS_KEPT,
+            help='How many of the newest snapshots to keep'
+        )
+        parser.add_argument(
+            '--landmarks',
+            type=int,
+            default=getattr(settings, 'ROAD_GRAPH_LANDMARK_COUNT', DEFAULT_LANDMARK_COUNT),
+            help='ALT landmarks to preprocess for goal-directed path queries, 0 for none'
+        )
+
+    def handle(self, *args, **options):
+        if not options['dir']:
+            raise CommandError('No snapshot directory, give --dir or set ROAD_GRAPH_SNAPSHOT_DIR')
+        if options['keep'] < 1:
+            raise CommandError('--keep must be at least 1')
+        graph = load_road_graph(version=get_road_network_version())
+        if options['landmarks'] > 0:
+            graph = graph.with_landmarks(options['landmarks'])
+        snapshot_name = export_road_graph_snapshot(graph, options['dir'], options['keep'])
+        self.stdout.write(self.style.SUCCESS(
+            'Done, {} with {} edges, {} nodes and {} landmarks for road network version {}'.format(
+                snapshot_name, len(graph.edge_id), len(graph.node_id), options['landmarks'], graph.version
+            )
+        ))
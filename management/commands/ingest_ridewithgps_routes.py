@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from ...app_lib_ridewithgps_ingest import ingest_routes, search_route_references, \
+    DEFAULT_INGEST_WORKERS, DEFAULT_INGEST_RETRIES, DEFAULT_INGEST_BATCH_SIZE
+
+
+class Command(BaseCommand):
+    help = 'Bulk fetch RideWithGPS routes/trips into the Route table, by reference ("route:123", "trip:456") ' \
+           'and/or by a search query'
+
+    def add_arguments(self, parser):
+        parser.add_argument('references', nargs='*')
+        parser.add_argument('--keywords', default='')
+        parser.add_argument('--start-location', default='')
+        parser.add_argument('--start-distance', default='')
+        parser.add_argument('--length-min', default='')
+        parser.add_argument('--length-max', default='')
+        parser.add_argument('--limit', type=int, default=100, help='Maximum search results to ingest')
+        parser.add_argument('--workers', type=int, default=DEFAULT_INGEST_WORKERS)
+        parser.add_argument('--retries', type=int, default=DEFAULT_INGEST_RETRIES)
+        parser.add_argument('--batch-size', type=int, default=DEFAULT_INGEST_BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        references = list(options['references'])
+        if options['keywords'] or options['start_location']:
+            references += search_route_references({
+                'keywords': options['keywords'],
+                'start_location': options['start_location'],
+                'start_distance': options['start_distance'],
+                'length_min': options['length_min'],
+                'length_max': options['length_max'],
+                'limit': options['limit']
+            }, options['limit'])
+        if not references:
+            raise CommandError('Give route references and/or a search (--keywords / --start-location)')
+
+        stats = ingest_routes(references, options['workers'], options['retries'], options['batch_size'])
+        self.stdout.write(
+            'Requested {requested}, already stored {already_stored}, fetched {fetched}, written {written}, '
+            'conflicts {conflicts}, invalid {invalid}, failed {failed}'.format(**stats)
+        )
+        self.stdout.write(self.style.SUCCESS(
+            '{:.1f}s, {:.1f} routes/s'.format(stats['seconds'], stats['routes_per_second'])
+        ))
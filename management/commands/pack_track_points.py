@@ -0,0 +1,68 @@
+"""
+Data migration of Route.track_points into track_points_packed / track_points_importance.
+
+The app's migrations package is not part of this tree, so the schema change itself (the two BinaryFields,
+nullable track_points, the (external_system, external_id) unique_together and the two bounding box indexes) is
+generated with makemigrations and applied first. Duplicate (external_system, external_id) rows have to be removed
+before that, or the unique constraint can't be created.
+
+The conversion is this command rather than a RunPython migration: rows not converted yet are still read from their
+JSON, so it can run in batches of short transactions while the site keeps serving, and be interrupted and rerun.
+Rows that fail to convert are reported and left as they are.
+"""
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Q
+
+from ...models import Route
+
+
+class Command(BaseCommand):
+    help = 'Convert legacy JSON Route.track_points into the packed binary format (track_points_packed) ' \
+           'and precompute level-of-detail importance (track_points_importance) where missing'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        converted = 0
+        failed_ids = []
+        last_id = 0
+        while True:
+            # Walk by id, so rows that failed (and still match the filter) are not taken again
+            with transaction.atomic():
+                batch = list(
+                    Route.objects
+                    .filter(
+                        Q(track_points_packed__isnull=True, track_points__isnull=False)
+                        | Q(track_points_importance__isnull=True, track_points_packed__isnull=False)
+                    )
+                    .filter(id__gt=last_id)
+                    .only('id', 'track_points', 'track_points_packed', 'track_points_importance')
+                    .order_by('id')[:batch_size]
+                )
+                if not batch:
+                    break
+                for route in batch:
+                    # Savepoint per row, a failing row is rolled back alone and skipped
+                    try:
+                        with transaction.atomic():
+                            route.pack_track_points()
+                            Route.objects.filter(id=route.id).update(
+                                track_points_packed=route.track_points_packed,
+                                track_points_importance=route.track_points_importance,
+                                track_points=None
+                            )
+                    except Exception as e:
+                        failed_ids.append(route.id)
+                        self.stderr.write('Skipped route {}: {}'.format(route.id, e))
+                        continue
+                    converted += 1
+            last_id = batch[-1].id
+            self.stdout.write('Packed track points of {} routes'.format(converted))
+        if failed_ids:
+            self.stderr.write('{} routes could not be converted: {}'.format(
+                len(failed_ids), ', '.join(str(route_id) for route_id in failed_ids)
+            ))
+        self.stdout.write(self.style.SUCCESS('Done, {} routes converted'.format(converted)))
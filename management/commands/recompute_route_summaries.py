@@ -0,0 +1,64 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Q
+import time
+
+from ...models import Route
+from ...app_lib_track_analytics import calculate_track_summaries, get_track_arrays, TRACK_SUMMARY_FIELDS, \
+    DEFAULT_ELEVATION_SMOOTHING_WINDOW_M
+
+
+class Command(BaseCommand):
+    help = 'Recompute Route distance, elevation gain/loss, bounding box and first/last points from the stored ' \
+           'track points, a batch of routes at a time'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument(
+            '--window-m',
+            type=float,
+            default=getattr(settings, 'ELEVATION_SMOOTHING_WINDOW_M', DEFAULT_ELEVATION_SMOOTHING_WINDOW_M),
+            help='Elevation smoothing window, metres of track'
+        )
+        parser.add_argument('--user-created', action='store_true', help='Only routes having a creator')
+
+    def handle(self, *args, **options):
+        routes = Route.objects.filter(Q(track_points__isnull=False) | Q(track_points_packed__isnull=False))
+        if options['user_created']:
+            routes = routes.filter(creator__isnull=False)
+        last_id, updated, skipped, point_count = 0, 0, 0, 0
+        compute_seconds = 0.0
+        while True:
+            # Keyset pagination, the updated rows still match the filter
+            batch = list(
+                routes.filter(id__gt=last_id)
+                .only('id', 'track_points', 'track_points_packed')
+                .order_by('id')[:options['batch_size']]
+            )
+            if not batch:
+                break
+            last_id = batch[-1].id
+
+            tracks = [get_track_arrays(route.get_track_points()) for route in batch]
+            compute_started = time.time()
+            summaries = calculate_track_summaries(tracks, options['window_m'])
+            compute_seconds += time.time() - compute_started
+            point_count += sum(len(track[0]) for track in tracks)
+
+            with transaction.atomic():
+                for route, summary in zip(batch, summaries):
+                    if summary is None:
+                        skipped += 1
+                        continue
+                    route.set_track_summary(summary)
+                    Route.objects.filter(id=route.id).update(
+                        **{field: getattr(route, field) for field in TRACK_SUMMARY_FIELDS}
+                    )
+                    updated += 1
+            self.stdout.write('Recomputed {} routes ({} without coordinates)'.format(updated, skipped))
+        self.stdout.write(self.style.SUCCESS(
+            'Done, {} routes updated, {} points analysed at {:.0f} points/s'.format(
+                updated, point_count, point_count / compute_seconds if compute_seconds else 0
+            )
+        ))
@@ -0,0 +1,24 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from ...app_lib_sql import refresh_ksp_edge_tiles, DEFAULT_KSP_EDGE_TILE_SIZE_DEG
+
+
+class Command(BaseCommand):
+    help = 'Precompute geodesic edge costs of fi_2po_4pgr into tiles (ksp_edge_tiles) for the SQL KSP queries, ' \
+           'run after every road network re-import. Used when settings.KSP_EDGE_TILES is on'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--tile-size',
+            type=float,
+            default=getattr(settings, 'KSP_EDGE_TILE_SIZE_DEG', DEFAULT_KSP_EDGE_TILE_SIZE_DEG),
+            help='Tile width and height in degrees'
+        )
+
+    def handle(self, *args, **options):
+        meta = refresh_ksp_edge_tiles(options['tile_size'])
+        self.stdout.write(self.style.SUCCESS(
+            'Done, {edge_count} edges in {tile_size} degree tiles for road network version {network_version}'
+            .format(**meta)
+        ))
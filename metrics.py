@@ -0,0 +1,34 @@
+from django.http import HttpResponse
+import json
+
+from ..app_lib_db import get_gisdb_pool_metrics
+from ..app_lib_timing import get_phase_timing_metrics, render_phase_timing_prometheus
+from . import ridewithgps, generate_ksp_roundtrip
+
+
+def get_component_metrics():
+    # The module globals as they are, reporting must not create the caches (or the pool) itself
+    search_cache = ridewithgps._search_cache
+    round_trip_cache = generate_ksp_roundtrip._round_trip_cache
+    return {
+        'gisdb_pool': get_gisdb_pool_metrics(),
+        'ridewithgps_search_cache': search_cache.stats() if search_cache is not None else None,
+        'round_trip_cache': round_trip_cache.stats() if round_trip_cache is not None else None
+    }
+
+
+# Returns {'phase_timing': <see app_lib_timing.get_phase_timing_metrics()>, 'gisdb_pool': .., '..._cache': ..}
+# Components not created yet in this process (pool, caches) are null, as is the round trip cache when disabled
+# GET param "format=prometheus" returns the same as Prometheus text exposition, for scraping
+def get_metrics(request):
+    if request.GET.get('format', None) == 'prometheus':
+        lines = [render_phase_timing_prometheus()]
+        for component, metrics in get_component_metrics().items():
+            for name, value in sorted((metrics or {}).items()):
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    lines.append('{}_{} {}\n'.format(component, name, value))
+        return HttpResponse(''.join(lines), content_type='text/plain; version=0.0.4')
+    return HttpResponse(json.dumps(dict(
+        get_component_metrics(),
+        phase_timing=get_phase_timing_metrics()
+    ), indent=4), content_type='application/json')
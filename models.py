@@ -4,7 +4,12 @@ https://docs.djangoproject.com/en/1.11/ref/models/fields/
 """
 from django.db import models
 import json
+import numpy as np
 from .app_lib import truncate_coordinate_to_8_decimal_float
+from .app_lib_track_points import encode_track_points, decode_track_points, iter_track_points_json
+from .app_lib_track_lod import calculate_douglas_peucker_importance, encode_importance, decode_importance, \
+    select_level_of_detail
+from .app_lib_track_analytics import calculate_track_summary, TRACK_SUMMARY_FIELDS
 
 
 class ThirdPartyProvider(models.Model):
@@ -42,9 +47,73 @@ class Route(models.Model):
     last_lng = models.FloatField()
 
     # Route point-by-point
-    track_points = models.TextField()  # JSON text [{d: .., x: .., y:..}, {d:.., x: .., y:.., e:..}, ...]
-
-    def save(self, *args, **kwargs):
+    track_points = models.TextField(null=True)  # Legacy JSON text [{d: .., x: .., y:..}, {d:.., x: .., y:.., e:..}, ...]
+    track_points_packed = models.BinaryField(null=True)  # Same points, see app_lib_track_points for the format
+    track_points_importance = models.BinaryField(null=True)  # Per point level-of-detail, see app_lib_track_lod
+
+    class Meta:
+        unique_together = (('external_system', 'external_id'),)
+        indexes = [
+            # Viewport intersection filters on one edge of each axis against each bound
+            models.Index(fields=['bounding_box_lesser_edge_lat', 'bounding_box_larger_edge_lat']),
+            models.Index(fields=['bounding_box_lesser_edge_lng', 'bounding_box_larger_edge_lng'])
+        ]
+
+    def set_track_points(self, points):
+        self.track_points_packed = encode_track_points(points)
+        self.track_points = None
+        self.track_points_importance = None
+        self._decoded_track_points = None
+
+    def get_track_points(self):
+        # Decoded once per instance; rows not yet converted by "manage.py pack_track_points" fall back to the JSON
+        if getattr(self, '_decoded_track_points', None) is None:
+            if self.track_points_packed is not None:
+                self._decoded_track_points = decode_track_points(self.track_points_packed)
+            else:
+                self._decoded_track_points = decode_track_points(encode_track_points(json.loads(self.track_points)))
+        return self._decoded_track_points
+
+    def get_track_points_at_tolerance(self, tolerance_m):
+        # Simplified track for clients that can't show more detail than tolerance_m metres (None: all points)
+        track_points = self.get_track_points()
+        if tolerance_m is None or self.track_points_importance is None:
+            return track_points
+        importance = decode_importance(self.track_points_importance)
+        if len(importance) != len(track_points):
+            return track_points
+        return track_points.take(select_level_of_detail(importance, tolerance_m))
+
+    def get_track_lat_lon(self, tolerance_m=None):
+        # (lats, lons) arrays of the points having both coordinates, at the given level of detail
+        track_points = self.get_track_points_at_tolerance(tolerance_m)
+        lats, lons = track_points.channels.get('y'), track_points.channels.get('x')
+        if lats is None or lons is None:
+            return np.zeros(0), np.zeros(0)
+        present = ~np.isnan(lats) & ~np.isnan(lons)
+        return lats[present], lons[present]
+
+    def set_track_summary(self, summary):
+        # Summary fields as given by app_lib_track_analytics (see TRACK_SUMMARY_FIELDS), normalized like save() does
+        for field in TRACK_SUMMARY_FIELDS:
+            value = summary[field]
+            if field.endswith(('_lat', '_lng')):
+                value = truncate_coordinate_to_8_decimal_float(value)
+            setattr(self, field, value)
+
+    def update_track_summary(self, window_m=None):
+        """
+        Recompute distance, elevation gain/loss, bounding box and first/last points from the track, e.g. for
+        user-created or edited routes. Returns False (fields untouched) when the track has no coordinates.
+        """
+        summary = calculate_track_summary(self.get_track_points(), window_m)
+        if summary is None:
+            return False
+        self.set_track_summary(summary)
+        return True
+
+    def normalize_fields(self):
+        # Applied by save(), and explicitly before bulk_create() which bypasses save()
         self.bounding_box_larger_edge_lat = truncate_coordinate_to_8_decimal_float(self.bounding_box_larger_edge_lat)
         self.bounding_box_larger_edge_lng = truncate_coordinate_to_8_decimal_float(self.bounding_box_larger_edge_lng)
         self.bounding_box_lesser_edge_lat = truncate_coordinate_to_8_decimal_float(self.bounding_box_lesser_edge_lat)
@@ -58,10 +127,26 @@ class Route(models.Model):
         self.first_lng = truncate_coordinate_to_8_decimal_float(self.first_lng)
         self.last_lat = truncate_coordinate_to_8_decimal_float(self.last_lat)
         self.last_lng = truncate_coordinate_to_8_decimal_float(self.last_lng)
+        self.pack_track_points()
+
+    def pack_track_points(self):
+        # Convert legacy JSON to the packed format and precompute level-of-detail importance where missing
+        if self.track_points_packed is None and self.track_points is not None:
+            self.set_track_points(json.loads(self.track_points))
+        if self.track_points_importance is None and self.track_points_packed is not None:
+            lats, lons = self.get_track_points().channels.get('y'), self.get_track_points().channels.get('x')
+            if lats is not None and lons is not None and not np.isnan(lats).any() and not np.isnan(lons).any():
+                importance = calculate_douglas_peucker_importance(lats, lons)
+            else:
+                importance = np.zeros(0)  # Tracks with missing coordinates are always served whole
+            self.track_points_importance = encode_importance(importance)
+
+    def save(self, *args, **kwargs):
+        self.normalize_fields()
         super(Route, self).save(*args, **kwargs)
 
-    def to_dict(self):
-        return {
+    def to_dict(self, include_track_points=True):
+        route_dict = {
             "id":                           self.id,
             "external_system":              self.external_system.name,
             "external_id":                  self.external_id,
@@ -77,9 +162,25 @@ class Route(models.Model):
             "first_lat":                    self.first_lat,
             "first_lng":                    self.first_lng,
             "last_lat":                     self.last_lat,
-            "last_lng":                     self.last_lng,
-            "track_points":                 json.loads(self.track_points)
+            "last_lng":                     self.last_lng
         }
+        if include_track_points:
+            route_dict["track_points"] = self.get_track_points().to_list()
+        return route_dict
+
+    def iter_json(self, chunk_size=2000, tolerance_m=None):
+        """
+        Same JSON text as json.dumps(self.to_dict()), yielded in chunks for StreamingHttpResponse.
+        Stored track points are spliced in as text (legacy JSON verbatim) without building the point dicts.
+        """
+        yield json.dumps(self.to_dict(include_track_points=False))[:-1] + ', "track_points": '
+        if self.track_points_packed is None and self.track_points is not None and tolerance_m is None:
+            for chunk_start in range(0, len(self.track_points), chunk_size * 64):
+                yield self.track_points[chunk_start:chunk_start + chunk_size * 64]
+        else:
+            for chunk in iter_track_points_json(self.get_track_points_at_tolerance(tolerance_m), chunk_size):
+                yield chunk
+        yield '}'
 
 
 class Comment(models.Model):
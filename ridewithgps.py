@@ -1,42 +1,67 @@
 from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist
-from django.http import HttpResponse, HttpResponseBadRequest
-import requests
+from django.db import IntegrityError, transaction
+from django.http import HttpResponse, HttpResponseBadRequest, StreamingHttpResponse
 import json
-import urllib.parse
+import re
 
-from ..models import Route, ThirdPartyProvider
+from ..models import Route
 from ..app_lib import RoutePreview
+from ..app_lib_ridewithgps import ridewithgps_get
+from ..app_lib_cache import TTLLRUCache
+from ..app_lib_ridewithgps_ingest import get_ridewithgps_provider, get_external_id, format_external_id, build_route
+from ..app_lib_track_lod import zoom_to_tolerance
+from ..app_lib_timing import start_phase_timer, NULL_PHASE_TIMER
+from ..app_lib_route_formats import encode_polyline, encode_binary_points, parse_route_format_params, \
+    STORED_ROUTE_FORMATS, ROUTE_FORMAT_JSON, ROUTE_FORMAT_BINARY, BINARY_CONTENT_TYPE
 
 
-def get_authtoken():
-    r = requests.get('https://ridewithgps.com/users/current.json'
-                     + '?email=' + settings.RIDEWITHGPS_EMAIL
-                     + '&password=' + settings.RIDEWITHGPS_PASSWORD
-                     + '&apikey=' + settings.RIDEWITHGPS_APIKEY)
-    user_obj = json.loads(r.text)
-    return user_obj['user']['auth_token']
+SEARCH_PARAMS = (
+    'keywords', 'start_location', 'start_distance', 'elevation_max', 'elevation_min',
+    'length_max', 'length_min', 'offset', 'limit', 'sort_by'
+)
+CASE_INSENSITIVE_SEARCH_PARAMS = ('keywords', 'start_location')
+DEFAULT_SEARCH_CACHE_SIZE = 256
+DEFAULT_SEARCH_CACHE_TTL = 300  # seconds
+DEFAULT_SEARCH_CACHE_STALE_TTL = 0  # seconds a stale result is served while refreshing, 0 disables
 
+_search_cache = None
 
-# Returns {'results': <list-serialized-using-RoutePreview.to_dict()>, 'results_count': <int>}
-def search_routes(request):
-    querystring = urllib.parse.urlencode({
-        "apikey": settings.RIDEWITHGPS_APIKEY,
-        "version": settings.RIDEWITHGPS_APIVERSION,
-        "auth_token": get_authtoken(),
-        "search[keywords]":       request.GET.get('keywords', ''),
-        "search[start_location]": request.GET.get('start_location', ''),
-        "search[start_distance]": request.GET.get('start_distance', ''),
-        "search[elevation_max]":  request.GET.get('elevation_max', ''),
-        "search[elevation_min]":  request.GET.get('elevation_min', ''),
-        "search[length_max]":     request.GET.get('length_max', ''),
-        "search[length_min]":     request.GET.get('length_min', ''),
-        "search[offset]":         request.GET.get('offset', ''),
-        "search[limit]":          request.GET.get('limit', ''),
-        "search[sort_by]":        request.GET.get('sort_by', '')
-    })
-    r = requests.get('https://ridewithgps.com/find/search.json?%s' % querystring)
-    response_obj = json.loads(r.text)
+
+def get_search_cache():
+    global _search_cache
+    if _search_cache is None:
+        _search_cache = TTLLRUCache(
+            getattr(settings, 'RIDEWITHGPS_SEARCH_CACHE_SIZE', DEFAULT_SEARCH_CACHE_SIZE),
+            getattr(settings, 'RIDEWITHGPS_SEARCH_CACHE_TTL', DEFAULT_SEARCH_CACHE_TTL),
+            getattr(settings, 'RIDEWITHGPS_SEARCH_CACHE_STALE_TTL', DEFAULT_SEARCH_CACHE_STALE_TTL)
+        )
+    return _search_cache
+
+
+def normalize_search_params(query_dict):
+    # Collapse whitespace (and case, where upstream ignores it) so equivalent searches share a cache entry
+    normalized = []
+    for name in SEARCH_PARAMS:
+        value = ' '.join(query_dict.get(name, '').split())
+        if name in CASE_INSENSITIVE_SEARCH_PARAMS:
+            value = value.lower()
+        normalized.append((name, value))
+    return tuple(normalized)
+
+
+def fetch_search_routes_payload(search_params, timer=NULL_PHASE_TIMER):
+    with timer.phase('upstream'):
+        r = ridewithgps_get('/find/search.json', {
+            "search[%s]" % name: value
+            for name, value in search_params
+        })
+    with timer.phase('serialize'):
+        return serialize_search_routes_payload(r.text)
+
+
+def serialize_search_routes_payload(response_text):
+    response_obj = json.loads(response_text)
     # filter away "segment"s and whatnot possibly other
     trips_and_routes = list(filter(lambda x: x['type'] == "route" or x['type'] == "trip", response_obj['results']))
     # validate and serialize valid routes
@@ -47,55 +72,137 @@ def search_routes(request):
             valid_routes.append(route_preview.to_dict())
         except ValueError:
             pass
-    return HttpResponse(json.dumps({
+    return json.dumps({
         'results': valid_routes,
         'results_count': response_obj['results_count']
-    }, indent=4), content_type='application/json')
+    }, indent=4)
 
 
-# Returns Route.to_dict() as 'application/json'
-def get_route(request, objtype, identifier):
-    endpoint = "trips" if objtype == "trip" else "routes"
-    querystring = urllib.parse.urlencode({
-        "apikey": settings.RIDEWITHGPS_APIKEY,
-        "version": settings.RIDEWITHGPS_APIVERSION,
-        "auth_token": get_authtoken()
-    })
-    r = requests.get('https://ridewithgps.com/%s/%s.json?%s' % (endpoint, identifier, querystring))
-    response_obj = json.loads(r.text)
-    # Ensure existence of the ThirdPartyProvider
-    try:
-        third_party_provider = ThirdPartyProvider.objects.get(name='RIDEWITHGPS')
-    except ObjectDoesNotExist:
-        third_party_provider = ThirdPartyProvider(name='RIDEWITHGPS')
-        third_party_provider.save()
+# Returns {'results': <list-serialized-using-RoutePreview.to_dict()>, 'results_count': <int>}
+def search_routes(request):
+    timer = start_phase_timer('search_routes')
+    search_params = normalize_search_params(request.GET)
+    # Serialized payloads are cached per normalized search, see get_search_cache().stats() for hits/misses
+    payload = get_search_cache().get_or_compute(
+        search_params,
+        lambda: fetch_search_routes_payload(search_params, timer)
+    )
+    return timer.finish(HttpResponse(payload, content_type='application/json'))
+
+
+def validate_level_of_detail_params(query_dict):
+    # HttpResponseBadRequest for invalid "tolerance"/"zoom" GET params, None if valid (or absent)
+    tolerance = query_dict.get('tolerance', None)
+    zoom = query_dict.get('zoom', None)
+    if tolerance is not None and not re.compile(r'^\d+([.]\d+)?$').match(tolerance):
+        return HttpResponseBadRequest('Invalid GET param "tolerance" (metres) e.g. "1", "12.5", "100"')
+    if zoom is not None and not re.compile(r'^\d+$').match(zoom):
+        return HttpResponseBadRequest('Invalid GET param "zoom" e.g. "5", "12", "18"')
+    return None
+
+
+def get_level_of_detail_tolerance(query_dict, the_route):
+    # Level of detail: explicit tolerance wins over zoom, which maps to about one pixel at the route's latitude
+    tolerance = query_dict.get('tolerance', None)
+    zoom = query_dict.get('zoom', None)
+    tolerance_m = float(tolerance) if tolerance is not None else None
+    if tolerance_m is None and zoom is not None:
+        tolerance_m = zoom_to_tolerance(int(zoom), the_route.first_lat)
+    return tolerance_m
+
+
+def get_stored_route(objtype, identifier):
+    # Already stored Route of a "route"/"trip" id, None if it has to be fetched from RideWithGPS first
+    return Route.objects.select_related('external_system').filter(
+        external_system__name='RIDEWITHGPS',
+        external_id=format_external_id("trip" if objtype == "trip" else "route", identifier)
+    ).first()
+
+
+def get_or_create_route(response_obj):
+    """
+    Stored Route of a RideWithGPS routes/trips payload, saved first if new; None for invalid routes.
+    The provider is attached, so serializing the route needs no further queries.
+    """
+    third_party_provider = get_ridewithgps_provider()
+    external_id = get_external_id(response_obj)
     # Search if this route already exists in database, else create
-    typekey = response_obj['type']  # Either "route" or "trip"
-    external_id = "%s:%s" % (typekey, response_obj[typekey]['id'])
     try:
-        the_route = Route.objects.get(external_system=third_party_provider, external_id=external_id)
+        return Route.objects.select_related('external_system').get(
+            external_system=third_party_provider,
+            external_id=external_id
+        )
     except ObjectDoesNotExist:
-        bounding_box_ne = max(response_obj[typekey]['bounding_box'], key=lambda x: x['lat'])
-        bounding_box_sw = min(response_obj[typekey]['bounding_box'], key=lambda x: x['lat'])
-        try:
-            the_route = Route(
-                external_system=third_party_provider,
-                external_id=external_id,
-                is_public=True,
-                bounding_box_larger_edge_lat=bounding_box_ne['lat'],
-                bounding_box_larger_edge_lng=bounding_box_ne['lng'],
-                bounding_box_lesser_edge_lat=bounding_box_sw['lat'],
-                bounding_box_lesser_edge_lng=bounding_box_sw['lng'],
-                distance=response_obj[typekey]['distance'],
-                accumulated_elevation_gain=response_obj[typekey]['elevation_gain'],
-                accumulated_elevation_loss=response_obj[typekey]['elevation_loss'],
-                first_lat=response_obj[typekey]['first_lat'],
-                first_lng=response_obj[typekey]['first_lng'],
-                last_lat=response_obj[typekey]['last_lat'],
-                last_lng=response_obj[typekey]['last_lng'],
-                track_points=json.dumps(response_obj[typekey]['track_points'])  # Saved TextField
-            )
-        except ValueError:
-            return HttpResponseBadRequest('Tried to query an invalid route. (Where did frontend get this ID?)')
-        the_route.save()
-    return HttpResponse(json.dumps(the_route.to_dict()), content_type='application/json')
+        pass
+    try:
+        the_route = build_route(response_obj, third_party_provider)
+    except ValueError:
+        return None
+    try:
+        # Savepoint, so that losing the race doesn't break a surrounding transaction
+        with transaction.atomic():
+            the_route.save()
+    except IntegrityError:
+        # A concurrent first fetch of the same route saved it first (unique external_system, external_id)
+        return Route.objects.select_related('external_system').get(
+            external_system=third_party_provider,
+            external_id=external_id
+        )
+    return the_route
+
+
+def route_format_response(the_route, tolerance_m, output_format, precision):
+    # Track as encoded polyline (in the Route.to_dict() JSON, instead of "track_points") or the binary format
+    lats, lons = the_route.get_track_lat_lon(tolerance_m)
+    if output_format == ROUTE_FORMAT_BINARY:
+        return HttpResponse(
+            encode_binary_points(lats, lons, precision, the_route.distance),
+            content_type=BINARY_CONTENT_TYPE
+        )
+    route_dict = the_route.to_dict(include_track_points=False)
+    route_dict['track_points_polyline'] = encode_polyline(lats, lons, precision)
+    route_dict['precision'] = precision
+    return HttpResponse(json.dumps(route_dict), content_type='application/json')
+
+
+# Returns Route.to_dict() as 'application/json', streamed
+# Optional GET param "tolerance" (metres) or "zoom" (web map zoom level) returns a simplified track
+# Optional GET param "format" ("polyline" or "binary", with "precision" decimals) returns the track compacted,
+# default "json" is the above
+def get_route(request, objtype, identifier):
+    invalid_params_response = validate_level_of_detail_params(request.GET)
+    if invalid_params_response is not None:
+        return invalid_params_response
+    try:
+        output_format, precision = parse_route_format_params(request.GET, STORED_ROUTE_FORMATS)
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+
+    timer = start_phase_timer('get_route')
+    # Stored routes are answered from the database, RideWithGPS is only asked for routes not seen before
+    with timer.phase('db'):
+        the_route = get_stored_route(objtype, identifier)
+    if the_route is None:
+        endpoint = "trips" if objtype == "trip" else "routes"
+        with timer.phase('upstream'):
+            r = ridewithgps_get('/%s/%s.json' % (endpoint, identifier))
+        with timer.phase('parse'):
+            response_obj = json.loads(r.text)
+        with timer.phase('db'):
+            the_route = get_or_create_route(response_obj)
+    if the_route is None:
+        return timer.finish(
+            HttpResponseBadRequest('Tried to query an invalid route. (Where did frontend get this ID?)')
+        )
+
+    tolerance_m = get_level_of_detail_tolerance(request.GET, the_route)
+    if output_format != ROUTE_FORMAT_JSON:
+        with timer.phase('serialize'):
+            response = route_format_response(the_route, tolerance_m, output_format, precision)
+        return timer.finish(response)
+    # Header carries the phases up to here, serialization is timed while streaming and only lands in the histograms
+    response = StreamingHttpResponse(
+        timer.iter_timed(the_route.iter_json(tolerance_m=tolerance_m), 'serialize'),
+        content_type='application/json'
+    )
+    return timer.set_server_timing(response)
@@ -0,0 +1,109 @@
+from asgiref.sync import sync_to_async
+from django.http import HttpResponse, HttpResponseBadRequest, StreamingHttpResponse
+import json
+
+from ..app_lib_ridewithgps_async import ridewithgps_get_async, fetch_route_texts_async
+from ..app_lib_timing import start_phase_timer
+from ..app_lib_route_formats import parse_route_format_params, STORED_ROUTE_FORMATS, ROUTE_FORMAT_JSON
+from .ridewithgps import get_search_cache, normalize_search_params, serialize_search_routes_payload, \
+    validate_level_of_detail_params, get_level_of_detail_tolerance, get_stored_route, get_or_create_route, \
+    route_format_response
+
+
+# Most references accepted by get_routes_async() per request
+MAX_ROUTE_REFERENCES = 50
+
+
+# Async version of ridewithgps.search_routes, sharing its cache (no stale-while-revalidate here)
+async def search_routes_async(request):
+    timer = start_phase_timer('search_routes_async')
+    search_params = normalize_search_params(request.GET)
+    search_cache = get_search_cache()
+    payload = search_cache.get(search_params)
+    if payload is None:
+        with timer.phase('upstream'):
+            r = await ridewithgps_get_async('/find/search.json', {
+                "search[%s]" % name: value
+                for name, value in search_params
+            })
+        with timer.phase('serialize'):
+            payload = serialize_search_routes_payload(r.text)
+        search_cache.set(search_params, payload)
+    return timer.finish(HttpResponse(payload, content_type='application/json'))
+
+
+# Async version of ridewithgps.get_route: Route.to_dict() as 'application/json', streamed
+async def get_route_async(request, objtype, identifier):
+    invalid_params_response = validate_level_of_detail_params(request.GET)
+    if invalid_params_response is not None:
+        return invalid_params_response
+    try:
+        output_format, precision = parse_route_format_params(request.GET, STORED_ROUTE_FORMATS)
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+
+    timer = start_phase_timer('get_route_async')
+    # ORM calls run in the sync thread, the loop keeps serving other requests meanwhile
+    with timer.phase('db'):
+        the_route = await sync_to_async(get_stored_route)(objtype, identifier)
+    if the_route is None:
+        endpoint = "trips" if objtype == "trip" else "routes"
+        with timer.phase('upstream'):
+            r = await ridewithgps_get_async('/%s/%s.json' % (endpoint, identifier))
+        with timer.phase('parse'):
+            response_obj = json.loads(r.text)
+        with timer.phase('db'):
+            the_route = await sync_to_async(get_or_create_route)(response_obj)
+    if the_route is None:
+        return timer.finish(
+            HttpResponseBadRequest('Tried to query an invalid route. (Where did frontend get this ID?)')
+        )
+
+    tolerance_m = get_level_of_detail_tolerance(request.GET, the_route)
+    if output_format != ROUTE_FORMAT_JSON:
+        with timer.phase('serialize'):
+            response = route_format_response(the_route, tolerance_m, output_format, precision)
+        return timer.finish(response)
+    response = StreamingHttpResponse(
+        timer.iter_timed(the_route.iter_json(tolerance_m=tolerance_m), 'serialize'),
+        content_type='application/json'
+    )
+    return timer.set_server_timing(response)
+
+
+def get_or_create_routes(response_texts):
+    # {reference: Route.to_dict() or error message}, for get_routes_async() in the sync thread
+    results = {}
+    for reference, response_text in response_texts.items():
+        if isinstance(response_text, Exception):
+            results[reference] = 'Could not fetch route: {}'.format(str(response_text) or type(response_text).__name__)
+            continue
+        try:
+            the_route = get_or_create_route(json.loads(response_text))
+        except (ValueError, KeyError, TypeError):
+            the_route = None
+        if the_route is None:
+            results[reference] = 'Invalid route'
+        else:
+            results[reference] = the_route.to_dict()
+    return results
+
+
+# Returns {'results': {<reference>: Route.to_dict()}, 'errors': {<reference>: <message>}}
+# GET param "references" is a comma separated list of "route:123", "trip:456" (or bare route ids), fetched concurrently
+async def get_routes_async(request):
+    references = [reference for reference in request.GET.get('references', '').split(',') if reference]
+    if not references:
+        return HttpResponseBadRequest('Invalid GET param "references" e.g. "route:123,trip:456"')
+    if len(references) > MAX_ROUTE_REFERENCES:
+        return HttpResponseBadRequest('At most {} "references" per request'.format(MAX_ROUTE_REFERENCES))
+
+    timer = start_phase_timer('get_routes_async')
+    with timer.phase('upstream'):
+        response_texts = await fetch_route_texts_async(list(dict.fromkeys(references)))
+    with timer.phase('db'):
+        results = await sync_to_async(get_or_create_routes)(response_texts)
+    return timer.finish(HttpResponse(json.dumps({
+        'results': {reference: result for reference, result in results.items() if isinstance(result, dict)},
+        'errors': {reference: result for reference, result in results.items() if not isinstance(result, dict)}
+    }), content_type='application/json'))
@@ -0,0 +1,60 @@
+from django.db.models import ExpressionWrapper, F, FloatField
+from django.http import HttpResponse, HttpResponseBadRequest
+import json
+import math
+
+from ..models import Route
+
+
+DEFAULT_VIEWPORT_LIMIT = 50
+MAX_VIEWPORT_LIMIT = 200
+
+
+# Returns {'results': <list-serialized-using-Route.to_dict(include_track_points=False)>, 'results_count': <int>}
+def get_routes_in_viewport(request):
+    # Gather arguments
+    input_bbox = request.GET.get('bbox', None)
+    offset = request.GET.get('offset', '0')
+    limit = request.GET.get('limit', str(DEFAULT_VIEWPORT_LIMIT))
+
+    # Validate arguments
+    if input_bbox is None or not len(input_bbox.split(',')) == 4:
+        return HttpResponseBadRequest('Invalid GET param "bbox". Should be "south,west,north,east" (without quotes).')
+    try:
+        south, west, north, east = map(lambda coord: float(coord), input_bbox.split(','))
+    except ValueError:
+        return HttpResponseBadRequest('Invalid coordinate(s) in GET param "bbox". Format: "nn.mm,nn.mm,nn.mm,nn.mm"')
+    if south > north or west > east:
+        return HttpResponseBadRequest('Invalid GET param "bbox", south must not exceed north nor west exceed east.')
+    if not offset.isdigit() or not limit.isdigit():
+        return HttpResponseBadRequest('Invalid GET param "offset" or "limit", should be non-negative integers.')
+    offset, limit = int(offset), min(int(limit), MAX_VIEWPORT_LIMIT)
+
+    # Routes whose bounding box intersects the viewport (served by the composite bbox indexes on Route),
+    # nearest bounding box center to viewport center first
+    center_lat, center_lng = (south + north) / 2, (west + east) / 2
+    lng_scale = math.cos(math.radians(center_lat))
+    routes = Route.objects.filter(
+        is_public=True,
+        bounding_box_larger_edge_lat__gte=south,
+        bounding_box_lesser_edge_lat__lte=north,
+        bounding_box_larger_edge_lng__gte=west,
+        bounding_box_lesser_edge_lng__lte=east
+    )
+    lat_offset = (F('bounding_box_larger_edge_lat') + F('bounding_box_lesser_edge_lat')) / 2.0 - center_lat
+    lng_offset = ((F('bounding_box_larger_edge_lng') + F('bounding_box_lesser_edge_lng')) / 2.0 - center_lng) * lng_scale
+    page = (
+        routes
+        .select_related('external_system')
+        .defer('track_points', 'track_points_packed', 'track_points_importance')
+        .annotate(center_offset=ExpressionWrapper(
+            lat_offset * lat_offset + lng_offset * lng_offset,
+            output_field=FloatField()
+        ))
+        .order_by('center_offset', 'id')[offset:offset + limit]
+    )
+
+    return HttpResponse(json.dumps({
+        'results': [route.to_dict(include_track_points=False) for route in page],
+        'results_count': routes.count()
+    }), content_type='application/json')
@@ -0,0 +1,758 @@
+from django.conf import settings
+from django.test import SimpleTestCase, TestCase, RequestFactory, override_settings
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+from unittest import mock
+import asyncio
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+import unittest
+import numpy as np
+import psycopg2
+
+from . import app_lib_ridewithgps, app_lib_ridewithgps_async, app_lib_ridewithgps_ingest, app_lib_sql
+from .app_lib_budget import RequestBudget, BudgetExhausted
+from .app_lib_db import gisdb_connection
+from .app_lib_edge_scoring import select_disposed_edges
+from .app_lib_graph import RoadGraph, load_road_graph, export_road_graph_snapshot, load_road_graph_snapshot, \
+    load_current_road_graph, read_current_snapshot
+from .app_lib_ridewithgps import ridewithgps_get
+from .app_lib_ridewithgps_async import get_async_session, fetch_route_texts_async
+from .app_lib_route_formats import parse_route_format_params, encode_polyline, decode_polyline, \
+    encode_binary_points, decode_binary_points, stitch_path_points, stitch_round_trip_points, ROUND_TRIP_FORMATS, \
+    STORED_ROUTE_FORMATS, DEFAULT_ROUTE_FORMAT_PRECISION, MAX_ROUTE_FORMAT_PRECISION
+from .app_lib_spatial import NearestNodeIndex
+from .app_lib_track_points import encode_track_points, decode_track_points
+from .models import Route, ThirdPartyProvider
+from .app_lib_sql import get_k_shortest_paths_edge_ids
+from .views import generate_ksp_roundtrip, ridewithgps, ridewithgps_async
+from .views.generate_ksp_roundtrip import generate_sector_route, run_sector_pipelines, \
+    iter_sector_pipelines_as_completed, SECTOR_TIMED_OUT
+
+
+def make_road_graph(edges, node_coordinates):
+    """
+    RoadGraph of [(edge_id, source, target, cost)], node_coordinates {node_id: (lon, lat)}.
+    """
+    columns = {column: [] for column in ('id', 'source', 'target', 'cost', 'clazz', 'x1', 'y1', 'x2', 'y2',
+                                         'xmin', 'ymin', 'xmax', 'ymax')}
+    for edge_id, source, target, cost in edges:
+        (x1, y1), (x2, y2) = node_coordinates[source], node_coordinates[target]
+        for column, value in (('id', edge_id), ('source', source), ('target', target), ('cost', cost),
+                              ('clazz', 0), ('x1', x1), ('y1', y1), ('x2', x2), ('y2', y2),
+                              ('xmin', min(x1, x2)), ('ymin', min(y1, y2)),
+                              ('xmax', max(x1, x2)), ('ymax', max(y1, y2))):
+            columns[column].append(value)
+    return RoadGraph.from_edges(columns, version='test')
+
+
+def random_road_graph(rnd, node_count, edge_count):
+    node_coordinates = {node_id: (rnd.uniform(0, 1), rnd.uniform(0, 1)) for node_id in range(1, node_count + 1)}
+    edges = []
+    for edge_id in range(1, edge_count + 1):
+        source, target = rnd.sample(sorted(node_coordinates), 2)
+        edges.append((edge_id * 10, source, target, float(rnd.randint(1, 20))))
+    return edges, node_coordinates
+
+
+def brute_force_path_costs(edges, source, target, allowed_edge_ids):
+    # Costs of every simple (loopless) path source -> target, cheapest first
+    outgoing = {}
+    for edge_id, edge_source, edge_target, cost in edges:
+        if edge_id in allowed_edge_ids:
+            outgoing.setdefault(edge_source, []).append((edge_target, cost))
+    costs = []
+
+    def visit(node, visited, cost):
+        if node == target:
+            costs.append(cost)
+            return
+        for next_node, edge_cost in outgoing.get(node, ()):
+            if next_node not in visited:
+                visit(next_node, visited | {next_node}, cost + edge_cost)
+
+    visit(source, {source}, 0.0)
+    return sorted(costs)
+
+
+def edge_overlaps_extent(node_coordinates, source, target, extent):
+    # As "geom_way && ST_MakeEnvelope(..)" for a straight edge
+    (x1, y1), (x2, y2) = node_coordinates[source], node_coordinates[target]
+    return max(x1, x2) >= min(extent[0], extent[2]) and min(x1, x2) <= max(extent[0], extent[2]) \
+        and max(y1, y2) >= min(extent[1], extent[3]) and min(y1, y2) <= max(extent[1], extent[3])
+
+
+def path_cost(graph, edge_ids):
+    return float(graph.edge_cost[graph.edge_indices(edge_ids)].sum())
+
+
+class RoadGraphKShortestPathsTests(SimpleTestCase):
+    """
+    RoadGraph.k_shortest_paths() against every simple path enumerated on small random graphs: the k cheapest
+    costs must match (ties may come in any order), and every path must be a loopless source -> target walk.
+    """
+
+    def assert_k_shortest_paths(self, graph, edges, node_coordinates, rnd, k=3):
+        for _ in range(20):
+            source, target = rnd.sample(sorted(node_coordinates), 2)
+            excluded_edge_ids = set(rnd.sample([edge[0] for edge in edges], 2))
+            extent = (0.9, 0.9, 0.1, 0.1) if rnd.random() < 0.5 else None
+            allowed_edge_ids = {
+                edge_id for edge_id, edge_source, edge_target, _ in edges
+                if edge_id not in excluded_edge_ids
+                and (extent is None or edge_overlaps_extent(node_coordinates, edge_source, edge_target, extent))
+            }
+            expected_costs = brute_force_path_costs(edges, source, target, allowed_edge_ids)[:k]
+            paths = graph.k_shortest_paths(source, target, k, extent, excluded_edge_ids)
+
+            self.assertEqual([round(path_cost(graph, path), 6) for path in paths], expected_costs)
+            self.assertEqual(len(set(tuple(path) for path in paths)), len(paths))
+            edge_ends = {edge_id: (edge_source, edge_target) for edge_id, edge_source, edge_target, _ in edges}
+            for path in paths:
+                self.assertTrue(set(path) <= allowed_edge_ids)
+                nodes = [edge_ends[path[0]][0]] + [edge_ends[edge_id][1] for edge_id in path]
+                self.assertEqual((nodes[0], nodes[-1]), (source, target))
+                self.assertEqual(len(set(nodes)), len(nodes))
+                self.assertTrue(all(edge_ends[a][1] == edge_ends[b][0] for a, b in zip(path, path[1:])))
+
+    def test_matches_brute_force(self):
+        rnd = random.Random(3)
+        for _ in range(10):
+            edges, node_coordinates = random_road_graph(rnd, 8, 24)
+            self.assert_k_shortest_paths(make_road_graph(edges, node_coordinates), edges, node_coordinates, rnd)
+
+    def test_landmarks_match_brute_force(self):
+        rnd = random.Random(4)
+        for _ in range(10):
+            edges, node_coordinates = random_road_graph(rnd, 8, 24)
+            graph = make_road_graph(edges, node_coordinates).with_landmarks(3)
+            self.assertTrue(graph.has_landmarks)
+            self.assert_k_shortest_paths(graph, edges, node_coordinates, rnd)
+
+    def test_unknown_or_same_nodes(self):
+        graph = make_road_graph([(1, 1, 2, 1.0)], {1: (0, 0), 2: (1, 1)})
+        self.assertEqual(graph.k_shortest_paths(1, 99, 3), [])
+        self.assertEqual(graph.k_shortest_paths(1, 1, 3), [])
+        self.assertEqual(graph.k_shortest_paths(2, 1, 3), [])  # Edges are directed
+        self.assertEqual(graph.k_shortest_paths(1, 2, 3), [[1]])
+
+
+class RoadGraphSnapshotTests(SimpleTestCase):
+
+    def setUp(self):
+        temporary_directory = tempfile.TemporaryDirectory()
+        self.addCleanup(temporary_directory.cleanup)
+        self.snapshot_dir = temporary_directory.name
+
+    def test_exported_snapshot_loads_back_identical(self):
+        rnd = random.Random(9)
+        graph = make_road_graph(*random_road_graph(rnd, 30, 150)).with_landmarks(3)
+        graph.version = '16384:2'
+        snapshot_name = export_road_graph_snapshot(graph, self.snapshot_dir)
+
+        loaded = load_road_graph_snapshot(self.snapshot_dir)
+        self.assertEqual((loaded.version, loaded.snapshot_name), ('16384:2', snapshot_name))
+        self.assertEqual(sorted(loaded.arrays), sorted(graph.arrays))
+        for array_name, array in graph.arrays.items():
+            self.assertEqual(loaded.arrays[array_name].dtype, array.dtype)
+            np.testing.assert_array_equal(loaded.arrays[array_name], array)
+        self.assertTrue(loaded.has_landmarks)
+        for source, target in ((1, 2), (3, 30), (17, 5)):
+            self.assertEqual(loaded.k_shortest_paths(source, target, 3), graph.k_shortest_paths(source, target, 3))
+
+    def test_pointer_swaps_to_the_newest_export(self):
+        self.assertIsNone(load_road_graph_snapshot(self.snapshot_dir))
+        rnd = random.Random(10)
+        first = make_road_graph(*random_road_graph(rnd, 10, 30))
+        second = make_road_graph(*random_road_graph(rnd, 12, 40))
+        first.version, second.version = '16384:0', '16384:1'
+
+        first_name = export_road_graph_snapshot(first, self.snapshot_dir, keep=1)
+        self.assertEqual(read_current_snapshot(self.snapshot_dir)[0], first_name)
+        second_name = export_road_graph_snapshot(second, self.snapshot_dir, keep=1)
+        self.assertEqual(read_current_snapshot(self.snapshot_dir), (second_name, {
+            'version': '16384:1', 'arrays': sorted(second.arrays), 'edge_count': 40, 'node_count': 12
+        }))
+        self.assertEqual(load_road_graph_snapshot(self.snapshot_dir).snapshot_name, second_name)
+        # Older snapshots beyond keep are removed, partially written files never stay behind
+        self.assertEqual(sorted(os.listdir(self.snapshot_dir)), sorted(['current', second_name]))
+
+        with override_settings(ROAD_GRAPH_SNAPSHOT_DIR=self.snapshot_dir):
+            self.assertEqual(load_current_road_graph('16384:1').snapshot_name, second_name)
+
+
+@unittest.skipUnless(getattr(settings, 'GISDB_HOST', None), 'No GIS database configured')
+class RoadGraphAgainstPgrKspTests(SimpleTestCase):
+    """
+    The in-process backend against PGR_KSP on the real fi_2po_4pgr, over the same bbox: path costs must match.
+    """
+
+    def test_matches_pgr_ksp(self):
+        try:
+            with gisdb_connection() as dbh:
+                cursor = dbh.cursor()
+                cursor.execute("SELECT ST_X(ST_Centroid(ST_Extent(geom_way))), ST_Y(ST_Centroid(ST_Extent(geom_way)))"
+                               "  FROM fi_2po_4pgr;")
+                center_lon, center_lat = cursor.fetchone()
+                cursor.close()
+        except psycopg2.Error as e:
+            self.skipTest('GIS database not reachable: {}'.format(e))
+        extent = (center_lon + 0.02, center_lat + 0.01, center_lon - 0.02, center_lat - 0.01)
+        graph = load_road_graph(extent=extent)
+        rnd = np.random.RandomState(0)
+        compared = 0
+        for _ in range(20):
+            source, target = (int(node_id) for node_id in rnd.choice(graph.node_id, 2, replace=False))
+            graph_paths = graph.k_shortest_paths(source, target, 3, extent)
+            sql_paths = get_k_shortest_paths_edge_ids(source, target, 3, extent)
+            self.assertEqual(
+                [round(path_cost(graph, path), 1) for path in graph_paths],
+                [round(path_cost(graph, path), 1) for path in sql_paths]
+            )
+            compared += len(graph_paths) > 0
+        self.assertGreater(compared, 0)
+
+
+class NearestNodeIndexTests(SimpleTestCase):
+
+    def test_matches_brute_force_inside_and_far_outside_the_network(self):
+        rnd = np.random.RandomState(0)
+        lats, lons = rnd.uniform(59.8, 70.1, 20000), rnd.uniform(20.5, 31.6, 20000)
+        index = NearestNodeIndex(np.arange(len(lats)), lats, lons)
+        queries = [(0.0, 0.0), (40.0, 24.0), (89.0, 179.0), (65.0, 40.0)] + list(zip(
+            rnd.uniform(55, 75, 200), rnd.uniform(15, 36, 200)
+        ))
+        for lat, lon in queries:
+            distances = np.hypot(lats - lat, (lons - lon) * np.cos(np.radians(lat)))
+            self.assertEqual(index.nearest(lat, lon)[2], int(distances.argmin()))
+
+    def test_empty_index(self):
+        self.assertIsNone(NearestNodeIndex([], [], []).nearest(60.0, 25.0))
+
+
+class CurrentRoadNetworkVersionTests(SimpleTestCase):
+
+    def setUp(self):
+        for name, value in (('_road_network_version', None), ('_road_network_version_checked_at', 0.0)):
+            patcher = mock.patch.object(app_lib_sql, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_one_background_refresh_at_a_time(self):
+        calls = []
+        refresh_started, release_refresh = threading.Event(), threading.Event()
+
+        def get_road_network_version(dbh=None):
+            calls.append(dbh)
+            if len(calls) > 1:
+                refresh_started.set()
+                release_refresh.wait(5)
+            return '1:{}'.format(len(calls) - 1)
+
+        with mock.patch.object(app_lib_sql, 'get_road_network_version', get_road_network_version), \
+                override_settings(ROAD_NETWORK_VERSION_CHECK_INTERVAL=0):
+            self.assertEqual(app_lib_sql.get_current_road_network_version(), '1:0')
+            time.sleep(0.01)
+            # Expired: every caller gets the previous version right away, only one re-read is started
+            callers = [threading.Thread(target=app_lib_sql.get_current_road_network_version) for _ in range(8)]
+            for caller in callers:
+                caller.start()
+            for caller in callers:
+                caller.join(5)
+            self.assertTrue(refresh_started.wait(5))
+            self.assertEqual(app_lib_sql.get_current_road_network_version(), '1:0')
+            self.assertEqual(len(calls), 2)
+            release_refresh.set()
+            for _ in range(100):
+                if app_lib_sql._road_network_version != '1:0':
+                    break
+                time.sleep(0.01)
+            self.assertEqual(app_lib_sql._road_network_version, '1:1')
+
+
+class SectorPipelinesTests(SimpleTestCase):
+    """
+    Sector pipelines run concurrently must give exactly what serial mode (concurrency 1) gives, in the same order.
+    The merge query is answered in-process, the paths come from a random in-memory graph.
+    """
+
+    def test_concurrent_matches_serial(self):
+        rnd = random.Random(5)
+        edges, node_coordinates = random_road_graph(rnd, 30, 150)
+        graph = make_road_graph(edges, node_coordinates)
+        edge_costs = {edge_id: cost for edge_id, _, _, cost in edges}
+
+        def get_edges_union_geojson_and_length(edge_ids, dbh=None):
+            return json.dumps({'type': 'MultiLineString', 'edge_ids': sorted(edge_ids)}), \
+                sum(edge_costs[edge_id] for edge_id in edge_ids)
+
+        sector_args_list = [
+            ('sector {}'.format(target), target, 1, 1.0, 1.0, 0.0, 0.0)
+            + (generate_ksp_roundtrip.NULL_PHASE_TIMER, graph, None)
+            for target in range(2, 31)
+        ]
+        with mock.patch.object(generate_ksp_roundtrip, 'gisdb_connection', lambda: mock.MagicMock()), \
+                mock.patch.object(generate_ksp_roundtrip, 'get_edges_union_geojson_and_length',
+                                  get_edges_union_geojson_and_length):
+            serial = run_sector_pipelines(generate_sector_route, sector_args_list, 1)
+            for concurrency in (2, 4, 8):
+                self.assertEqual(run_sector_pipelines(generate_sector_route, sector_args_list, concurrency), serial)
+        self.assertTrue(any(isinstance(sector_route, dict) for sector_route in serial))
+
+
+def dict_based_dispose_values(paths):
+    # {edge id: dispose value} of the first path's edges, by the dict algorithm select_disposed_edges() replaced
+    routes = []
+    edge_repetitions = {}
+    for path_edges in paths:
+        routes.append([{'seq': seq, 'edge': edge} for seq, edge in enumerate(path_edges)])
+        for edge in path_edges:
+            edge_repetitions[edge] = edge_repetitions.get(edge, 0) + 1
+    if len(routes) == 0:
+        return {}
+    all_mid_distance_edge_weights = {}
+    for r in routes:
+        total_sequences_in_route = len(r)
+        for segment in r:
+            weight = 1 - (abs((total_sequences_in_route/2) - segment['seq']) / (total_sequences_in_route/2))
+            all_mid_distance_edge_weights.setdefault(segment['edge'], []).append(weight)
+    average_mid_distance_edge_weights = {
+        edge_id: sum(all_weights)/float(len(all_weights))
+        for edge_id, all_weights in all_mid_distance_edge_weights.items()
+    }
+    edge_ids_in_first_path = [segment['edge'] for segment in routes[0]]
+    return {
+        edge_id: (counts_crossed/len(routes)) * average_mid_distance_edge_weights[edge_id]
+        for edge_id, counts_crossed in edge_repetitions.items()
+        if edge_id in edge_ids_in_first_path
+    }
+
+
+class EdgeDisposalTests(SimpleTestCase):
+    """
+    Vectorized select_disposed_edges() against the dict-based algorithm it replaced, on random paths.
+    """
+
+    def assert_same_disposed_edges(self, paths):
+        dispose_values = dict_based_dispose_values(paths)
+        # Every edge's own value is a margin too, an edge right at the margin must stay on the same side
+        for dispose_margin in sorted({0.0, 0.1, 0.3, 0.5, 0.7, 1.0} | set(dispose_values.values())):
+            self.assertEqual(
+                select_disposed_edges(paths, dispose_margin, 'mid_distance_repetition'),
+                [edge_id for edge_id, value in dispose_values.items() if value > dispose_margin]
+            )
+
+    def test_matches_dict_based_algorithm(self):
+        rnd = random.Random(6)
+        for _ in range(200):
+            edge_pool = list(range(1, rnd.randint(2, 30)))
+            paths = [
+                [rnd.choice(edge_pool) for _ in range(rnd.randint(1, 12))]
+                for _ in range(rnd.randint(1, 4))
+            ]
+            self.assert_same_disposed_edges(paths)
+
+    def test_ties_and_empty_paths(self):
+        for paths in ([], [[]], [[1, 2, 3, 4]], [[1, 2, 3, 4]] * 3, [[1, 2, 3], [3, 2, 1]], [[1, 2], [], [2, 1]],
+                      [[5, 6, 5, 6], [6, 5]], [[], [1, 2, 3]]):
+            self.assert_same_disposed_edges(paths)
+
+
+class RequestBudgetTests(SimpleTestCase):
+
+    def test_sub_budgets_share_the_deadline_and_cancellation(self):
+        budget = RequestBudget(60)
+        first, second = budget.sub_budget(), budget.sub_budget()
+        self.assertEqual((first.deadline, second.deadline), (budget.deadline, budget.deadline))
+        first.cancel()
+        self.assertEqual((first.is_exhausted(), second.is_exhausted(), budget.is_exhausted()), (True, False, False))
+        budget.cancel()
+        self.assertTrue(second.is_exhausted())
+        self.assertTrue(budget.sub_budget().is_exhausted())
+
+    def test_graph_search_gives_up_when_cancelled(self):
+        rnd = random.Random(8)
+        graph = make_road_graph(*random_road_graph(rnd, 30, 150))
+        self.assertTrue(graph.k_shortest_paths(1, 2, 5, budget=RequestBudget()))
+        cancelled = RequestBudget()
+        cancelled.cancel()
+        with self.assertRaises(BudgetExhausted):
+            graph.k_shortest_paths(1, 2, 5, budget=cancelled)
+        self.assertEqual(generate_sector_route('NE', 2, 1, 1.0, 1.0, 0.0, 0.0, graph=graph, budget=cancelled),
+                         SECTOR_TIMED_OUT)
+
+    def test_abandoned_sectors_are_cancelled(self):
+        budget = RequestBudget()  # No deadline, only cancellation stops the sectors
+        sector_budgets = [budget.sub_budget() for _ in range(3)]
+        gave_up = []
+
+        def pipeline(index, sector_budget):
+            # Stands in for a graph search checking its budget between iterations
+            while index > 0 and not sector_budget.is_exhausted():
+                time.sleep(0.001)
+            gave_up.append(index)
+            return index
+
+        sector_results = iter_sector_pipelines_as_completed(
+            pipeline, list(enumerate(sector_budgets)), 3, budget
+        )
+        self.assertEqual(next(sector_results), (0, 0))
+        sector_results.close()  # E.g. the client went away
+        for _ in range(500):
+            if len(gave_up) == 3:
+                break
+            time.sleep(0.01)
+        self.assertEqual(sorted(gave_up), [0, 1, 2])
+
+
+class StubRidewithgpsServer(ThreadingMixIn, HTTPServer):
+    """
+    Local stand-in for the RideWithGPS API: a login at /users/current.json hands out auth tokens "token-1",
+    "token-2", .. and any other path answers {"path": ..} unless its auth_token is in rejected_authtokens (401),
+    or statuses[path] lists statuses to answer first. Responses take delay_seconds. Records the (path, client port)
+    of every request, one port per kept-alive connection, and the most requests it had in flight at once.
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), StubRidewithgpsHandler)
+        self.lock = threading.Lock()
+        self.requests = []
+        self.logins = 0
+        self.rejected_authtokens = set()
+        self.statuses = {}
+        self.delay_seconds = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    @property
+    def base_url(self):
+        return 'http://127.0.0.1:%d' % self.server_address[1]
+
+    def paths(self):
+        return [path for path, _ in self.requests]
+
+    def client_ports(self):
+        return {port for _, port in self.requests}
+
+
+class StubRidewithgpsHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # Keep-alive
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        with self.server.lock:
+            self.server.requests.append((url.path, self.client_address[1]))
+            self.server.in_flight += 1
+            self.server.max_in_flight = max(self.server.max_in_flight, self.server.in_flight)
+            if url.path == '/users/current.json':
+                self.server.logins += 1
+                status, body = 200, {'user': {'auth_token': 'token-%d' % self.server.logins}}
+            elif params.get('auth_token') in self.server.rejected_authtokens:
+                status, body = 401, {'error': 'unauthorized'}
+            elif self.server.statuses.get(url.path):
+                status, body = self.server.statuses[url.path].pop(0), {'error': 'failed'}
+            else:
+                status, body = 200, {'path': url.path}
+        time.sleep(self.server.delay_seconds)
+        with self.server.lock:
+            self.server.in_flight -= 1
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubRidewithgpsTestCase(SimpleTestCase):
+    """
+    Runs each test against a fresh StubRidewithgpsServer, with the client's token and session caches reset.
+    """
+
+    def setUp(self):
+        self.server = StubRidewithgpsServer()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        settings_override = override_settings(
+            RIDEWITHGPS_BASE_URL=self.server.base_url,
+            RIDEWITHGPS_EMAIL='user@example.com',
+            RIDEWITHGPS_PASSWORD='password',
+            RIDEWITHGPS_APIKEY='apikey',
+            RIDEWITHGPS_APIVERSION=2,
+            RIDEWITHGPS_TIMEOUT=5
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.reset_client()
+        self.addCleanup(self.reset_client)
+
+    def reset_client(self):
+        app_lib_ridewithgps.invalidate_authtoken()
+        if app_lib_ridewithgps._session is not None:
+            app_lib_ridewithgps._session.close()
+        app_lib_ridewithgps._session = None
+
+
+class RidewithgpsGetTests(StubRidewithgpsTestCase):
+
+    def test_logs_in_once_and_keeps_the_connection_alive(self):
+        for route_id in (1, 2, 3):
+            r = ridewithgps_get('/routes/%d.json' % route_id)
+            self.assertEqual(r.status_code, 200)
+            self.assertEqual(r.json(), {'path': '/routes/%d.json' % route_id})
+        self.assertEqual(self.server.paths(), ['/users/current.json', '/routes/1.json', '/routes/2.json',
+                                               '/routes/3.json'])
+        self.assertEqual(len(self.server.client_ports()), 1)
+
+    def test_rejected_token_is_renewed_and_the_request_retried_once(self):
+        ridewithgps_get('/routes/1.json')
+        self.server.rejected_authtokens.add('token-1')
+        r = ridewithgps_get('/routes/2.json')
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(self.server.logins, 2)
+        self.assertEqual(self.server.paths()[1:], ['/routes/1.json', '/routes/2.json', '/users/current.json',
+                                                   '/routes/2.json'])
+        # The renewed token is cached in turn
+        ridewithgps_get('/routes/3.json')
+        self.assertEqual(self.server.logins, 2)
+
+    def test_gives_up_after_one_retry(self):
+        self.server.rejected_authtokens.update({'token-1', 'token-2', 'token-3'})
+        r = ridewithgps_get('/routes/1.json')
+        self.assertEqual(r.status_code, 401)
+        self.assertEqual(self.server.logins, 2)
+
+    def test_expired_token_is_renewed(self):
+        with override_settings(RIDEWITHGPS_AUTHTOKEN_TTL=0):
+            ridewithgps_get('/routes/1.json')
+            ridewithgps_get('/routes/2.json')
+        self.assertEqual(self.server.logins, 2)
+
+
+class RidewithgpsAsyncTests(StubRidewithgpsTestCase):
+
+    def setUp(self):
+        super().setUp()
+        backoff_override = mock.patch.object(app_lib_ridewithgps_async, 'RETRY_BACKOFF_SECONDS', 0)
+        backoff_override.start()
+        self.addCleanup(backoff_override.stop)
+
+    def test_fetches_concurrently_with_one_login(self):
+        self.server.delay_seconds = 0.05
+        references = ['route:1', 'trip:2'] + ['route:%d' % route_id for route_id in range(3, 11)]
+        results = asyncio.run(fetch_route_texts_async(references, concurrency=3))
+        self.assertEqual(json.loads(results['trip:2']), {'path': '/trips/2.json'})
+        self.assertEqual(json.loads(results['route:10']), {'path': '/routes/10.json'})
+        self.assertEqual(self.server.logins, 1)
+        self.assertEqual(self.server.max_in_flight, 3)
+
+    def test_retries_server_errors_and_gives_up_on_client_errors(self):
+        self.server.statuses = {'/routes/1.json': [503, 429], '/routes/2.json': [404], '/routes/3.json': [500] * 3}
+        results = asyncio.run(fetch_route_texts_async(['route:1', 'route:2', 'route:3'], retries=2))
+        self.assertEqual(json.loads(results['route:1']), {'path': '/routes/1.json'})
+        self.assertIsInstance(results['route:2'], ValueError)
+        self.assertIsInstance(results['route:3'], ValueError)
+        self.assertEqual(self.server.paths().count('/routes/1.json'), 3)
+        self.assertEqual(self.server.paths().count('/routes/2.json'), 1)
+        self.assertEqual(self.server.paths().count('/routes/3.json'), 3)
+
+    def test_rejected_token_is_renewed(self):
+        # The token cache is shared with the sync client
+        ridewithgps_get('/routes/1.json')
+        self.server.rejected_authtokens.add('token-1')
+        results = asyncio.run(fetch_route_texts_async(['route:2']))
+        self.assertEqual(json.loads(results['route:2']), {'path': '/routes/2.json'})
+        self.assertEqual(self.server.logins, 2)
+
+    def test_session_is_closed_with_its_loop(self):
+        async def fetch():
+            await fetch_route_texts_async(['route:1'])
+            return get_async_session()
+
+        session = asyncio.run(fetch())
+        self.assertTrue(session.closed)
+        self.assertTrue(session.connector is None or session.connector.closed)
+        self.assertIsNot(asyncio.run(fetch()), session)
+
+
+class StoredRouteTests(TestCase):
+    """
+    Routes already in the database are served without asking RideWithGPS.
+    """
+
+    def setUp(self):
+        Route(
+            external_system=ThirdPartyProvider.objects.create(name='RIDEWITHGPS'), external_id='route:123',
+            is_public=True, distance=1000, first_lat=60.1, first_lng=24.9, last_lat=60.2, last_lng=25.0,
+            bounding_box_larger_edge_lat=60.2, bounding_box_larger_edge_lng=25.0,
+            bounding_box_lesser_edge_lat=60.1, bounding_box_lesser_edge_lng=24.9,
+            track_points=json.dumps([{'x': 24.9, 'y': 60.1, 'd': 0}, {'x': 25.0, 'y': 60.2, 'd': 1000}])
+        ).save()
+
+    def test_stored_route_is_not_fetched(self):
+        with mock.patch.object(ridewithgps, 'ridewithgps_get') as ridewithgps_get_mock:
+            response = ridewithgps.get_route(RequestFactory().get('/'), 'route', '123')
+            self.assertEqual(json.loads(b''.join(response.streaming_content))['external_id'], 'route:123')
+            self.assertFalse(ridewithgps_get_mock.called)
+
+            # A trip of the same id is another route
+            ridewithgps_get_mock.return_value.text = json.dumps({'type': 'trip', 'trip': {'id': 123}})
+            with mock.patch.object(ridewithgps, 'get_or_create_route', return_value=None):
+                response = ridewithgps.get_route(RequestFactory().get('/'), 'trip', '123')
+            self.assertEqual(response.status_code, 400)
+            ridewithgps_get_mock.assert_called_once_with('/trips/123.json')
+
+    async def test_stored_route_is_not_fetched_async(self):
+        with mock.patch.object(ridewithgps_async, 'ridewithgps_get_async') as ridewithgps_get_async_mock:
+            response = await ridewithgps_async.get_route_async(RequestFactory().get('/'), 'route', '123')
+            self.assertEqual(json.loads(b''.join(response.streaming_content))['external_id'], 'route:123')
+            self.assertFalse(ridewithgps_get_async_mock.called)
+
+
+def ridewithgps_route_payload(route_id):
+    return {'type': 'route', 'route': {
+        'id': route_id, 'distance': 1000, 'elevation_gain': 10, 'elevation_loss': 10,
+        'bounding_box': [{'lat': 60.2, 'lng': 25.0}, {'lat': 60.1, 'lng': 24.9}],
+        'first_lat': 60.1, 'first_lng': 24.9, 'last_lat': 60.2, 'last_lng': 25.0,
+        'track_points': [{'x': 24.9, 'y': 60.1, 'd': 0}, {'x': 25.0, 'y': 60.2, 'd': 1000}]
+    }}
+
+
+class IngestRoutesTests(TestCase):
+
+    def test_conflicting_rows_are_not_counted_as_written(self):
+        build_route = app_lib_ridewithgps_ingest.build_route
+
+        def build_route_stored_concurrently(response_obj, third_party_provider):
+            if response_obj['route']['id'] == 2:
+                # A concurrent writer stores this one after ingest_routes looked for stored routes
+                build_route(response_obj, third_party_provider).save()
+            return build_route(response_obj, third_party_provider)
+
+        with mock.patch.object(app_lib_ridewithgps_ingest, 'fetch_route_payload',
+                               lambda objtype, identifier, retries: ridewithgps_route_payload(int(identifier))), \
+                mock.patch.object(app_lib_ridewithgps_ingest, 'build_route', build_route_stored_concurrently):
+            stats = app_lib_ridewithgps_ingest.ingest_routes(['route:1', 'route:2', '3'], workers=1)
+        self.assertEqual((stats['fetched'], stats['written'], stats['conflicts']), (3, 2, 1))
+        self.assertEqual(Route.objects.count(), 3)
+
+
+class RouteFormatParamsTests(SimpleTestCase):
+
+    def test_defaults_per_kind_of_view(self):
+        self.assertEqual(parse_route_format_params({}, ROUND_TRIP_FORMATS), ('geojson', DEFAULT_ROUTE_FORMAT_PRECISION))
+        self.assertEqual(parse_route_format_params({}, STORED_ROUTE_FORMATS), ('json', DEFAULT_ROUTE_FORMAT_PRECISION))
+        self.assertEqual(parse_route_format_params({'format': 'binary', 'precision': '6'}, STORED_ROUTE_FORMATS),
+                         ('binary', 6))
+
+    def test_invalid_params(self):
+        for query_dict, formats in (({'format': 'json'}, ROUND_TRIP_FORMATS),
+                                    ({'format': 'geojson'}, STORED_ROUTE_FORMATS),
+                                    ({'precision': '8'}, ROUND_TRIP_FORMATS),
+                                    ({'precision': 'x'}, STORED_ROUTE_FORMATS)):
+            with self.assertRaises(ValueError):
+                parse_route_format_params(query_dict, formats)
+
+
+class RouteFormatEncodingTests(SimpleTestCase):
+    """
+    Encoded polylines and binary routes decode back to the points within half a unit of their precision.
+    """
+
+    def assert_round_trip(self, lats, lons, precision):
+        tolerance = 0.5 * 10 ** -precision + 1e-12
+        decoded_lats, decoded_lons = decode_polyline(encode_polyline(lats, lons, precision), precision)
+        np.testing.assert_allclose(decoded_lats, lats, rtol=0, atol=tolerance)
+        np.testing.assert_allclose(decoded_lons, lons, rtol=0, atol=tolerance)
+        decoded_lats, decoded_lons, length_m = decode_binary_points(encode_binary_points(lats, lons, precision, 1234.5))
+        np.testing.assert_allclose(decoded_lats, lats, rtol=0, atol=tolerance)
+        np.testing.assert_allclose(decoded_lons, lons, rtol=0, atol=tolerance)
+        self.assertEqual(length_m, 1234.5)
+
+    def test_round_trip(self):
+        rnd = np.random.RandomState(7)
+        for precision in range(MAX_ROUTE_FORMAT_PRECISION + 1):
+            # Negative coordinates, a walk back and forth across the equator and the prime meridian
+            lats = np.linspace(-0.2, 0.2, 200) + rnd.uniform(-0.01, 0.01, 200)
+            lons = np.linspace(0.3, -0.3, 200) + rnd.uniform(-0.01, 0.01, 200)
+            self.assert_round_trip(lats, lons, precision)
+            self.assert_round_trip([-89.9999999, -89.99], [-179.9999999, -179.99], precision)
+        self.assert_round_trip([60.1699], [-24.9384], DEFAULT_ROUTE_FORMAT_PRECISION)
+
+    def test_known_polyline(self):
+        # The example of the encoded polyline algorithm's documentation
+        lats, lons = [38.5, 40.7, 43.252], [-120.2, -120.95, -126.453]
+        self.assertEqual(encode_polyline(lats, lons, 5), '_p~iF~ps|U_ulLnnqC_mqNvxq`@')
+
+    def test_precision_limits(self):
+        # Rounded to precision decimals, not truncated
+        self.assertEqual(decode_polyline(encode_polyline([60.123456789], [-24.987654321], 7), 7),
+                         (np.array([60.1234568]), np.array([-24.9876543])))
+        # Binary deltas are int32: at the highest precision any absolute coordinate fits, a hop of over ~214
+        # degrees doesn't (the polyline has no such limit)
+        encode_binary_points([-89.9999999, 89.9999999], [-179.9999999, 0.0], MAX_ROUTE_FORMAT_PRECISION)
+        with self.assertRaises(ValueError):
+            encode_binary_points([0.0, 0.0], [-179.9999999, 179.9999999], MAX_ROUTE_FORMAT_PRECISION)
+        self.assertEqual(len(decode_polyline(encode_polyline([0.0, 0.0], [-179.9999999, 179.9999999], 7), 7)[0]), 2)
+        with self.assertRaises(ValueError):
+            decode_binary_points(b'NOPE' + encode_binary_points([1.0], [2.0])[4:])
+
+    def test_empty_route(self):
+        self.assertEqual(encode_polyline([], []), '')
+        decoded_lats, decoded_lons = decode_polyline('')
+        self.assertEqual((len(decoded_lats), len(decoded_lons)), (0, 0))
+        decoded_lats, decoded_lons, length_m = decode_binary_points(encode_binary_points([], []))
+        self.assertEqual((len(decoded_lats), len(decoded_lons), length_m), (0, 0, 0.0))
+
+
+class StitchPointsTests(SimpleTestCase):
+    # Edges 1-3 run A -> B -> C -> D, with edge 2 digitized backwards; edges 4-5 run A -> E -> D
+
+    EDGE_POINTS = {
+        1: [(0, 0), (0, 1), (1, 1)],
+        2: [(2, 1), (1, 1)],
+        3: [(2, 1), (3, 1), (3, 0)],
+        4: [(0, 0), (-1, 0), (-1, -1)],
+        5: [(3, 0), (-1, -1)]
+    }
+
+    def test_path_follows_travel_order(self):
+        self.assertEqual(stitch_path_points([1, 2, 3], self.EDGE_POINTS),
+                         [(0, 0), (0, 1), (1, 1), (2, 1), (3, 1), (3, 0)])
+        self.assertEqual(stitch_path_points([3, 2, 1], self.EDGE_POINTS),
+                         [(3, 0), (3, 1), (2, 1), (1, 1), (0, 1), (0, 0)])
+        # A first edge digitized backwards is flipped to meet the next one
+        self.assertEqual(stitch_path_points([2, 3], self.EDGE_POINTS), [(1, 1), (2, 1), (3, 1), (3, 0)])
+        self.assertEqual(stitch_path_points([2], self.EDGE_POINTS), [(2, 1), (1, 1)])
+        self.assertEqual(stitch_path_points([], self.EDGE_POINTS), [])
+
+    def test_round_trip_goes_out_and_back(self):
+        self.assertEqual(stitch_round_trip_points([1, 2, 3], [4, 5], self.EDGE_POINTS), [
+            (0, 0), (0, 1), (1, 1), (2, 1), (3, 1), (3, 0),  # Out
+            (-1, -1), (-1, 0), (0, 0)  # Back, the round trip point not repeated
+        ])
+        self.assertEqual(stitch_round_trip_points([], [], self.EDGE_POINTS), [])
+
+
+class TrackPointsTests(SimpleTestCase):
+
+    def test_round_trip_keeps_every_key(self):
+        points = [
+            {'x': 24.9384, 'y': 60.1699, 'd': 0.0, 'e': 12.5},
+            {'x': 24.9391, 'y': 60.1702, 'd': 55.3, 'e': None},  # Null channel value
+            {'x': 24.9402, 'y': 60.1705, 'd': 121.8, 'c': 'turn left'},  # Channel missing, unknown key
+            {'y': 60.1710, 'd': 180.2, 't': 1500000000, 'e': 14.0}
+        ]
+        self.assertEqual(decode_track_points(encode_track_points(points)).to_list(), points)
+        self.assertEqual(decode_track_points(encode_track_points([])).to_list(), [])